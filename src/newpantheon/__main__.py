@@ -28,6 +28,9 @@ def main():
     command_map = {
         "experiment": experiments.run,
         "analysis": analysis.run,
+        "results": analysis.query_results,
+        "tunnel-graph": analysis.tunnel_graph.run,
+        "live": analysis.live.run,
     }
     command_map[parsed_args.command](parsed_args)
 
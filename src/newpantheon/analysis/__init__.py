@@ -1,14 +1,112 @@
 import ast
 import json
+import os
+import sys
 from os import path
 
-from newpantheon.common import context
+from newpantheon.common import context, results_db
+
+from newpantheon.analysis import (figures, live, manifest, plot,
+                                  plot_over_time, profiling, report,
+                                  tunnel_graph)
+
+def parse_delay_sketch(subparser):
+    subparser.add_argument(
+        '--max-exact-delays', metavar='N', type=int, default=10000000,
+        help='per-packet delays to keep in memory per tunnel log before '
+        'switching to approximate percentiles (default 10000000)')
+    subparser.add_argument(
+        '--delay-error', metavar='FRACTION', type=float, default=0.01,
+        help='relative error bound of approximate delay percentiles '
+        '(default 0.01)')
+
+
+def parse_jobs(subparser):
+    subparser.add_argument(
+        '--parse-jobs', metavar='N', type=int, default=1,
+        help='processes that parse each tunnel log in parallel shards '
+        '(default 1)')
+
+
+def parse_analysis_jobs(subparser):
+    subparser.add_argument(
+        '--analysis-jobs', metavar='N', type=int, default=None,
+        help='worker processes that analyze and graph tunnel logs of '
+        'different runs in parallel (default: number of CPUs)')
+
+
+def parse_delay_graph(subparser):
+    subparser.add_argument(
+        '--delay-graph-mode', choices=['scatter', 'density', 'decimate'],
+        default='scatter',
+        help='draw per-packet delays as one point per packet (scatter), as a '
+        '2D density image (density) or as the packets with the minimum and '
+        'maximum delay per time column (decimate); the last two render in '
+        'bounded time for any number of packets (default scatter)')
+
+
+def parse_figures(subparser):
+    subparser.add_argument(
+        '--formats', metavar='FORMAT', nargs='+',
+        choices=list(figures.FORMATS) + ['none'],
+        help='save every figure in these formats (%s), or none to only '
+        'compute statistics; the PDF report embeds the png figures '
+        '(default: summary figures in svg, pdf and png, graphs of every '
+        'run in png)' % ', '.join(figures.FORMATS))
+    subparser.add_argument(
+        '--dpi', metavar='DPI', type=int,
+        help='resolution of the figures (default: 300, or the matplotlib '
+        'default for the throughput over time)')
+    subparser.add_argument(
+        '--save-jobs', metavar='N', type=int, default=1,
+        help='processes that encode figures in the background while the '
+        'next figure is drawn (default 1: encode in place)')
+
+
+def parse_incremental(subparser):
+    subparser.add_argument(
+        '--incremental', action='store_true',
+        help='only rebuild the graphs, stats logs and reports whose logs, '
+        'options or code changed since the last incremental analysis, as '
+        'recorded in DIR/%s' % manifest.MANIFEST_NAME)
+
+
+def parse_results_db(subparser, required=False):
+    subparser.add_argument(
+        '--results-db', metavar='DB',
+        default=os.environ.get('PANTHEON_RESULTS_DB'),
+        required=required and 'PANTHEON_RESULTS_DB' not in os.environ,
+        help='SQLite results database shared by experiments; the analysis '
+        'also records the results of every run in it '
+        '(default: $PANTHEON_RESULTS_DB, if set)')
+
+
+def parse_analysis_cache(subparser):
+    subparser.add_argument(
+        '--no-cache', action='store_true',
+        help='parse tunnel logs again instead of reusing the results cached '
+        'in DIR/.analysis_cache')
+
+
+def parse_profile(subparser):
+    subparser.add_argument(
+        '--profile', action='store_true',
+        help='record time, memory and bytes read per analysis stage and '
+        'save them in %s' % profiling.PROFILE_NAME)
 
-from newpantheon.analysis import plot, plot_over_time, report
 
 def parse_tunnel_graph(subparser):
-    subparser.add_argument('tunnel_log', metavar='tunnel-log',
-                        help='tunnel log file')
+    subparser.add_argument('tunnel_log', metavar='tunnel-log', nargs='?',
+                        help='tunnel log file; with --flow, where to write '
+                        'the merged log (default: not written)')
+    subparser.add_argument(
+        '--flow', metavar=('INGRESS-LOG', 'EGRESS-LOG'), nargs=2,
+        action='append',
+        help='analyze the raw logs of the tunnels as they are merged instead '
+        'of reading a merged tunnel log (repeat for every flow)')
+    subparser.add_argument(
+        '--link-log', metavar='LINK-LOG',
+        help='mm-link log to merge with the raw logs given with --flow')
     subparser.add_argument(
         '--throughput', metavar='OUTPUT-GRAPH',
         action='store', dest='throughput_graph',
@@ -20,6 +118,30 @@ def parse_tunnel_graph(subparser):
     subparser.add_argument(
         '--ms-per-bin', metavar='MS-PER-BIN', type=int, default=500,
         help='bin size in ms (default 500)')   
+    parse_delay_sketch(subparser)
+    parse_delay_graph(subparser)
+    parse_jobs(subparser)
+    parse_figures(subparser)
+    parse_profile(subparser)
+
+
+def parse_live(subparser):
+    subparser.add_argument(
+        '--flow', metavar=('INGRESS-LOG', 'EGRESS-LOG'), nargs=2,
+        action='append', required=True,
+        help='raw tunnel logs of one flow to follow (repeat for every flow)')
+    subparser.add_argument(
+        '--window', metavar='SECONDS', type=float, default=10,
+        help='window of the rolling statistics in seconds (default 10)')
+    subparser.add_argument(
+        '--interval', metavar='SECONDS', type=float, default=1,
+        help='seconds between refreshes (default 1)')
+    subparser.add_argument(
+        '--snapshot', metavar='JSON',
+        help='file to keep the latest statistics in (default None)')
+    subparser.add_argument(
+        '--duration', metavar='SECONDS', type=float,
+        help='stop after this many seconds (default: until interrupted)')
 
 
 def parse_analyze_shared(parser):
@@ -41,7 +163,16 @@ def parse_plot(subparser):
     subparser.add_argument(
         '--no-graphs', action='store_true', help='only append datalink '
         'statistics to stats files with no graphs generated')
- 
+    parse_delay_sketch(subparser)
+    parse_delay_graph(subparser)
+    parse_jobs(subparser)
+    parse_figures(subparser)
+    parse_analysis_jobs(subparser)
+    parse_results_db(subparser)
+    parse_analysis_cache(subparser)
+    parse_incremental(subparser)
+    parse_profile(subparser)
+
 
 
 def parse_report(subparser):
@@ -76,6 +207,15 @@ def parse_report(subparser):
     subparser.add_argument(
         '--amplify', metavar='FACTOR', type=float, default=1.0,
         help='amplication factor of output graph\'s x-axis scale ')
+    parse_delay_sketch(subparser)
+    parse_delay_graph(subparser)
+    parse_jobs(subparser)
+    parse_figures(subparser)
+    parse_analysis_jobs(subparser)
+    parse_results_db(subparser)
+    parse_analysis_cache(subparser)
+    parse_incremental(subparser)
+    parse_profile(subparser)
 
 
 def parse_over_time(subparser):
@@ -86,16 +226,82 @@ def parse_over_time(subparser):
     subparser.add_argument(
         '--amplify', metavar='FACTOR', type=float, default=1.0,
         help='amplication factor of output graph\'s x-axis scale ')
-  
+    parse_delay_sketch(subparser)
+    parse_jobs(subparser)
+    parse_figures(subparser)
+    parse_analysis_cache(subparser)
+    parse_incremental(subparser)
+    parse_profile(subparser)
+
 
 def parse_analyze(subparser):
     parse_analyze_shared(subparser)
     subparser.add_argument('--include-acklink', action='store_true',
                         help='include acklink analysis')
     
+def parse_results(subparser):
+    parse_results_db(subparser, required=True)
+    subparser.add_argument(
+        '--group-by', metavar='COLUMN', nargs='+', default=['scheme'],
+        choices=results_db.GROUP_COLUMNS,
+        help='summarize the latest result of every run per value of these '
+        'columns: %s (default scheme)' % ', '.join(results_db.GROUP_COLUMNS))
+    subparser.add_argument(
+        '--schemes', metavar='"SCHEME1 SCHEME2..."',
+        help='only include a space-separated list of schemes')
+    subparser.add_argument(
+        '--where', metavar='CONDITION',
+        help='only include runs matching this SQL condition on the columns '
+        'of the experiments and results tables, e.g. "runtime >= 30"')
+    subparser.add_argument(
+        '--json', action='store_true',
+        help='print the summary as JSON instead of a table')
+
+
 def setup_args(subparsers):
     parser_analysis = subparsers.add_parser("analysis", help="Run Analysis")
     parse_report(parser_analysis)
+    parser_results = subparsers.add_parser(
+        "results", help="Summarize results across experiments")
+    parse_results(parser_results)
+    parser_tunnel_graph = subparsers.add_parser(
+        "tunnel-graph", help="Analyze and graph one tunnel log")
+    parse_tunnel_graph(parser_tunnel_graph)
+    parser_live = subparsers.add_parser(
+        "live", help="Follow the rolling statistics of running tunnels")
+    parse_live(parser_live)
+
+
+def query_results(args):
+    conn = results_db.connect(args.results_db)
+    try:
+        rows = results_db.aggregate(
+            conn, args.group_by,
+            schemes=args.schemes.split() if args.schemes else None,
+            where=args.where)
+    finally:
+        conn.close()
+
+    if args.json:
+        json.dump([dict(row) for row in rows], sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    header = list(args.group_by) + ['experiments', 'runs', 'tput (Mbit/s)',
+                                    'delay (ms)', 'loss (%)']
+    table = [header]
+    for row in rows:
+        loss = row['loss_rate']
+        table.append([str(row[column]) for column in args.group_by] + [
+            str(row['experiments']), str(row['runs'])] + [
+            '' if value is None else '%.2f' % value
+            for value in [row['throughput_mbps'], row['delay_ms'],
+                          None if loss is None else loss * 100.0]])
+
+    widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+    for line in table:
+        print('  '.join(cell.ljust(width)
+                        for cell, width in zip(line, widths)).rstrip())
 
 def run(args):
     if args.schemes is None:
@@ -109,6 +315,15 @@ def run(args):
         if "test-name" in data:
             args.test_name = data["test-name"]
 
-    plot.run(args)
-    plot_over_time.run(args)
-    report.run(args)
+    profiler = profiling.Profiler() if args.profile else None
+    stage = (profiler or profiling.DISABLED).stage
+
+    with stage('plot'):
+        plot.run(args, profiler)
+    with stage('plot_over_time'):
+        plot_over_time.run(args, profiler)
+    with stage('report'):
+        report.run(args, profiler)
+
+    if profiler is not None:
+        profiler.report(path.join(args.data_dir, profiling.PROFILE_NAME))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""Mergeable, bounded-memory quantile sketch for per-packet delays.
+
+Delays are counted in logarithmically sized buckets (in the style of
+DDSketch), so every quantile is reported within a relative error of
+``relative_error`` while memory only depends on the range of the delays,
+not on the number of packets. Sketches built with the same error bound can
+be merged exactly.
+"""
+
+import math
+
+import numpy as np
+
+MIN_MAGNITUDE = 1e-6  # values closer to zero are counted as zero
+
+
+class _BucketStore(object):
+    """Counts per bucket index over a contiguous range of at most max_buckets;
+    the lowest buckets are folded together when the range grows too wide."""
+
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        self.base = 0  # bucket index of counts[0]
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, indices, counts=None):
+        if not indices.size:
+            return
+
+        lo = int(indices.min())
+        hi = int(indices.max())
+        if not self.counts.size:
+            self.base = lo
+            self._extend(lo, hi)
+        elif (hi >= self.base + self.counts.size or
+              (lo < self.base and self.counts.size < self.max_buckets)):
+            self._extend(lo, hi)
+
+        # indices below the folded floor land in the lowest bucket
+        np.maximum(indices, self.base, out=indices)
+        self.counts += np.bincount(indices - self.base, weights=counts,
+                                   minlength=self.counts.size).astype(np.int64)
+
+    def _extend(self, lo, hi):
+        top = max(hi, self.base + self.counts.size - 1)
+        bottom = min(lo, self.base)
+        if top - bottom + 1 > self.max_buckets:
+            bottom = top - self.max_buckets + 1
+
+        counts = np.zeros(top - bottom + 1, dtype=np.int64)
+        if self.counts.size:
+            old = np.arange(self.base, self.base + self.counts.size)
+            np.add.at(counts, np.maximum(old, bottom) - bottom, self.counts)
+        self.base = bottom
+        self.counts = counts
+
+    def merge(self, other):
+        if other.counts.size:
+            self.add(np.arange(other.base, other.base + other.counts.size),
+                     other.counts)
+
+    def indices(self):
+        return np.arange(self.base, self.base + self.counts.size)
+
+    def state(self):
+        return {'bounds': np.array([self.max_buckets, self.base]),
+                'counts': self.counts}
+
+    @classmethod
+    def from_state(cls, state):
+        max_buckets, base = state['bounds'].tolist()
+        store = cls(max_buckets)
+        store.base = base
+        store.counts = state['counts']
+        return store
+
+
+class DelaySketch(object):
+    def __init__(self, relative_error=0.01, max_buckets=2048):
+        if not 0 < relative_error < 1:
+            raise ValueError('relative error must be between 0 and 1')
+
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+
+        self.positive = _BucketStore(max_buckets)
+        self.negative = _BucketStore(max_buckets)
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def _value(self, index):
+        return 2.0 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values > MIN_MAGNITUDE
+        negative = values < -MIN_MAGNITUDE
+        self.positive.add(self._index(values[positive]))
+        self.negative.add(self._index(-values[negative]))
+        self.zeros += values.size - int(positive.sum()) - int(negative.sum())
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('cannot merge sketches with different errors')
+
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def state(self):
+        """Return the sketch as a flat dict of numpy arrays."""
+        state = {'stats': np.array([self.relative_error, self.zeros,
+                                    self.count, self.min, self.max])}
+        for sign in ['positive', 'negative']:
+            for key, value in getattr(self, sign).state().items():
+                state['%s.%s' % (sign, key)] = value
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        relative_error, zeros, count, vmin, vmax = state['stats'].tolist()
+        sketch = cls(relative_error)
+        sketch.zeros = int(zeros)
+        sketch.count = int(count)
+        sketch.min = vmin
+        sketch.max = vmax
+        for sign in ['positive', 'negative']:
+            store = _BucketStore.from_state(
+                {key: state['%s.%s' % (sign, key)]
+                 for key in ['bounds', 'counts']})
+            setattr(sketch, sign, store)
+        return sketch
+
+    def quantile(self, q):
+        """Return the q-th percentile (0 <= q <= 100), picking the nearest
+        rank like np.percentile(..., method='nearest')."""
+        if not self.count:
+            return None
+
+        rank = int(np.around(q / 100.0 * (self.count - 1)))
+
+        # walk from the most negative bucket up to the most positive one
+        counts = np.concatenate([self.negative.counts[::-1], [self.zeros],
+                                 self.positive.counts])
+        bucket = int(np.searchsorted(np.cumsum(counts), rank, side='right'))
+
+        negatives = self.negative.counts.size
+        if bucket < negatives:
+            index = self.negative.indices()[::-1][bucket]
+            value = -self._value(index)
+        elif bucket == negatives:
+            value = 0.0
+        else:
+            index = self.positive.indices()[bucket - negatives - 1]
+            value = self._value(index)
+
+        return min(max(value, self.min), self.max)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Saving the figures of the analysis (--formats, --dpi, --save-jobs).
+
+A FigureSaver saves a figure in the formats selected with --formats, or in
+the default formats of the figure when none were selected, at the --dpi
+resolution. With --save-jobs N > 1, every format is encoded by a child
+process forked with a copy of the drawn figure, so that encoding runs in
+parallel with the next figure; up to N such processes run at a time, and
+wait() returns once they all have finished.
+"""
+
+import multiprocessing
+import sys
+from os import path
+
+from newpantheon.analysis import profiling
+
+FORMATS = ('svg', 'pdf', 'png')
+
+
+def selected_formats(args):
+    """The formats selected with --formats: None if not given, [] for none
+    or with --no-graphs and otherwise a list of formats."""
+    if getattr(args, 'no_graphs', False):
+        return []
+    formats = getattr(args, 'formats', None)
+    if formats is None:
+        return None
+    if 'none' in formats:
+        return []
+    return list(dict.fromkeys(formats))
+
+
+def _savefig(fig, fig_path, kwargs):
+    fig.savefig(fig_path, **kwargs)
+
+
+class FigureSaver(object):
+    def __init__(self, formats=None, dpi=None, jobs=1, profiler=None):
+        self.formats = formats
+        self.dpi = dpi
+        # daemonic processes, such as pool workers on Python < 3.9, cannot
+        # have children
+        if multiprocessing.current_process().daemon:
+            jobs = 1
+        self.jobs = jobs
+        self.profiler = profiler or profiling.DISABLED
+        self.pending = []  # (process, figure path)
+
+    @classmethod
+    def from_args(cls, args, profiler=None):
+        return cls(formats=selected_formats(args),
+                   dpi=getattr(args, 'dpi', None),
+                   jobs=getattr(args, 'save_jobs', 1),
+                   profiler=profiler)
+
+    def enabled(self):
+        """False if --formats none left no figures to save."""
+        return self.formats != []
+
+    def paths(self, fig_path, formats=None):
+        """The paths to save the figure at fig_path as: fig_path with its
+        extension replaced by every selected format, or else by every one of
+        formats, or else fig_path as is."""
+        formats = self.formats if self.formats is not None else formats
+        if formats is None:
+            return [fig_path]
+        root = path.splitext(fig_path)[0]
+        return ['%s.%s' % (root, graph_format) for graph_format in formats]
+
+    def save(self, fig, fig_path, formats=None, **kwargs):
+        """Save fig in the paths given by paths(); kwargs are passed on to
+        savefig, with dpi replaced by --dpi if given."""
+        if self.dpi is not None:
+            kwargs['dpi'] = self.dpi
+
+        for graph_path in self.paths(fig_path, formats):
+            graph_format = path.splitext(graph_path)[1].lstrip('.')
+            with self.profiler.stage('savefig', format=graph_format):
+                if self.jobs < 2:
+                    fig.savefig(graph_path, **kwargs)
+                    continue
+
+                while len(self.pending) >= self.jobs:
+                    self._join(self.pending.pop(0))
+                process = multiprocessing.Process(
+                    target=_savefig, args=(fig, graph_path, kwargs))
+                process.start()
+                self.pending.append((process, graph_path))
+
+    def _join(self, pending):
+        process, graph_path = pending
+        process.join()
+        if process.exitcode != 0:
+            sys.stderr.write('Warning: failed to save %s\n' % graph_path)
+
+    def wait(self):
+        """Wait for the figures that are still being saved."""
+        if not self.pending:
+            return
+        with self.profiler.stage('savefig_wait'):
+            while self.pending:
+                self._join(self.pending.pop(0))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""Rolling statistics of tunnels while a test is still running.
+
+Follows the raw egress and ingress logs of every tunnel as they grow,
+pairs packets by uid the way ``merge_tunnel_logs.py single`` does and keeps
+throughput, 95th percentile delay and loss over a sliding window per flow.
+The statistics are printed periodically and written to a JSON snapshot.
+"""
+
+import collections
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+import numpy as np
+
+from newpantheon.common.log_format import US_PER_MS, parse_ms
+
+
+class LogFollower(object):
+    """Returns the complete lines appended to a file since the last read."""
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.offset = 0
+        self.partial = b''
+
+    def read_lines(self):
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return []  # not created yet
+
+        if size < self.offset:
+            # truncated or replaced: start over
+            self.offset = 0
+            self.partial = b''
+        if size == self.offset:
+            return []
+
+        with open(self.log_path, 'rb') as log:
+            log.seek(self.offset)
+            data = log.read(size - self.offset)
+        self.offset += len(data)
+
+        data = self.partial + data
+        cut = data.rfind(b'\n') + 1
+        self.partial = data[cut:]
+        return data[:cut].decode(errors='replace').splitlines()
+
+
+class Window(object):
+    """Values timestamped in microseconds, of which only the last window_us
+    are kept."""
+
+    def __init__(self, window_us):
+        self.window_us = window_us
+        self.items = collections.deque()
+        self.total = 0
+
+    def add(self, ts, value):
+        self.items.append((ts, value))
+        self.total += value
+
+    def expire(self, now):
+        while self.items and self.items[0][0] < now - self.window_us:
+            self.total -= self.items.popleft()[1]
+
+    def values(self):
+        return [value for _, value in self.items]
+
+
+class LiveFlow(object):
+    """Joins the egress (packets entering the tunnel) and ingress (packets
+    leaving it) logs of one tunnel as they grow."""
+
+    def __init__(self, flow_id, ingress_log, egress_log, window_s=10):
+        self.flow_id = flow_id
+        self.send_log = LogFollower(egress_log)
+        self.recv_log = LogFollower(ingress_log)
+        self.window_us = round(1000 * US_PER_MS * window_s)
+
+        self.send_init_ts = None
+        self.recv_init_ts = None
+        self.send_lines = []  # held back until both init timestamps are known
+        self.recv_lines = []
+
+        # uid -> (calibrated timestamp, size) of unpaired packets, in the
+        # order of their timestamps, so that expiring them stops at the first
+        # one still within the window
+        self.sent = collections.OrderedDict()
+        self.unmatched = collections.OrderedDict()  # received before sent
+        self.arrivals = Window(self.window_us)
+        self.departures = Window(self.window_us)
+        self.delays = Window(self.window_us)
+
+        # timestamps in microseconds, as merge_tunnel_logs keeps them
+        self.first_ts = None
+        self.now = None  # latest timestamp seen
+        self.send_now = None  # latest timestamp read from either log
+        self.recv_now = None
+        self.total_arrivals = 0
+        self.total_departures = 0
+
+    def poll(self):
+        # read the sending side first, so that most packets received in the
+        # meantime can be paired right away
+        self.send_lines += self.send_log.read_lines()
+        self.recv_lines += self.recv_log.read_lines()
+
+        if self.send_init_ts is None and self.send_lines:
+            self.send_init_ts = parse_ms(
+                self.send_lines.pop(0).rsplit(':', 1)[-1])
+        if self.recv_init_ts is None and self.recv_lines:
+            self.recv_init_ts = parse_ms(
+                self.recv_lines.pop(0).rsplit(':', 1)[-1])
+        if self.send_init_ts is None or self.recv_init_ts is None:
+            return
+
+        # timestamp calibration as in merge_tunnel_logs.single_mode
+        min_init_ts = min(self.send_init_ts, self.recv_init_ts)
+        send_cal = self.send_init_ts - min_init_ts
+        recv_cal = self.recv_init_ts - min_init_ts
+
+        for line in self.send_lines:
+            ts, uid, size = self.parse_line(line)
+            if ts is None:
+                continue
+            ts += send_cal
+            self.sent[uid] = (ts, size)
+            self.sent.move_to_end(uid)
+            self.arrivals.add(ts, size * 8)
+            self.total_arrivals += size * 8
+            self.send_now = ts
+            self.advance(ts)
+        self.send_lines = []
+
+        for line in self.recv_lines:
+            ts, uid, size = self.parse_line(line)
+            if ts is not None:
+                self.unmatched[uid] = (ts + recv_cal, size)
+                self.recv_now = ts + recv_cal
+        self.recv_lines = []
+
+        for uid in list(self.unmatched):
+            if uid in self.sent:
+                recv_ts, size = self.unmatched.pop(uid)
+                send_ts, _ = self.sent.pop(uid)
+                self.departures.add(recv_ts, size * 8)
+                self.delays.add(recv_ts, recv_ts - send_ts)
+                self.total_departures += size * 8
+                self.advance(recv_ts)
+
+        self.expire()
+
+    def parse_line(self, line):
+        try:
+            ts, uid, size = line.split('-')
+            return parse_ms(ts), int(uid), int(size)
+        except ValueError:
+            return None, None, None
+
+    def advance(self, ts):
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts = ts
+        if self.now is None or ts > self.now:
+            self.now = ts
+
+    def expire(self):
+        if self.now is None:
+            return
+
+        for window in [self.arrivals, self.departures, self.delays]:
+            window.expire(self.now)
+
+        # packets still unpaired a whole window after the other log got past
+        # them are not waited for
+        if self.recv_now is not None:
+            self.expire_packets(self.sent, self.recv_now - self.window_us)
+        if self.send_now is not None:
+            self.expire_packets(self.unmatched, self.send_now - self.window_us)
+
+    def expire_packets(self, packets, horizon):
+        # packets are in timestamp order: drop them from the front
+        while packets:
+            uid, (ts, _) = next(iter(packets.items()))
+            if ts >= horizon:
+                break
+            del packets[uid]
+
+    def stats(self):
+        window_us = self.window_us
+        if self.now is not None:
+            window_us = min(window_us, self.now - self.first_ts) or window_us
+
+        delays = self.delays.values()
+        loss = None
+        if self.arrivals.total > 0:
+            loss = max(0.0, 1 - 1.0 * self.departures.total /
+                       self.arrivals.total)
+
+        return {
+            'time': (None if self.now is None
+                     else self.now / (1000.0 * US_PER_MS)),
+            'ingress_tput': self.arrivals.total / window_us,
+            'egress_tput': self.departures.total / window_us,
+            'delay': (np.percentile(delays, 95, method='nearest') / US_PER_MS
+                      if delays else None),
+            'loss': loss,
+            'total_arrivals': self.total_arrivals,
+            'total_departures': self.total_departures,
+        }
+
+
+class LiveTunnelGraph(object):
+    """Rolling per-flow statistics of several tunnels, refreshed every
+    interval_s seconds until stopped."""
+
+    def __init__(self, flows, window_s=10, interval_s=1, snapshot=None,
+                 output=sys.stderr):
+        # flows: {flow_id: (ingress_log, egress_log)}
+        self.flows = collections.OrderedDict(
+            (flow_id, LiveFlow(flow_id, ingress, egress, window_s))
+            for flow_id, (ingress, egress) in sorted(flows.items()))
+        self.window_s = window_s
+        self.interval_s = interval_s
+        self.snapshot = snapshot
+        self.output = output
+        self.stop_event = threading.Event()
+
+    def poll(self):
+        for flow in self.flows.values():
+            flow.poll()
+
+    def stats(self):
+        return {
+            'updated': time.time(),
+            'window_s': self.window_s,
+            'flows': {str(flow_id): flow.stats()
+                      for flow_id, flow in self.flows.items()},
+        }
+
+    def statistics_string(self, stats=None):
+        stats = stats or self.stats()
+        ret = '-- Last %s s:\n' % self.window_s
+        for flow_id, flow in stats['flows'].items():
+            ret += 'Flow %s: %.2f Mbit/s in, %.2f Mbit/s out' % (
+                flow_id, flow['ingress_tput'], flow['egress_tput'])
+            if flow['delay'] is not None:
+                ret += ', 95th percentile delay %.3f ms' % flow['delay']
+            if flow['loss'] is not None:
+                ret += ', loss %.2f%%' % (flow['loss'] * 100.0)
+            ret += '\n'
+        return ret
+
+    def write_snapshot(self, stats):
+        # replace the snapshot atomically, so readers never see half of it
+        snapshot_dir = path.dirname(path.abspath(self.snapshot))
+        fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(stats, tmp, indent=2)
+        os.replace(tmp_path, self.snapshot)
+
+    def refresh(self):
+        self.poll()
+        stats = self.stats()
+        if self.output is not None:
+            self.output.write(self.statistics_string(stats))
+        if self.snapshot:
+            self.write_snapshot(stats)
+        return stats
+
+    def run(self, duration_s=None):
+        """Refresh until stop() is called or duration_s seconds elapsed."""
+        deadline = None if duration_s is None else time.time() + duration_s
+        while not self.stop_event.is_set():
+            self.refresh()
+            if deadline is not None and time.time() >= deadline:
+                break
+            self.stop_event.wait(self.interval_s)
+        self.refresh()
+
+    def start(self):
+        """Run in a background thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if getattr(self, 'thread', None) is not None:
+            self.thread.join()
+
+
+def run(args):
+    flows = {}
+    for flow_id, (ingress_log, egress_log) in enumerate(args.flow, 1):
+        flows[flow_id] = (ingress_log, egress_log)
+
+    live = LiveTunnelGraph(flows, window_s=args.window,
+                           interval_s=args.interval, snapshot=args.snapshot)
+    try:
+        live.run(args.duration)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Manifest of the artifacts of an incremental analysis (--incremental).
+
+Every artifact of the analysis, such as the graphs and stats log of a run,
+the summary figures or the report, is recorded in
+<data-dir>/pantheon_manifest.json under a key, together with its inputs
+(fingerprints of the logs it was made from, the options that shape it and
+the version of the code that made it), the fingerprints of the files it
+wrote and, optionally, a result to reuse. A later run with the same inputs
+whose files are still in place finds the artifact up to date and skips
+it. Without --incremental, the analysis uses DISABLED, which finds
+nothing up to date and records nothing.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from os import path
+
+from newpantheon import __about__
+
+MANIFEST_NAME = 'pantheon_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def fingerprint(file_path):
+    """[size, modification time in ns] of file_path, or None if missing."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def code_version(*modules):
+    """Digest of the package version and the sources of modules, so that
+    changing the code that makes an artifact makes it outdated."""
+    digest = hashlib.sha1(__about__.__version__.encode())
+    for module in modules:
+        with open(module.__file__, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:16]
+
+
+def _normalized(value):
+    # inputs compare as they read back from JSON, e.g. tuples as lists
+    return json.loads(json.dumps(value))
+
+
+class Manifest(object):
+    enabled = True
+
+    def __init__(self, manifest_path, artifacts=None):
+        self.manifest_path = manifest_path
+        self.artifacts = artifacts or {}
+
+    @classmethod
+    def load(cls, data_dir):
+        """Load the manifest of data_dir; a missing, unreadable or outdated
+        manifest starts empty."""
+        manifest_path = path.join(data_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as manifest:
+                saved = json.load(manifest)
+            if saved.get('version') == MANIFEST_VERSION:
+                return cls(manifest_path, saved['artifacts'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as exception:
+            sys.stderr.write('Warning: ignoring unreadable manifest %s (%s)\n'
+                             % (manifest_path, exception))
+        return cls(manifest_path)
+
+    def up_to_date(self, key, inputs):
+        """Return the artifact recorded under key if it was made from the
+        same inputs and its files are unchanged, otherwise None."""
+        artifact = self.artifacts.get(key)
+        if artifact is None or artifact['inputs'] != _normalized(inputs):
+            return None
+        for output, recorded in artifact['outputs'].items():
+            if fingerprint(output) != recorded:
+                return None
+        return artifact
+
+    def record(self, key, inputs, outputs, result=None):
+        """Record that the files outputs were made from inputs, along with
+        a JSON-serializable result."""
+        self.artifacts[key] = {
+            'inputs': _normalized(inputs),
+            'outputs': {output: fingerprint(output) for output in outputs},
+            'result': _normalized(result)}
+
+    def save(self):
+        # write under a temporary name first, so that an interrupted save
+        # leaves the previous manifest in place
+        manifest_dir = path.dirname(self.manifest_path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=manifest_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as manifest:
+                    json.dump({'version': MANIFEST_VERSION,
+                               'artifacts': self.artifacts},
+                              manifest, indent=2)
+                os.replace(tmp_path, self.manifest_path)
+            finally:
+                if path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except OSError as exception:
+            sys.stderr.write('Warning: failed to save manifest %s (%s)\n'
+                             % (self.manifest_path, exception))
+
+
+class _DisabledManifest(object):
+    enabled = False
+
+    def up_to_date(self, key, inputs):
+        return None
+
+    def record(self, key, inputs, outputs, result=None):
+        pass
+
+    def save(self):
+        pass
+
+
+DISABLED = _DisabledManifest()
+
+
+def for_args(args):
+    """The manifest of args.data_dir with --incremental, else DISABLED."""
+    if getattr(args, 'incremental', False):
+        return Manifest.load(path.abspath(args.data_dir))
+    return DISABLED
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Cache of parsed tunnel logs shared by the analysis stages.
+
+Parsing a tunnel log yields a TunnelLogSummary, which holds everything that
+tunnel_graph, plot and plot_over_time need. Summaries are saved as .npz
+files under <data-dir>/.analysis_cache, named after a hash of the log's
+path, size and modification time and of the parsing parameters, so a
+changed log or different parameters never hit a stale entry. Writing a
+new entry for a log removes the entries it supersedes. Bits are binned per
+millisecond in the summary, so one entry serves every bin size.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from os import path
+
+from newpantheon.analysis import tunnel_log
+
+CACHE_DIR = '.analysis_cache'
+
+
+def cache_dir_for(data_dir):
+    return path.join(data_dir, CACHE_DIR)
+
+
+def cache_path(cache_dir, log_path, **params):
+    log_path = path.abspath(log_path)
+    st = os.stat(log_path)
+    key = json.dumps([log_path, st.st_size, st.st_mtime_ns,
+                      sorted(params.items())])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return path.join(cache_dir, '%s.%s.npz' % (path.basename(log_path), digest))
+
+
+def remove_superseded(npz_path):
+    """Remove the other entries for the log of the entry npz_path."""
+    log_name, digest, _ = path.basename(npz_path).rsplit('.', 2)
+    pattern = '%s.%s.npz' % (glob.escape(log_name), '?' * len(digest))
+    for entry in glob.glob(path.join(glob.escape(path.dirname(npz_path)),
+                                     pattern)):
+        if entry != npz_path:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass  # removed concurrently
+
+
+def load_summary(log_path, cache_dir=None, max_exact_delays=None,
+                 delay_error=0.01, jobs=1):
+    """Return the TunnelLogSummary of log_path, parsing the log (with jobs
+    processes) only if cache_dir holds no summary for its current contents.
+    A cache_dir of None disables caching."""
+    params = {'max_exact_delays': max_exact_delays,
+              'delay_error': delay_error}
+    if cache_dir is None:
+        return tunnel_log.summarize(log_path, jobs=jobs, **params)
+
+    npz_path = cache_path(cache_dir, log_path,
+                          version=tunnel_log.SUMMARY_VERSION, **params)
+    if path.isfile(npz_path):
+        try:
+            return tunnel_log.TunnelLogSummary.load(npz_path)
+        except Exception as exception:
+            sys.stderr.write('Warning: ignoring unreadable cache entry %s '
+                             '(%s)\n' % (npz_path, exception))
+
+    summary = tunnel_log.summarize(log_path, jobs=jobs, **params)
+
+    # write under a temporary name first so that concurrent readers never
+    # see a partially written entry
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            summary.save(tmp_path)
+            os.replace(tmp_path, npz_path)
+            remove_superseded(npz_path)
+        finally:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+    except OSError as exception:
+        sys.stderr.write('Warning: failed to cache %s (%s)\n'
+                         % (log_path, exception))
+
+    return summary
@@ -5,7 +5,7 @@ import sys
 import math
 import json
 import multiprocessing
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 import matplotlib
@@ -14,19 +14,41 @@ import matplotlib.ticker as ticker
 matplotlib.use('Agg')
 
 
-from newpantheon.common import utils
-from newpantheon.analysis import tunnel_graph
+from newpantheon.common import log_format, results_db, tunnel_merge, utils
+from newpantheon.analysis import (delay_sketch, figures, manifest,
+                                  parse_cache, profiling, run_stats,
+                                  tunnel_graph, tunnel_log)
 
 
 class Plot(object):
-    def __init__(self, args):
+    def __init__(self, args, profiler=None):
         # plt.use('Agg')
         self.data_dir = path.abspath(args.data_dir)
+        self.profiler = profiler or profiling.DISABLED
         self.include_acklink = args.include_acklink
         self.no_graphs = args.no_graphs
+        self.max_exact_delays = args.max_exact_delays
+        self.delay_error = args.delay_error
+        self.delay_graph_mode = args.delay_graph_mode
+        self.parse_jobs = args.parse_jobs
+        self.analysis_jobs = (getattr(args, 'analysis_jobs', None)
+                              or multiprocessing.cpu_count())
+        self.cache_dir = (None if args.no_cache
+                          else parse_cache.cache_dir_for(self.data_dir))
+        self.formats = figures.selected_formats(args)
+        self.dpi = getattr(args, 'dpi', None)
+        self.save_jobs = getattr(args, 'save_jobs', 1)
+        self.manifest = manifest.for_args(args)
+        self.results_db = getattr(args, 'results_db', None)
+        if self.manifest.enabled:
+            # every module that the graphs and statistics depend on
+            self.code_version = manifest.code_version(
+                sys.modules[__name__], figures, tunnel_graph, tunnel_log,
+                log_format, parse_cache, delay_sketch, tunnel_merge)
 
         metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
         meta = utils.load_test_metadata(metadata_path)
+        self.meta = meta
         self.interactions = args.interactions
         if not self.interactions:
             self.cc_schemes = utils.verify_schemes_with_meta(args.schemes, meta)
@@ -65,40 +87,55 @@ class Plot(object):
 
         return expt_title
 
-    def parse_tunnel_log(self, cc, run_id):
+    def link_directions(self):
+        if self.include_acklink:
+            return ['datalink', 'acklink']
+        return ['datalink']
+
+    def tunnel_log_path(self, cc, link_t, run_id):
         log_prefix = cc
         if self.flows == 0:
             log_prefix += '_mm'
 
+        log_name = f"{log_prefix}_{link_t}_run{run_id}.log"
+        return log_format.find_log(path.join(self.data_dir, log_name))
+
+    def parse_tunnel_log(self, cc, run_id):
         error = False
         ret = None
 
-        link_directions = ['datalink']
-        if self.include_acklink:
-            link_directions.append('acklink')
-
-        for link_t in link_directions:
-            log_name = f"{log_prefix}_{link_t}_run{run_id}.log"
-            log_path = path.join(self.data_dir, log_name)
+        for link_t in self.link_directions():
+            log_path = self.tunnel_log_path(cc, link_t, run_id)
 
             if not path.isfile(log_path):
                 sys.stderr.write(f"Warning: {log_path} does not exist\n")
                 error = True
                 continue
 
-            # if self.no_graphs:
-            #     tput_graph_path = None
-            #     delay_graph_path = None
-            # else:
-            tput_graph_path = path.join(self.data_dir, f"{cc}_{link_t}_throughput_run{run_id}.png")
-            delay_graph_path = path.join(self.data_dir, f"{cc}_{link_t}_delay_run{run_id}.png")
+            if self.formats == []:
+                tput_graph_path = None
+                delay_graph_path = None
+            else:
+                tput_graph_path = path.join(self.data_dir, f"{cc}_{link_t}_throughput_run{run_id}.png")
+                delay_graph_path = path.join(self.data_dir, f"{cc}_{link_t}_delay_run{run_id}.png")
 
             sys.stderr.write(f"$ tunnel_graph {log_path}\n")
             try:
-                tunnel_results = tunnel_graph.TunnelGraph(
-                    tunnel_log=log_path,
-                    throughput_graph=tput_graph_path,
-                    delay_graph=delay_graph_path).run()
+                with self.profiler.stage('tunnel_graph', scheme=cc,
+                                         run=run_id, link=link_t):
+                    tunnel_results = tunnel_graph.TunnelGraph(
+                        tunnel_log=log_path,
+                        throughput_graph=tput_graph_path,
+                        delay_graph=delay_graph_path,
+                        max_exact_delays=self.max_exact_delays,
+                        delay_error=self.delay_error,
+                        cache_dir=self.cache_dir,
+                        delay_graph_mode=self.delay_graph_mode,
+                        parse_jobs=self.parse_jobs,
+                        profiler=self.profiler,
+                        formats=self.formats,
+                        dpi=self.dpi,
+                        save_jobs=self.save_jobs).run()
             except Exception as exception:
                 sys.stderr.write('Error: %s\n' % exception)
                 sys.stderr.write('Warning: "tunnel_graph %s" failed but '
@@ -154,6 +191,64 @@ class Plot(object):
                         stats_log.write(f"# Flow {i+1} = {self.individual_schemes[i]}\n")
                 stats_log.write(stats)
 
+    def __getstate__(self):
+        # workers get a profiler of their own, as the profiler holds a lock,
+        # and leave the manifest to this process
+        state = dict(self.__dict__)
+        state['profiler'] = self.profiler.enabled
+        state['manifest'] = manifest.DISABLED
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.profiler = (profiling.Profiler() if state['profiler']
+                         else profiling.DISABLED)
+
+    def parse_tunnel_logs(self, jobs):
+        """Return the results of parse_tunnel_log for every (cc, run_id) in
+        jobs, in order. With analysis_jobs > 1, the logs are parsed and
+        their graphs rendered by a pool of worker processes, which only
+        send back the results and their profiled stages."""
+        processes = min(self.analysis_jobs, len(jobs))
+        if processes < 2:
+            return [self.parse_tunnel_log(cc, run_id) for cc, run_id in jobs]
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(_parse_tunnel_log, self, cc, run_id)
+                       for cc, run_id in jobs]
+            ret = []
+            for future in futures:
+                result, records = future.result()
+                if self.profiler.enabled:
+                    self.profiler.add_records(records)
+                ret.append(result)
+        return ret
+
+    def run_inputs(self, cc, run_id):
+        if not self.manifest.enabled:
+            return None
+        return {
+            'logs': [manifest.fingerprint(self.tunnel_log_path(cc, link_t, run_id))
+                     for link_t in self.link_directions()],
+            'outputs': self.run_outputs(cc, run_id),
+            'options': [self.max_exact_delays, self.delay_error,
+                        self.delay_graph_mode, self.dpi, self.runtime,
+                        self.interactions and self.individual_schemes],
+            'code': self.code_version}
+
+    def run_outputs(self, cc, run_id):
+        """The graphs, stats log and run_stats file that parse_tunnel_log
+        and eval_performance write for a run."""
+        saver = figures.FigureSaver(self.formats)
+        outputs = [path.join(self.data_dir, f"{cc}_stats_run{run_id}.log"),
+                   run_stats.stats_path(self.data_dir, cc, run_id)]
+        if saver.enabled():
+            for link_t in self.link_directions():
+                for metric_t in ['throughput', 'delay']:
+                    outputs += saver.paths(path.join(
+                        self.data_dir, f"{cc}_{link_t}_{metric_t}_run{run_id}.png"))
+        return outputs
+
     def eval_performance(self):
         perf_data = {}
         stats = {}
@@ -162,29 +257,39 @@ class Plot(object):
             perf_data[cc] = {}
             stats[cc] = {}
 
-        cc_id = 0
-        run_id = 1
-        pool = ThreadPool(processes=multiprocessing.cpu_count())
+        # with --incremental, runs whose logs, options and outputs are
+        # unchanged reuse the results saved by run_stats
+        jobs = []
+        run_inputs = {}
+        for cc in self.cc_schemes:
+            for run_id in range(1, 1 + self.run_times):
+                run_inputs[cc, run_id] = self.run_inputs(cc, run_id)
+                artifact = self.manifest.up_to_date(
+                    f"{cc}_run{run_id}", run_inputs[cc, run_id])
+                if artifact is None:
+                    jobs.append((cc, run_id))
+                    continue
 
-        while cc_id < len(self.cc_schemes):
-            cc = self.cc_schemes[cc_id]
-            perf_data[cc][run_id] = pool.apply_async(
-                self.parse_tunnel_log, args=(cc, run_id))
+                result = run_stats.load(self.data_dir, cc, run_id)
+                perf_data[cc][run_id] = result
+                if result is not None:
+                    stats[cc][run_id] = result['stats']
 
-            run_id += 1
-            if run_id > self.run_times:
-                run_id = 1
-                cc_id += 1
+        if self.manifest.enabled:
+            sys.stderr.write(f'Reused {len(run_inputs) - len(jobs)} up-to-date '
+                             f'runs recorded in {manifest.MANIFEST_NAME}\n')
 
-        for cc in self.cc_schemes:
-            for run_id in range(1, 1 + self.run_times):
-                perf_data[cc][run_id] = perf_data[cc][run_id].get()
+        for (cc, run_id), result in zip(jobs, self.parse_tunnel_logs(jobs)):
+            perf_data[cc][run_id] = result
 
-                if perf_data[cc][run_id] is None:
-                    continue
-                stats_str = perf_data[cc][run_id]['stats']
+            if result is not None:
+                stats_str = result['stats']
                 self.update_stats_log(cc, run_id, stats_str)
                 stats[cc][run_id] = stats_str
+            run_stats.save(self.data_dir, cc, run_id, result)
+
+            self.manifest.record(f"{cc}_run{run_id}", run_inputs[cc, run_id],
+                                 self.run_outputs(cc, run_id))
 
         sys.stderr.write(f'Appended datalink statistics to stats files in {self.data_dir}\n')
 
@@ -291,27 +396,27 @@ class Plot(object):
         lgd = ax_raw.legend(scatterpoints=1, bbox_to_anchor=(0.5, -0.15),
                             loc='upper center', fontsize=12)
 
-        for graph_format in ['svg', 'pdf', 'png']:
-            raw_summary = path.join(
-                self.data_dir, 'pantheon_summary.%s' % graph_format)
-            fig_raw.savefig(raw_summary, dpi=300, bbox_extra_artists=(lgd,),
-                            bbox_inches='tight', pad_inches=0.2)
+        saver = figures.FigureSaver(self.formats, self.dpi, self.save_jobs,
+                                    self.profiler)
+        saver.save(fig_raw, path.join(self.data_dir, 'pantheon_summary'),
+                   figures.FORMATS, dpi=300, bbox_extra_artists=(lgd,),
+                   bbox_inches='tight', pad_inches=0.2)
 
         # save pantheon_summary_mean.svg and .pdf
         ax_mean.set_title(self.expt_title +
                           ' (mean of all runs by scheme)', fontsize=12)
 
-        for graph_format in ['svg', 'pdf', 'png']:
-            mean_summary = path.join(
-                self.data_dir, 'pantheon_summary_mean.%s' % graph_format)
-            fig_mean.savefig(mean_summary, dpi=300,
-                             bbox_inches='tight', pad_inches=0.2)
+        saver.save(fig_mean, path.join(self.data_dir, 'pantheon_summary_mean'),
+                   figures.FORMATS, dpi=300, bbox_inches='tight',
+                   pad_inches=0.2)
+        saver.wait()
 
         sys.stderr.write(
             f'Saved throughput graphs, delay graphs, and summary graphs in {self.data_dir}\n')
 
     def run(self):
-        perf_data, stats_logs = self.eval_performance()
+        with self.profiler.stage('eval_performance'):
+            perf_data, stats_logs = self.eval_performance()
 
         data_for_plot = {}
         data_for_json = {}
@@ -334,15 +439,47 @@ class Plot(object):
                 if flow_data is not None:
                     data_for_json[cc][run_id] = flow_data
 
-        # if not self.no_graphs:
-        self.plot_throughput_delay(data_for_plot)
-
-        plt.close('all')
+        saver = figures.FigureSaver(self.formats)
+        summary_outputs = [
+            graph_path for name in ['pantheon_summary', 'pantheon_summary_mean']
+            for graph_path in saver.paths(path.join(self.data_dir, name),
+                                          figures.FORMATS)]
+        summary_inputs = None
+        if self.manifest.enabled:
+            summary_inputs = {
+                'runs': data_for_plot,
+                'title': self.expt_title,
+                'outputs': summary_outputs,
+                'options': [self.dpi],
+                'code': self.code_version}
+        if (saver.enabled() and
+                self.manifest.up_to_date('summary', summary_inputs) is None):
+            with self.profiler.stage('summary_graphs'):
+                self.plot_throughput_delay(data_for_plot)
+
+            plt.close('all')
+
+            self.manifest.record('summary', summary_inputs, summary_outputs)
 
         perf_path = path.join(self.data_dir, 'pantheon_perf.json')
         with open(perf_path, 'w') as fh:
             json.dump(data_for_json, fh)
 
-def run(args):
-    plot = Plot(args)
+        if self.results_db:
+            results_db.record(self.results_db, results_db.add_results,
+                              self.data_dir, self.meta, perf_data)
+
+        self.manifest.save()
+
+def _parse_tunnel_log(plot, cc, run_id):
+    # daemonic pool workers (Python < 3.9) cannot start parse_jobs processes
+    if multiprocessing.current_process().daemon:
+        plot.parse_jobs = 1
+    ret = plot.parse_tunnel_log(cc, run_id)
+    records = plot.profiler.records() if plot.profiler.enabled else []
+    return ret, records
+
+
+def run(args, profiler=None):
+    plot = Plot(args, profiler)
     plot.run()
\ No newline at end of file
@@ -7,17 +7,28 @@ import time
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+import numpy as np
 matplotlib.use('Agg')
 
-from newpantheon.common import utils
+from newpantheon.analysis import (delay_sketch, figures, manifest,
+                                  parse_cache, profiling, tunnel_log)
+from newpantheon.common import log_format, tunnel_merge, utils
 
 
 class PlotThroughputTime(object):
-    def __init__(self, args):
+    def __init__(self, args, profiler=None):
         # plt.use('Agg')
         self.data_dir = path.abspath(args.data_dir)
+        self.profiler = profiler or profiling.DISABLED
         self.ms_per_bin = args.ms_per_bin
         self.amplify = args.amplify
+        self.max_exact_delays = args.max_exact_delays
+        self.delay_error = args.delay_error
+        self.parse_jobs = args.parse_jobs
+        self.cache_dir = (None if args.no_cache
+                          else parse_cache.cache_dir_for(self.data_dir))
+        self.figures = figures.FigureSaver.from_args(args, self.profiler)
+        self.manifest = manifest.for_args(args)
 
         metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
         meta = utils.load_test_metadata(metadata_path)
@@ -30,86 +41,77 @@ class PlotThroughputTime(object):
         self.run_times = meta['run_times']
         self.flows = meta['flows']
 
+    def tunnel_log_path(self, cc, run_id):
+        if self.flows > 0:
+            datalink_fmt_str = '%s_datalink_run%s.log'
+        else:
+            datalink_fmt_str = '%s_mm_datalink_run%s.log'
+        return log_format.find_log(path.join(
+            self.data_dir, datalink_fmt_str % (cc, run_id)))
+
+    def inputs(self, outputs):
+        if not self.manifest.enabled:
+            return None
+        return {
+            'logs': [manifest.fingerprint(self.tunnel_log_path(cc, run_id))
+                     for cc in self.cc_schemes
+                     for run_id in range(1, self.run_times + 1)],
+            'outputs': outputs,
+            'options': [self.cc_schemes, self.ms_per_bin, self.amplify,
+                        self.figures.dpi],
+            'code': manifest.code_version(sys.modules[__name__], figures,
+                                          tunnel_log, log_format, parse_cache,
+                                          delay_sketch, tunnel_merge)}
+
     def ms_to_bin(self, ts, flow_base_ts):
         return int((ts - flow_base_ts) / self.ms_per_bin)
 
     def parse_tunnel_log(self, tunnel_log_path):
-        tunlog = open(tunnel_log_path)
-
-        # read init timestamp
-        init_ts = None
-        while init_ts is None:
-            line = tunlog.readline()
-            if 'init timestamp' in line:
-                init_ts = float(line.split(':')[1])
-
-        flow_base_ts = {}  # timestamp when each flow sent the first byte
-        departures = {}  # number of bits leaving the tunnel within a bin
-
-        while True:
-            line = tunlog.readline()
-            if not line:
-                break
-            if '#' in line:
-                continue
-
-            items = line.split()
-            ts = float(items[0])
-            event_type = items[1]
-            num_bits = int(items[2]) * 8
-
-            if event_type == '+':
-                if len(items) == 4:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                if flow_id not in flow_base_ts:
-                    flow_base_ts[flow_id] = ts
-            elif event_type == '-':
-                if len(items) == 5:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                if flow_id not in departures:
-                    departures[flow_id] = {}
-                else:
-                    bin_id = self.ms_to_bin(ts, flow_base_ts[flow_id])
-                    old_value = departures[flow_id].get(bin_id, 0)
-                    departures[flow_id][bin_id] = old_value + num_bits
-
-        tunlog.close()
+        summary = parse_cache.load_summary(
+            tunnel_log_path, self.cache_dir,
+            max_exact_delays=self.max_exact_delays,
+            delay_error=self.delay_error,
+            jobs=self.parse_jobs)
 
         # prepare return values
         us_per_bin = 1000.0 * self.ms_per_bin
         clock_time = {}  # data for x-axis
         throughput = {}  # data for y-axis
-        for flow_id in departures:
-            start_ts = flow_base_ts[flow_id] + init_ts + self.ms_per_bin / 2.0
-            clock_time[flow_id] = []
-            throughput[flow_id] = []
+        for flow_id in summary.first_departure:
+            bins = summary.flow_timeline(flow_id, self.ms_per_bin)
+            if bins is None or bins.max_bin < 0:
+                continue
 
-            max_bin_id = max(departures[flow_id].keys())
-            for bin_id in range(0, max_bin_id + 1):
-                time_sec = (start_ts + bin_id * self.ms_per_bin) / 1000.0
-                clock_time[flow_id].append(time_sec)
+            start_ts = ((summary.flow_base_ts[flow_id] + summary.init_ts) /
+                        log_format.US_PER_MS + self.ms_per_bin / 2.0)
+            bin_ids = np.arange(bins.max_bin + 1)
+            clock_time[flow_id] = (
+                (start_ts + bin_ids * self.ms_per_bin) / 1000.0).tolist()
 
-                tput_mbps = departures[flow_id].get(bin_id, 0) / us_per_bin
-                throughput[flow_id].append(tput_mbps)
+            bits = np.zeros(bin_ids.size, dtype=np.int64)
+            seen = bins.bin_ids()
+            bits[seen[seen >= 0]] = bins.values()[seen >= 0]
+            throughput[flow_id] = (bits / us_per_bin).tolist()
 
         return clock_time, throughput
 
     def run(self):
+        if not self.figures.enabled():
+            return
+
+        fig_paths = self.figures.paths(
+            path.join(self.data_dir, 'pantheon_throughput_time'),
+            figures.FORMATS)
+        inputs = self.inputs(fig_paths)
+        if self.manifest.up_to_date('throughput_time', inputs) is not None:
+            sys.stderr.write(
+                'pantheon_throughput_time in %s is up to date\n' % self.data_dir)
+            return
+
         fig, ax = plt.subplots()
         total_min_time = None
         total_max_time = None
 
-        if self.flows > 0:
-            datalink_fmt_str = '%s_datalink_run%s.log'
-        else:
-            datalink_fmt_str = '%s_mm_datalink_run%s.log'
-
         schemes_config = utils.parse_config()['schemes']
         for cc in self.cc_schemes:
             if self.interactions:
@@ -118,9 +120,10 @@ class PlotThroughputTime(object):
                 cc_name = schemes_config[cc]['name']
 
             for run_id in range(1, self.run_times + 1):
-                tunnel_log_path = path.join(
-                    self.data_dir, datalink_fmt_str % (cc, run_id))
-                clock_time, throughput = self.parse_tunnel_log(tunnel_log_path)
+                tunnel_log_path = self.tunnel_log_path(cc, run_id)
+                with self.profiler.stage('parse', scheme=cc, run=run_id):
+                    clock_time, throughput = self.parse_tunnel_log(
+                        tunnel_log_path)
 
                 min_time = None
                 max_time = None
@@ -162,16 +165,19 @@ class PlotThroughputTime(object):
         ax.set_xlabel('Time (s) since ' + start_datetime, fontsize=12)
         ax.set_ylabel('Throughput (Mbit/s)', fontsize=12)
 
-        for graph_format in ['svg', 'pdf', 'png']:
-            fig_path = path.join(
-                self.data_dir, 'pantheon_throughput_time.%s' % graph_format)
-            fig.savefig(fig_path, bbox_inches='tight', pad_inches=0.2)
+        self.figures.save(
+            fig, path.join(self.data_dir, 'pantheon_throughput_time'),
+            figures.FORMATS, bbox_inches='tight', pad_inches=0.2)
+        self.figures.wait()
 
         sys.stderr.write(
             'Saved pantheon_throughput_time in %s\n' % self.data_dir)
 
         plt.close('all')
 
-def run(args):
-    plot = PlotThroughputTime(args)
+        self.manifest.record('throughput_time', inputs, fig_paths)
+        self.manifest.save()
+
+def run(args, profiler=None):
+    plot = PlotThroughputTime(args, profiler)
     plot.run()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""Opt-in per-stage profiling of the analysis (--profile).
+
+Stages are timed with Profiler.stage(), which records the wall-clock time,
+CPU time (of the calling thread plus any child processes reaped meanwhile),
+the peak RSS of the process so far and the bytes the calling thread read.
+Stages nest, and labels such as the scheme and run are inherited by nested
+stages. Without --profile, the analysis uses DISABLED, whose stages cost
+nothing.
+"""
+
+import contextlib
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from newpantheon.common import utils
+
+PROFILE_NAME = 'pantheon_profile.json'
+METRICS = ('wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb')
+
+
+def _thread_io():
+    """Bytes read by the calling thread so far, or None if unknown."""
+    try:
+        with open('/proc/thread-self/io') as io:
+            for line in io:
+                key, value = line.split(':')
+                if key == 'rchar':
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _maxrss_mb(who):
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler(object):
+    enabled = True
+
+    def __init__(self):
+        self.entries = []  # (order in which the stage began, record)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = utils.utc_time()
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        stack = self._stack()
+        if stack:
+            name = stack[-1][0] + '/' + name
+            labels = dict(stack[-1][1], **labels)
+        stack.append((name, labels))
+        with self.lock:
+            order = next(self.counter)
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        children_cpu = _children_cpu()
+        read = _thread_io()
+        try:
+            yield
+        finally:
+            stack.pop()
+            record = {'stage': name}
+            record.update(labels)
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = (time.thread_time() - cpu +
+                               _children_cpu() - children_cpu)
+            record['peak_rss_mb'] = max(
+                _maxrss_mb(resource.RUSAGE_SELF),
+                _maxrss_mb(resource.RUSAGE_CHILDREN))
+            read_after = _thread_io()
+            record['read_mb'] = (None if read is None or read_after is None
+                                 else (read_after - read) / 1e6)
+            with self.lock:
+                self.entries.append((order, record))
+
+    def add_records(self, records):
+        """Add the records of stages profiled by another Profiler, such as
+        one in a worker process, as stages nested in the current stage."""
+        stack = self._stack()
+        with self.lock:
+            for record in records:
+                if stack:
+                    name, labels = stack[-1]
+                    nested = {'stage': name + '/' + record['stage']}
+                    nested.update(labels)
+                    nested.update((key, value) for key, value in record.items()
+                                  if key != 'stage')
+                    record = nested
+                self.entries.append((next(self.counter), record))
+
+    def records(self):
+        """Return the records of all finished stages in the order the
+        stages began."""
+        with self.lock:
+            return [record for _, record in sorted(self.entries,
+                                                   key=lambda e: e[0])]
+
+    def totals(self):
+        """Sum the records of every stage over schemes and runs."""
+        totals = {}
+        for record in self.records():
+            total = totals.setdefault(record['stage'], {
+                'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0,
+                'read_mb': 0.0})
+            total['count'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'],
+                                       record['peak_rss_mb'])
+            total['read_mb'] += record['read_mb'] or 0.0
+        return totals
+
+    def summary_string(self):
+        rows = [('stage', 'scheme', 'run', 'wall (s)', 'cpu (s)',
+                 'peak RSS (MB)', 'read (MB)')]
+
+        for record in self.records():
+            stage = record['stage']
+            other_labels = ['%s=%s' % (key, value)
+                            for key, value in record.items()
+                            if key not in ('stage', 'scheme', 'run') + METRICS]
+            if other_labels:
+                stage += ' [%s]' % ', '.join(other_labels)
+
+            read_mb = record['read_mb']
+            rows.append((
+                stage,
+                str(record.get('scheme', '')),
+                str(record.get('run', '')),
+                '%.3f' % record['wall_s'],
+                '%.3f' % record['cpu_s'],
+                '%.1f' % record['peak_rss_mb'],
+                '' if read_mb is None else '%.1f' % read_mb))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        ret = ''
+        for row in rows:
+            cells = [row[0].ljust(widths[0])] + [
+                cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            ret += '  '.join(cells).rstrip() + '\n'
+        return ret
+
+    def save(self, profile_path):
+        with open(profile_path, 'w') as profile:
+            json.dump({'started': self.started,
+                       'pid': os.getpid(),
+                       'records': self.records(),
+                       'totals': self.totals()}, profile, indent=2)
+
+    def report(self, profile_path):
+        """Save the records to profile_path and print the summary."""
+        self.save(profile_path)
+        sys.stderr.write(self.summary_string())
+        sys.stderr.write('Saved profile in %s\n' % profile_path)
+
+
+class _DisabledProfiler(object):
+    enabled = False
+
+    def stage(self, name, **labels):
+        return contextlib.nullcontext()
+
+
+DISABLED = _DisabledProfiler()
@@ -1,14 +1,17 @@
-import re
+import sys
 import uuid
 import numpy as np
 from fpdf import FPDF
 from os import path
+from newpantheon.analysis import manifest, profiling, run_stats
 from newpantheon.common import utils
 
 
 class PDF(FPDF):
-    def __init__(self, args):
+    def __init__(self, args, profiler=None):
         super().__init__(orientation="P", unit="mm", format="A4")
+        self.profiler = profiler or profiling.DISABLED
+        self.manifest = manifest.for_args(args)
         self.set_auto_page_break(auto=True, margin=15)
         
         self.data_dir = path.abspath(args.data_dir)
@@ -152,12 +155,6 @@ class PDF(FPDF):
     def summary_table(self):
         data = {}
 
-        re_tput = lambda x: re.match(r'Average throughput: (.*?) Mbit/s', x)
-        re_flow = lambda x: re.match(r'-- Flow (\d+):', x)
-        re_delay = lambda x: re.match(
-            r'95th percentile per-packet one-way delay: (.*?) ms', x)
-        re_loss = lambda x: re.match(r'Loss rate: (.*?)%', x)
-
         for cc in self.cc_schemes:
             data[cc] = {}
             data[cc]['valid_runs'] = 0
@@ -177,52 +174,21 @@ class PDF(FPDF):
                 data[cc][flow_id]['loss'] = []
 
             for run_id in range(1, 1 + self.run_times):
-                fname = '%s_stats_run%s.log' % (cc, run_id)
-                stats_log_path = path.join(self.data_dir, fname)
-
-                if not path.isfile(stats_log_path):
+                result = run_stats.load(self.data_dir, cc, run_id)
+                if result is None:
                     continue
+                data[cc]['valid_runs'] += 1
 
-                stats_log = open(stats_log_path)
-
-                valid_run = False
-                flow_id = 1
-
-                while True:
-                    line = stats_log.readline()
-                    if not line:
-                        break
-
-                    if 'Datalink statistics' in line:
-                        valid_run = True
-                        continue
-                    match = re_flow(line)
-                    if match:
-                        flow_id = int(re.search(r'\d+', line).group())
-                        if flow_id > self.flows:
+                for flow_id in range(1, self.flows + 1):
+                    flow = result['flow_data'].get(str(flow_id), {})
+                    for data_t in ['tput', 'delay', 'loss']:
+                        value = flow.get(data_t)
+                        if value is None:
                             continue
-                        ret = re_tput(stats_log.readline())
-                        if ret:
-                            ret = float(ret.group(1))
-                            data[cc][flow_id]['tput'].append(ret)
-
-                        ret = re_delay(stats_log.readline())
-                        if ret:
-                            ret = float(ret.group(1))
-                            data[cc][flow_id]['delay'].append(ret)
-
-                        ret = re_loss(stats_log.readline())
-                        if ret:
-                            ret = float(ret.group(1))
-                            data[cc][flow_id]['loss'].append(ret)
-
-                        if flow_id <= self.flows:
-                            flow_id += 1
-
-                stats_log.close()
-
-                if valid_run:
-                    data[cc]['valid_runs'] += 1
+                        # loss is shown in percent, as in the stats logs
+                        if data_t == 'loss':
+                            value *= 100.0
+                        data[cc][flow_id][data_t].append(value)
 
         self.create_table(data)
 
@@ -232,22 +198,26 @@ class PDF(FPDF):
         raw_summary = path.join(self.data_dir, 'pantheon_summary.png')
         mean_summary = path.join(self.data_dir, 'pantheon_summary_mean.png')
 
-        self.describe_metadata()
-        self.include_runs()
-        self.summary_table()
-
-        if path.isfile(raw_summary):
-            self.image(raw_summary, x=30, y=self.get_y(), h=137)  # Adjust width with padding
-            self.ln(135)
-        else:
-            self.cell(0, 5, "Figure is missing", align="C")
-            self.ln(10)  # Add some space after the figure
+        with self.profiler.stage('metadata'):
+            self.describe_metadata()
+        with self.profiler.stage('runs'):
+            self.include_runs()
+        with self.profiler.stage('summary_table'):
+            self.summary_table()
+
+        with self.profiler.stage('summary_figures'):
+            if path.isfile(raw_summary):
+                self.image(raw_summary, x=30, y=self.get_y(), h=137)  # Adjust width with padding
+                self.ln(135)
+            else:
+                self.cell(0, 5, "Figure is missing", align="C")
+                self.ln(10)  # Add some space after the figure
 
-        if path.isfile(mean_summary):
-            self.image(mean_summary, x=30, y=self.get_y(), h=130)  # Adjust width with padding
-        else:
-            self.cell(0, 5, "Figure is missing", align="C")
-            self.ln(10)  # Add some space after the figure
+            if path.isfile(mean_summary):
+                self.image(mean_summary, x=30, y=self.get_y(), h=130)  # Adjust width with padding
+            else:
+                self.cell(0, 5, "Figure is missing", align="C")
+                self.ln(10)  # Add some space after the figure
 
     def include_runs(self):
         # self.add_page()
@@ -260,73 +230,113 @@ class PDF(FPDF):
                 cc_name = self.config['schemes'][cc]['name'].strip().replace('_', ' ')
 
             for run_id in range(1, 1 + self.run_times):
-                fname = f"{cc}_stats_run{run_id}.log"
-                stats_log_path = path.join(self.data_dir, fname)
+                with self.profiler.stage('run', scheme=cc, run=run_id):
+                    self.include_run(cc, cc_name, run_id)
 
-                if path.isfile(stats_log_path):
-                    with open(stats_log_path, "r") as stats_log:
-                        stats_info = stats_log.read()
+    def include_run(self, cc, cc_name, run_id):
+        fname = f"{cc}_stats_run{run_id}.log"
+        stats_log_path = path.join(self.data_dir, fname)
+
+        if path.isfile(stats_log_path):
+            with open(stats_log_path, "r") as stats_log:
+                stats_info = stats_log.read()
+        else:
+            stats_info = f"{stats_log_path} does not exist\n"
+
+        # Add a new page for each run
+        self.add_page()
+        # Write statistics information
+        self.set_font("Times", style="B", size=12)
+        self.ln(5)
+        self.cell(0, 5, f"Run {run_id}: Statistics of {cc_name}", ln=True)
+        self.set_font("Courier", size=10)
+        self.multi_cell(0, 5, stats_info)
+        # Add graphs for Data Link
+        self.add_page()
+        self.set_font("Times", style="B", size=12)
+        self.ln(5)
+        self.cell(0, 5, f"Run {run_id}: Report of {cc_name} --- Data Link", ln=True)
+
+        link_directions = ['datalink']
+        if self.include_acklink:
+            link_directions.append('acklink')
+
+        for link_t in link_directions:
+            for metric_t in ['throughput', 'delay']:
+                graph_path = path.join(
+                    self.data_dir, f"{cc}_{link_t}_{metric_t}_run{run_id}.png"
+                )
+                if path.isfile(graph_path):
+                    self.image(graph_path, x=10, y=self.get_y(), w=190)
+                    self.ln(120)  # Adjust the spacing based on the image size
                 else:
-                    stats_info = f"{stats_log_path} does not exist\n"
-
-                # Add a new page for each run
-                self.add_page()
-                # Write statistics information
-                self.set_font("Times", style="B", size=12)
-                self.ln(5)
-                self.cell(0, 5, f"Run {run_id}: Statistics of {cc_name}", ln=True)
-                self.set_font("Courier", size=10)
-                self.multi_cell(0, 5, stats_info)
-                # Add graphs for Data Link
-                self.add_page()
-                self.set_font("Times", style="B", size=12)
-                self.ln(5)
-                self.cell(0, 5, f"Run {run_id}: Report of {cc_name} --- Data Link", ln=True)
-
-                link_directions = ['datalink']
-                if self.include_acklink:
-                    link_directions.append('acklink')
-
-                for link_t in link_directions:
-                    for metric_t in ['throughput', 'delay']:
-                        graph_path = path.join(
-                            self.data_dir, f"{cc}_{link_t}_{metric_t}_run{run_id}.png"
-                        )
-                        if path.isfile(graph_path):
-                            self.image(graph_path, x=10, y=self.get_y(), w=190)
-                            self.ln(120)  # Adjust the spacing based on the image size
-                        else:
-                            self.set_font("Times", style="I", size=10)
-                            self.cell(0, 5, f"Missing: {graph_path}", ln=True)
-                            self.ln(5)
-
-                    # self.ln(5)
-
-                # Add graphs for ACK Link (if enabled)
-                if self.include_acklink:
-                    self.set_font("Times", style="B", size=12)
-                    self.cell(0, 5, f"Run {run_id}: Report of {cc_name} --- ACK Link", ln=True)
+                    self.set_font("Times", style="I", size=10)
+                    self.cell(0, 5, f"Missing: {graph_path}", ln=True)
                     self.ln(5)
 
-                    for metric_t in ['throughput', 'delay']:
-                        graph_path = path.join(
-                            self.data_dir, f"{cc}_acklink_{metric_t}_run{run_id}.png"
-                        )
+            # self.ln(5)
+
+        # Add graphs for ACK Link (if enabled)
+        if self.include_acklink:
+            self.set_font("Times", style="B", size=12)
+            self.cell(0, 5, f"Run {run_id}: Report of {cc_name} --- ACK Link", ln=True)
+            self.ln(5)
 
-                        if path.isfile(graph_path):
-                            self.image(graph_path, x=10, y=self.get_y(), w=190)
-                            self.ln(70)  # Adjust the spacing based on the image size
-                        else:
-                            self.set_font("Times", style="I", size=10)
-                            self.cell(0, 5, f"Missing: {graph_path}", ln=True)
-                            self.ln(5)
+            for metric_t in ['throughput', 'delay']:
+                graph_path = path.join(
+                    self.data_dir, f"{cc}_acklink_{metric_t}_run{run_id}.png"
+                )
+
+                if path.isfile(graph_path):
+                    self.image(graph_path, x=10, y=self.get_y(), w=190)
+                    self.ln(70)  # Adjust the spacing based on the image size
+                else:
+                    self.set_font("Times", style="I", size=10)
+                    self.cell(0, 5, f"Missing: {graph_path}", ln=True)
+                    self.ln(5)
+
+    def inputs(self):
+        """Fingerprints of the metadata, stats logs and figures that the
+        report is made from, and the options that shape it."""
+        if not self.manifest.enabled:
+            return None
+        link_directions = ['datalink']
+        if self.include_acklink:
+            link_directions.append('acklink')
+
+        files = ['pantheon_metadata.json', 'pantheon_summary.png',
+                 'pantheon_summary_mean.png']
+        for cc in self.cc_schemes:
+            for run_id in range(1, 1 + self.run_times):
+                files.append(f"{cc}_stats_run{run_id}.log")
+                files.append(path.basename(
+                    run_stats.stats_path(self.data_dir, cc, run_id)))
+                files += [f"{cc}_{link_t}_{metric_t}_run{run_id}.png"
+                          for link_t in link_directions
+                          for metric_t in ['throughput', 'delay']]
+        return {
+            'files': [manifest.fingerprint(path.join(self.data_dir, name))
+                      for name in files],
+            'options': [self.cc_schemes, self.include_acklink,
+                        self.interactions],
+            'code': manifest.code_version(sys.modules[__name__])}
 
     def run(self):
+        inputs = self.inputs()
+        artifact = self.manifest.up_to_date('report', inputs)
+        if artifact is not None:
+            print(f"{path.basename(artifact['result'])} in {self.data_dir} is up to date")
+            return
+
         pdf_path = path.join(self.data_dir, f"pantheon_report_{utils.utc_time()}.pdf")
         self.include_summary()
-        self.output(pdf_path)
+        with self.profiler.stage('output'):
+            self.output(pdf_path)
         
         print(f"Saved pantheon_report.pdf in {self.data_dir}")
 
-def run(args):
-    PDF(args)
\ No newline at end of file
+        self.manifest.record('report', inputs, [pdf_path], pdf_path)
+        self.manifest.save()
+
+def run(args, profiler=None):
+    PDF(args, profiler)
\ No newline at end of file
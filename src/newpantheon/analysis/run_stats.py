@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Structured statistics of every analyzed run.
+
+Next to the free-text stats log of a run, the analysis saves the results of
+TunnelGraph.run for it as <scheme>_stats_run<ID>.json: the throughput,
+delay, loss and duration of all flows, the same per flow under
+'flow_data' (keyed by flow id, and 'all'), and the statistics text that
+was appended to the stats log. The report and incremental analyses read
+this file instead of parsing the stats log. A run that could not be
+analyzed has no such file.
+"""
+
+import json
+import os
+from os import path
+
+STATS_VERSION = 1
+
+
+def stats_path(data_dir, cc, run_id):
+    return path.join(data_dir, f'{cc}_stats_run{run_id}.json')
+
+
+def save(data_dir, cc, run_id, result):
+    """Save the result of TunnelGraph.run for a run, or remove the saved
+    one if result is None."""
+    json_path = stats_path(data_dir, cc, run_id)
+    if result is None:
+        if path.exists(json_path):
+            os.remove(json_path)
+        return
+
+    saved = {'version': STATS_VERSION, 'scheme': cc, 'run': run_id}
+    saved.update(result)
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'w') as stats:
+        json.dump(saved, stats, indent=2)
+    os.replace(tmp_path, json_path)
+
+
+def load(data_dir, cc, run_id):
+    """Return the saved result of a run as TunnelGraph.run returned it
+    (with flow ids as strings), or None if there is none."""
+    try:
+        with open(stats_path(data_dir, cc, run_id)) as stats:
+            saved = json.load(stats)
+    except FileNotFoundError:
+        return None
+    if saved.pop('version', None) != STATS_VERSION:
+        return None
+    saved.pop('scheme')
+    saved.pop('run')
+    return saved
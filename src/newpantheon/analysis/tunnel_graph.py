@@ -2,22 +2,97 @@
 
 import sys
 import math
+from os import path
 import itertools
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
 matplotlib.use('Agg')
 
+from newpantheon.analysis import figures, parse_cache, profiling, tunnel_log
+from newpantheon.common.log_format import US_PER_MS
+from newpantheon.common import tunnel_merge
+
+DELAY_GRAPH_MODES = ['scatter', 'density', 'decimate']
+DENSITY_BINS = (1200, 600)  # time and delay bins of a density image
+DECIMATE_COLUMNS = 2000  # time columns, each keeping its min and max delay
+
+
+class DelayDensity(object):
+    """Per-packet delays of all flows drawn as one RGBA image of
+    DENSITY_BINS cells. Each flow is painted over the previous ones in its
+    own color, more opaque where more of its packets fall in a cell."""
+
+    def __init__(self, t_range, delay_range):
+        if t_range[1] <= t_range[0]:
+            t_range = (t_range[0], t_range[0] + 1)
+        if delay_range[1] <= delay_range[0]:
+            delay_range = (delay_range[0] - 0.5, delay_range[1] + 0.5)
+
+        self.t_range = t_range
+        self.delay_range = delay_range
+        self.image = np.zeros((DENSITY_BINS[1], DENSITY_BINS[0], 4))
+
+    def add(self, delays_t, delays, color):
+        width, height = DENSITY_BINS
+        cols = self.cell(delays_t, self.t_range, width)
+        rows = self.cell(delays, self.delay_range, height)
+        counts = np.bincount(rows * width + cols,
+                             minlength=width * height).reshape(height, width)
+
+        # opacity from 0.25 (one packet) to 1 (busiest cell), log scaled
+        alpha = np.zeros(counts.shape)
+        filled = counts > 0
+        alpha[filled] = 0.25 + 0.75 * (
+            np.log(counts[filled]) / max(np.log(counts.max()), 1.0))
+
+        # "over" compositing of this flow onto the flows drawn before
+        alpha = alpha[..., np.newaxis]
+        below = self.image[..., 3:] * (1 - alpha)
+        out = alpha + below
+        rgb = np.array(to_rgb(color))
+        self.image[..., :3] = np.where(
+            out > 0, (rgb * alpha + self.image[..., :3] * below) /
+            np.where(out > 0, out, 1), 0)
+        self.image[..., 3:] = out
+
+    def cell(self, values, value_range, cells):
+        lo, hi = value_range
+        index = ((values - lo) * (cells / (hi - lo))).astype(np.int64)
+        return np.clip(index, 0, cells - 1)
+
+    def draw(self, ax):
+        ax.imshow(self.image, extent=self.t_range + self.delay_range,
+                  origin='lower', aspect='auto', interpolation='nearest')
 
 
 class TunnelGraph(object):
     def __init__(self, tunnel_log, throughput_graph=None, delay_graph=None,
-                 ms_per_bin=500):
+                 ms_per_bin=500, max_exact_delays=None, delay_error=0.01,
+                 cache_dir=None, delay_graph_mode='scatter', parse_jobs=1,
+                 profiler=None, events=None, formats=None, dpi=None,
+                 save_jobs=1):
         # plt.use('Agg')
         self.tunnel_log = tunnel_log
+        # merged events to analyze instead of reading tunnel_log, such as
+        # a tunnel_merge.FusedMerge
+        self.events = events
         self.throughput_graph = throughput_graph
         self.delay_graph = delay_graph
         self.ms_per_bin = ms_per_bin
+        self.max_exact_delays = max_exact_delays
+        self.delay_error = delay_error
+        self.cache_dir = cache_dir
+        self.parse_jobs = parse_jobs
+        if delay_graph_mode not in DELAY_GRAPH_MODES:
+            raise ValueError('unknown delay graph mode %s' % delay_graph_mode)
+        self.delay_graph_mode = delay_graph_mode
+        self.profiler = profiler or profiling.DISABLED
+        # graphs are saved in formats (default: as named) at dpi (default
+        # 300)
+        self.figures = figures.FigureSaver(formats, dpi, save_jobs,
+                                           self.profiler)
 
     def ms_to_bin(self, ts, first_ts):
         return int((ts - first_ts) / self.ms_per_bin)
@@ -26,136 +101,52 @@ class TunnelGraph(object):
         return bin_id * self.ms_per_bin / 1000.0
 
     def parse_tunnel_log(self):
-        tunlog = open(self.tunnel_log)
-
-        self.flows = {}
-        first_ts = None
-        capacities = {}
-
-        arrivals = {}
-        departures = {}
-        self.delays_t = {}
-        self.delays = {}
-
-        first_capacity = None
-        last_capacity = None
-        first_arrival = {}
-        last_arrival = {}
-        first_departure = {}
-        last_departure = {}
-
-        total_first_departure = None
-        total_last_departure = None
-        total_arrivals = 0
-        total_departures = 0
-
-        while True:
-            line = tunlog.readline()
-            if not line:
-                break
-
-            if line.startswith('#'):
-                continue
-
-            items = line.split()
-            ts = float(items[0])
-            event_type = items[1]
-            num_bits = int(items[2]) * 8
-
-            if first_ts is None:
-                first_ts = ts
-
-            bin_id = self.ms_to_bin(ts, first_ts)
-
-            if event_type == '#':
-                capacities[bin_id] = capacities.get(bin_id, 0) + num_bits
-
-                if first_capacity is None:
-                    first_capacity = ts
-
-                if last_capacity is None or ts > last_capacity:
-                    last_capacity = ts
-            elif event_type == '+':
-                if len(items) == 4:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                self.flows[flow_id] = True
-
-                if flow_id not in arrivals:
-                    arrivals[flow_id] = {}
-                    first_arrival[flow_id] = ts
-
-                if flow_id not in last_arrival:
-                    last_arrival[flow_id] = ts
-                else:
-                    if ts > last_arrival[flow_id]:
-                        last_arrival[flow_id] = ts
-
-                old_value = arrivals[flow_id].get(bin_id, 0)
-                arrivals[flow_id][bin_id] = old_value + num_bits
-
-                total_arrivals += num_bits
-            elif event_type == '-':
-                if len(items) == 5:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                self.flows[flow_id] = True
-
-                if flow_id not in departures:
-                    departures[flow_id] = {}
-                    first_departure[flow_id] = ts
-
-                if flow_id not in last_departure:
-                    last_departure[flow_id] = ts
-                else:
-                    if ts > last_departure[flow_id]:
-                        last_departure[flow_id] = ts
-
-                old_value = departures[flow_id].get(bin_id, 0)
-                departures[flow_id][bin_id] = old_value + num_bits
-
-                total_departures += num_bits
+        with self.profiler.stage('parse'):
+            if self.events is not None:
+                summary = tunnel_log.summarize_chunks(
+                    self.events, max_exact_delays=self.max_exact_delays,
+                    delay_error=self.delay_error)
+                summary.init_ts = self.events.init_ts
+            else:
+                summary = parse_cache.load_summary(
+                    self.tunnel_log, self.cache_dir,
+                    max_exact_delays=self.max_exact_delays,
+                    delay_error=self.delay_error,
+                    jobs=self.parse_jobs)
 
-                # update total variables
-                if total_first_departure is None:
-                    total_first_departure = ts
-                if (total_last_departure is None or
-                        ts > total_last_departure):
-                    total_last_departure = ts
+        with self.profiler.stage('statistics'):
+            self.calculate_statistics(summary)
 
-                # store delays in a list for each flow and sort later
-                delay = float(items[3])
-                if flow_id not in self.delays:
-                    self.delays[flow_id] = []
-                    self.delays_t[flow_id] = []
-                self.delays[flow_id].append(delay)
-                self.delays_t[flow_id].append((ts - first_ts) / 1000.0)
+    def calculate_statistics(self, summary):
+        self.summary = summary
 
-        tunlog.close()
+        self.flows = summary.flows
+        self.delays = {}
+        self.delays_t = {}
+        for flow_id in summary.delays:
+            self.delays[flow_id] = summary.flow_delays(flow_id)
+            self.delays_t[flow_id] = summary.flow_delays_t(flow_id)
 
         us_per_bin = 1000.0 * self.ms_per_bin
 
         self.avg_capacity = None
         self.link_capacity = []
         self.link_capacity_t = []
-        if capacities:
+        capacity = summary.capacity
+        if capacity.first_ts is not None:
             # calculate average capacity
-            if last_capacity == first_capacity:
+            if capacity.last_ts == capacity.first_ts:
                 self.avg_capacity = 0
             else:
-                delta = 1000.0 * (last_capacity - first_capacity)
-                self.avg_capacity = sum(capacities.values()) / delta
+                delta = capacity.last_ts - capacity.first_ts
+                self.avg_capacity = capacity.bins.total / delta
 
             # transform capacities into a list
-            capacity_bins = capacities.keys()
-            for bin_id in range(min(capacity_bins), max(capacity_bins) + 1):
-                self.link_capacity.append(
-                    capacities.get(bin_id, 0) / us_per_bin)
-                self.link_capacity_t.append(self.bin_to_s(bin_id))
+            capacity_bins = capacity.bins.at(self.ms_per_bin)
+            self.link_capacity = (
+                capacity_bins.values() / us_per_bin).tolist()
+            self.link_capacity_t = self.bin_to_s(
+                capacity_bins.bin_ids()).tolist()
 
         # calculate ingress and egress throughput for each flow
         self.ingress_tput = {}
@@ -167,7 +158,8 @@ class TunnelGraph(object):
         self.percentile_delay = {}
         self.loss_rate = {}
 
-        total_delays = []
+        total_arrivals = 0
+        total_departures = 0
 
         for flow_id in self.flows:
             self.ingress_tput[flow_id] = []
@@ -177,80 +169,74 @@ class TunnelGraph(object):
             self.avg_ingress[flow_id] = 0
             self.avg_egress[flow_id] = 0
 
-            if flow_id in arrivals:
+            arrivals = summary.arrivals.get(flow_id)
+            departures = summary.departures.get(flow_id)
+
+            if arrivals is not None:
                 # calculate average ingress and egress throughput
-                first_arrival_ts = first_arrival[flow_id]
-                last_arrival_ts = last_arrival[flow_id]
+                total_arrivals += arrivals.bins.total
 
-                if last_arrival_ts == first_arrival_ts:
+                if arrivals.last_ts == arrivals.first_ts:
                     self.avg_ingress[flow_id] = 0
                 else:
-                    delta = 1000.0 * (last_arrival_ts - first_arrival_ts)
-                    flow_arrivals = sum(arrivals[flow_id].values())
-                    self.avg_ingress[flow_id] = flow_arrivals / delta
+                    delta = arrivals.last_ts - arrivals.first_ts
+                    self.avg_ingress[flow_id] = arrivals.bins.total / delta
 
-                ingress_bins = arrivals[flow_id].keys()
-                for bin_id in range(min(ingress_bins), max(ingress_bins) + 1):
-                    self.ingress_tput[flow_id].append(
-                        arrivals[flow_id].get(bin_id, 0) / us_per_bin)
-                    self.ingress_t[flow_id].append(self.bin_to_s(bin_id))
+                arrival_bins = arrivals.bins.at(self.ms_per_bin)
+                self.ingress_tput[flow_id] = (
+                    arrival_bins.values() / us_per_bin).tolist()
+                self.ingress_t[flow_id] = self.bin_to_s(
+                    arrival_bins.bin_ids()).tolist()
 
-            if flow_id in departures:
-                first_departure_ts = first_departure[flow_id]
-                last_departure_ts = last_departure[flow_id]
+            if departures is not None:
+                total_departures += departures.bins.total
 
-                if last_departure_ts == first_departure_ts:
+                if departures.last_ts == departures.first_ts:
                     self.avg_egress[flow_id] = 0
                 else:
-                    delta = 1000.0 * (last_departure_ts - first_departure_ts)
-                    flow_departures = sum(departures[flow_id].values())
-                    self.avg_egress[flow_id] = flow_departures / delta
+                    delta = departures.last_ts - departures.first_ts
+                    self.avg_egress[flow_id] = departures.bins.total / delta
 
-                egress_bins = departures[flow_id].keys()
+                departure_bins = departures.bins.at(self.ms_per_bin)
+                egress_bins = departure_bins.bin_ids()
 
-                self.egress_tput[flow_id].append(0.0)
-                self.egress_t[flow_id].append(self.bin_to_s(min(egress_bins)))
-
-                for bin_id in range(min(egress_bins), max(egress_bins) + 1):
-                    self.egress_tput[flow_id].append(
-                        departures[flow_id].get(bin_id, 0) / us_per_bin)
-                    self.egress_t[flow_id].append(self.bin_to_s(bin_id + 1))
+                self.egress_tput[flow_id] = [0.0] + (
+                    departure_bins.values() / us_per_bin).tolist()
+                self.egress_t[flow_id] = [self.bin_to_s(departure_bins.min_bin)] + (
+                    self.bin_to_s(egress_bins + 1)).tolist()
 
             # calculate 95th percentile per-packet one-way delay
-            self.percentile_delay[flow_id] = None
-            if flow_id in self.delays:
-                self.percentile_delay[flow_id] = np.percentile(
-                    self.delays[flow_id], 95, interpolation='nearest')
-                total_delays += self.delays[flow_id]
+            self.percentile_delay[flow_id] = summary.delay_percentile(
+                95, flow_id)
 
             # calculate loss rate for each flow
-            if flow_id in arrivals and flow_id in departures:
-                flow_arrivals = sum(arrivals[flow_id].values())
-                flow_departures = sum(departures[flow_id].values())
-
+            if arrivals is not None and departures is not None:
                 self.loss_rate[flow_id] = None
-                if flow_arrivals > 0:
+                if arrivals.bins.total > 0:
                     self.loss_rate[flow_id] = (
-                        1 - 1.0 * flow_departures / flow_arrivals)
+                        1 - 1.0 * departures.bins.total / arrivals.bins.total)
 
         self.total_loss_rate = None
         if total_arrivals > 0:
             self.total_loss_rate = 1 - 1.0 * total_departures / total_arrivals
 
         # calculate total average throughput and 95th percentile delay
+        total_first_departure = summary.all_departures.first_ts
+        total_last_departure = summary.all_departures.last_ts
+
         self.total_avg_egress = None
         if total_last_departure == total_first_departure:
             self.total_duration = 0
             self.total_avg_egress = 0
         else:
-            self.total_duration = total_last_departure - total_first_departure
-            self.total_avg_egress = total_departures / (
-                1000.0 * self.total_duration)
+            delta = total_last_departure - total_first_departure
+            self.total_duration = delta / US_PER_MS
+            self.total_avg_egress = total_departures / delta
 
-        self.total_percentile_delay = None
-        if total_delays:
-            self.total_percentile_delay = np.percentile(
-                total_delays, 95, interpolation='nearest')
+        self.total_percentile_delay = summary.delay_percentile(95)
+
+    def delay_percentile(self, q, flow_id=None):
+        return self.summary.delay_percentile(q, flow_id)
 
     def flip(self, items, ncol):
         return list(itertools.chain(*[items[i::ncol] for i in range(ncol)]))
@@ -326,11 +312,12 @@ class TunnelGraph(object):
 
         # Improve figure size and save with tight layout
         fig.set_size_inches(12, 6)
-        fig.savefig(
-            self.throughput_graph, 
-            bbox_extra_artists=(legend,), 
-            bbox_inches='tight', 
-            pad_inches=0.2, 
+        self.figures.save(
+            fig,
+            self.throughput_graph,
+            bbox_extra_artists=(legend,),
+            bbox_inches='tight',
+            pad_inches=0.2,
             dpi=300  # Improved resolution
         )
         plt.close(fig)
@@ -344,23 +331,51 @@ class TunnelGraph(object):
         colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
         color_i = 0
 
+        flow_ids = [flow_id for flow_id in self.flows
+                    if flow_id in self.delays and flow_id in self.delays_t and
+                    self.delays[flow_id].size]
+        if flow_ids:
+            max_delay = max(np.max(self.delays_t[f]) for f in flow_ids)
+        density = None
+        if flow_ids and self.delay_graph_mode == 'density':
+            density = DelayDensity(
+                (0, int(math.ceil(max_delay))),
+                (min(np.min(self.delays[f]) for f in flow_ids),
+                 max(np.max(self.delays[f]) for f in flow_ids)))
+
         # Plot data for each flow
-        for flow_id in self.flows:
+        for flow_id in flow_ids:
             color = colors[color_i % len(colors)]
-            if flow_id in self.delays and flow_id in self.delays_t:
-                empty_graph = False
-                max_delay = max(max_delay, max(self.delays_t[flow_id]))
+            empty_graph = False
+            delays_t = self.delays_t[flow_id]
+            delays = self.delays[flow_id]
+            # percentiles come from all packets, whatever is drawn
+            label = f'Flow {flow_id} (95th percentile {self.percentile_delay.get(flow_id, 0):.2f} ms)'
+
+            if density is not None:
+                density.add(delays_t, delays, color)
+                # empty scatter as the legend entry of the image
+                ax.scatter([], [], s=1, color=color, marker='.', label=label)
+            else:
+                rasterized = False
+                if self.delay_graph_mode == 'decimate':
+                    delays_t, delays = self.decimate_delays(delays_t, delays)
+                    rasterized = True
 
                 # Use scatter plot for delays
                 ax.scatter(
-                    self.delays_t[flow_id],
-                    self.delays[flow_id],
+                    delays_t,
+                    delays,
                     s=1,
                     color=color,
                     marker='.',
-                    label=f'Flow {flow_id} (95th percentile {self.percentile_delay.get(flow_id, 0):.2f} ms)'
+                    label=label,
+                    rasterized=rasterized
                 )
-                color_i += 1
+            color_i += 1
+
+        if density is not None:
+            density.draw(ax)
 
         # Handle empty graph scenario
         if empty_graph:
@@ -391,7 +406,8 @@ class TunnelGraph(object):
 
         # Configure figure size and save it
         fig.set_size_inches(12, 6)
-        fig.savefig(
+        self.figures.save(
+            fig,
             self.delay_graph,
             bbox_extra_artists=(legend,),
             bbox_inches='tight',
@@ -402,6 +418,27 @@ class TunnelGraph(object):
         # Close the figure to free up memory
         plt.close(fig)
 
+    def decimate_delays(self, delays_t, delays):
+        """Keep the packets with the minimum and maximum delay in each of
+        DECIMATE_COLUMNS time columns."""
+        if delays.size <= 2 * DECIMATE_COLUMNS:
+            return delays_t, delays
+
+        t_min = delays_t.min()
+        width = (delays_t.max() - t_min) / DECIMATE_COLUMNS or 1.0
+        columns = np.minimum(((delays_t - t_min) / width).astype(np.int64),
+                             DECIMATE_COLUMNS - 1)
+
+        # sort by column, then delay: columns start at their minimum delay
+        # and end at their maximum
+        order = np.lexsort((delays, columns))
+        sorted_columns = columns[order]
+        edges = np.flatnonzero(np.diff(sorted_columns)) + 1
+        keep = np.unique(np.concatenate([
+            [0], edges, edges - 1, [order.size - 1]]))
+        keep = order[keep]
+        return delays_t[keep], delays[keep]
+
     def statistics_string(self):
         flows_str = 'flow' if len(self.flows) == 1 else 'flows'
         ret = f"-- Total of {len(self.flows)} {flows_str}:\n"
@@ -442,11 +479,15 @@ class TunnelGraph(object):
     def run(self):
         self.parse_tunnel_log()
 
-        if self.throughput_graph:
-            self.plot_throughput_graph()
+        if self.throughput_graph and self.figures.enabled():
+            with self.profiler.stage('throughput_graph'):
+                self.plot_throughput_graph()
+
+        if self.delay_graph and self.figures.enabled():
+            with self.profiler.stage('delay_graph'):
+                self.plot_delay_graph()
 
-        if self.delay_graph:
-            self.plot_delay_graph()
+        self.figures.wait()
 
         tunnel_results = {}
         tunnel_results['throughput'] = self.total_avg_egress
@@ -473,8 +514,35 @@ class TunnelGraph(object):
         return tunnel_results
 
 def run(args):
+    events = None
+    if args.flow:
+        # merge the raw logs while analyzing them; the merged log is only
+        # written if tunnel-log is given
+        events = tunnel_merge.FusedMerge(
+            [{'ingress_log': ingress_log, 'egress_log': egress_log}
+             for ingress_log, egress_log in args.flow],
+            link_log=args.link_log, output_log=args.tunnel_log)
+    elif not args.tunnel_log:
+        sys.exit('Error: give a tunnel log or the raw logs of its flows')
+
+    profiler = profiling.Profiler() if args.profile else None
     tg = TunnelGraph(tunnel_log=args.tunnel_log,
         throughput_graph=args.throughput_graph,
         delay_graph=args.delay_graph,
-        ms_per_bin=args.ms_per_bin)
-    tg.run()
\ No newline at end of file
+        ms_per_bin=args.ms_per_bin,
+        max_exact_delays=args.max_exact_delays,
+        delay_error=args.delay_error,
+        delay_graph_mode=args.delay_graph_mode,
+        parse_jobs=args.parse_jobs,
+        profiler=profiler,
+        events=events,
+        formats=figures.selected_formats(args),
+        dpi=args.dpi,
+        save_jobs=args.save_jobs)
+    with tg.profiler.stage('tunnel_graph'):
+        tunnel_results = tg.run()
+    sys.stderr.write(tunnel_results['stats'])
+
+    if profiler is not None:
+        log_path = args.tunnel_log or args.flow[0][0]
+        profiler.report(path.splitext(log_path)[0] + '_profile.json')
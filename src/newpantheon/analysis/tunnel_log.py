@@ -0,0 +1,676 @@
+#!/usr/bin/env python
+
+"""Per-flow statistics of merged tunnel logs, accumulated chunk by chunk.
+
+Logs are read through newpantheon.common.log_format, which accepts both the
+text format written by ``merge_tunnel_logs.py`` and its binary columnar
+equivalent. Timestamps are kept in integer microseconds, as log_format
+gives them; only the delays are kept in milliseconds, as reported.
+"""
+
+import functools
+import multiprocessing
+import os
+
+import numpy as np
+
+from newpantheon.analysis.delay_sketch import DelaySketch
+from newpantheon.common.log_format import (
+    ARRIVAL, CAPACITY, CHUNK_BYTES, DEPARTURE, US_PER_MS, LogIndex,
+    compression, iter_chunks, read_first_timestamp, read_init_timestamp,
+    shard_ranges)
+
+SUMMARY_VERSION = 5  # bump when the saved layout of a summary changes
+
+
+class BinCounter(object):
+    """Bit totals per bin id over a contiguous range that grows on demand."""
+
+    def __init__(self):
+        self.base = 0  # bin id of counts[0]
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.min_bin = None  # smallest and largest bin ids seen
+        self.max_bin = None
+        self.total = 0
+
+    def add(self, bins, bits):
+        lo = int(bins.min())
+        hi = int(bins.max())
+
+        if self.min_bin is None:
+            self.base = lo
+            self.min_bin = lo
+            self.max_bin = hi
+        else:
+            self.min_bin = min(self.min_bin, lo)
+            self.max_bin = max(self.max_bin, hi)
+
+        if lo < self.base or hi >= self.base + self.counts.size:
+            new_base = min(lo, self.base)
+            new_size = max(hi + 1, self.base + self.counts.size) - new_base
+            counts = np.zeros(max(new_size, 2 * self.counts.size),
+                              dtype=np.int64)
+            offset = self.base - new_base
+            counts[offset:offset + self.counts.size] = self.counts
+            self.base = new_base
+            self.counts = counts
+
+        # weights are summed as float64, which is exact for integer totals
+        # well below 2^53 bits per bin
+        self.counts[:hi - self.base + 1] += np.bincount(
+            bins - self.base, weights=bits,
+            minlength=hi - self.base + 1).astype(np.int64)
+        self.total += int(bits.sum())
+
+    def bin_ids(self):
+        return np.arange(self.min_bin, self.max_bin + 1)
+
+    def values(self):
+        return self.counts[self.min_bin - self.base:
+                           self.max_bin - self.base + 1]
+
+    def merge(self, other):
+        if other.min_bin is not None:
+            self.add(other.bin_ids(), other.values())
+
+    def shifted(self, offset):
+        """Return a copy whose bin ids are offset by offset."""
+        counter = BinCounter()
+        if self.min_bin is not None:
+            counter.base = self.base + offset
+            counter.min_bin = self.min_bin + offset
+            counter.max_bin = self.max_bin + offset
+            counter.counts = self.counts.copy()
+            counter.total = self.total
+        return counter
+
+    def coarsen(self, factor):
+        """Return a counter whose bins each span factor of these bins."""
+        counter = BinCounter()
+        if self.min_bin is None:
+            return counter
+
+        # group bin ids the way int() truncates (x / factor)
+        ids = self.bin_ids()
+        coarse = np.abs(ids) // factor * np.sign(ids)
+        starts = np.flatnonzero(np.diff(coarse, prepend=coarse[0] - 1))
+
+        counter.base = counter.min_bin = int(coarse[0])
+        counter.max_bin = int(coarse[-1])
+        counter.counts = np.add.reduceat(self.values(), starts)
+        counter.total = self.total
+        return counter
+
+    def state(self):
+        if self.min_bin is None:
+            return {'bounds': np.zeros(0, dtype=np.int64),
+                    'counts': self.counts[:0]}
+        return {'bounds': np.array([self.min_bin, self.max_bin, self.total]),
+                'counts': self.values()}
+
+    @classmethod
+    def from_state(cls, state):
+        counter = cls()
+        if state['bounds'].size:
+            counter.min_bin, counter.max_bin, counter.total = (
+                state['bounds'].tolist())
+            counter.base = counter.min_bin
+            counter.counts = np.array(state['counts'])
+        return counter
+
+
+class BinPyramid(object):
+    """Bits binned per millisecond since some base timestamp.
+
+    Coarser bin widths are derived by summing groups of finer bins, starting
+    from the widest level already built that evenly divides the requested
+    width, so any whole number of milliseconds per bin is available without
+    going back to the log.
+    """
+
+    LEVELS = (10, 100, 1000)  # built ahead of saving, in ms per bin
+
+    def __init__(self):
+        self.levels = {1: BinCounter()}
+
+    @property
+    def total(self):
+        return self.levels[1].total
+
+    def add(self, bins, bits):
+        # derived levels are stale once more bits arrive
+        self.levels = {1: self.levels[1]}
+        self.levels[1].add(bins, bits)
+
+    def merge(self, other):
+        self.levels = {1: self.levels[1]}
+        self.levels[1].merge(other.levels[1])
+
+    def at(self, ms_per_bin):
+        """Return the BinCounter with ms_per_bin milliseconds per bin."""
+        if ms_per_bin < 1 or ms_per_bin != int(ms_per_bin):
+            raise ValueError('bin size must be a whole number of ms, not %s'
+                             % ms_per_bin)
+
+        ms_per_bin = int(ms_per_bin)
+        if ms_per_bin not in self.levels:
+            width = max(w for w in self.levels if ms_per_bin % w == 0)
+            self.levels[ms_per_bin] = self.levels[width].coarsen(
+                ms_per_bin // width)
+        return self.levels[ms_per_bin]
+
+    def build(self):
+        for ms_per_bin in self.LEVELS:
+            self.at(ms_per_bin)
+
+    def state(self):
+        state = {}
+        for ms_per_bin, counter in self.levels.items():
+            state.update(_prefixed(str(ms_per_bin), counter.state()))
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        pyramid = cls()
+        for ms_per_bin in set(key.split('.')[0] for key in state):
+            pyramid.levels[int(ms_per_bin)] = BinCounter.from_state(
+                _unprefixed(ms_per_bin, state))
+        return pyramid
+
+
+class EventTotals(object):
+    """Binned bits and first/last timestamps of one kind of event."""
+
+    def __init__(self):
+        self.bins = BinPyramid()
+        self.first_ts = None  # timestamp of the first event in the log
+        self.last_ts = None  # latest timestamp
+
+    def add(self, ts, bins, bits):
+        if self.first_ts is None:
+            self.first_ts = int(ts[0])
+        last_ts = int(ts.max())
+        if self.last_ts is None or last_ts > self.last_ts:
+            self.last_ts = last_ts
+        self.bins.add(bins, bits)
+
+    def merge(self, other):
+        if self.first_ts is None:
+            self.first_ts = other.first_ts
+        if other.last_ts is not None and (
+                self.last_ts is None or other.last_ts > self.last_ts):
+            self.last_ts = other.last_ts
+        self.bins.merge(other.bins)
+
+    def state(self):
+        state = _prefixed('bins', self.bins.state())
+        state['ts'] = np.array([_nan_if_none(self.first_ts),
+                                _nan_if_none(self.last_ts)])
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        totals = cls()
+        totals.bins = BinPyramid.from_state(_unprefixed('bins', state))
+        totals.first_ts, totals.last_ts = [
+            _int_or_none(ts) for ts in state['ts'].tolist()]
+        return totals
+
+
+class TunnelLogSummary(object):
+    """Accumulates the per-flow statistics of a tunnel log chunk by chunk.
+
+    Per-packet delays are kept exactly until more than max_exact_delays of
+    them have been seen (None means no limit). Beyond that, percentiles come
+    from per-flow DelaySketches and only an evenly thinned subset of the
+    packets is kept for the delay graph.
+
+    Bits are binned per millisecond (see BinPyramid), so the summary does
+    not depend on the bin size of the graphs made from it. The departures
+    of every flow are also binned per millisecond since the flow's first
+    arrival (timelines), from which plot_over_time bins them exactly.
+
+    Summaries of consecutive parts of a log combine with merge(), which
+    lets a large log be parsed in parallel shards (see summarize()).
+    """
+
+    def __init__(self, max_exact_delays=None, delay_error=0.01):
+        self.max_exact_delays = max_exact_delays
+        self.delay_error = delay_error
+        self.init_ts = None  # from the log header
+        self.first_ts = None
+
+        self.flows = {}  # flow ids in order of first appearance
+        self.capacity = EventTotals()
+        self.arrivals = {}
+        self.departures = {}
+        self.all_departures = EventTotals()
+
+        # per-packet one-way delays and their times (s) since first_ts
+        self.delays = {}
+        self.delays_t = {}
+        self.delays_seen = {}
+        self.delays_kept = 0
+        self.delay_stride = 1  # keep every delay_stride-th packet per flow
+        self.sketches = None  # per-flow DelaySketches once over the limit
+
+        self.flow_base_ts = {}  # timestamp of the first arrival of each flow
+        # (timestamp, bits, whether it is in the timeline) per flow
+        self.first_departure = {}
+        self.timelines = {}  # 1 ms departure bins since the first arrival
+        # flow id -> timestamp of its first arrival earlier in the log, for
+        # a summary of a shard that starts after it (see summarize())
+        self.find_flow_base = None
+
+    def update(self, chunk):
+        if not chunk.ts.size:
+            return
+
+        if self.first_ts is None:
+            self.first_ts = int(chunk.ts[0])
+
+        # 1 ms bins; BinPyramid derives the bin size asked for later
+        bins = _whole_ms(chunk.ts - self.first_ts)
+        bits = chunk.size * 8
+
+        mask = chunk.event == CAPACITY
+        if mask.any():
+            self.capacity.add(chunk.ts[mask], bins[mask], bits[mask])
+
+        flow_ids = chunk.flow[~mask]
+        uniq, first_idx = np.unique(flow_ids, return_index=True)
+        for flow_id in uniq[np.argsort(first_idx)].tolist():
+            self.flows[flow_id] = True
+
+        for event_type, totals in [(ARRIVAL, self.arrivals),
+                                   (DEPARTURE, self.departures)]:
+            mask = chunk.event == event_type
+            if not mask.any():
+                continue
+
+            if event_type == DEPARTURE:
+                self.all_departures.add(chunk.ts[mask], bins[mask], bits[mask])
+
+            idx = np.flatnonzero(mask)
+            flow_ids = chunk.flow[idx]
+            uniq, first_idx = np.unique(flow_ids, return_index=True)
+            for flow_id in uniq[np.argsort(first_idx)].tolist():
+                sel = idx[flow_ids == flow_id]
+                if flow_id not in totals:
+                    totals[flow_id] = EventTotals()
+                totals[flow_id].add(chunk.ts[sel], bins[sel], bits[sel])
+
+                if event_type == ARRIVAL:
+                    if self.base_ts(flow_id) is None:
+                        self.flow_base_ts[flow_id] = int(chunk.ts[sel[0]])
+                else:
+                    base_ts = self.base_ts(flow_id)
+                    if base_ts is not None:
+                        if flow_id not in self.timelines:
+                            self.timelines[flow_id] = BinCounter()
+                        self.timelines[flow_id].add(
+                            _whole_ms(chunk.ts[sel] - base_ts), bits[sel])
+                    if flow_id not in self.first_departure:
+                        self.first_departure[flow_id] = (
+                            int(chunk.ts[sel[0]]), int(bits[sel[0]]),
+                            base_ts is not None)
+                    self.add_delays(
+                        flow_id, chunk.delay[sel] / US_PER_MS,
+                        (chunk.ts[sel] - self.first_ts) / (1000.0 * US_PER_MS))
+
+    def base_ts(self, flow_id):
+        """Timestamp of the first arrival of a flow so far, or None"""
+        if (flow_id not in self.flow_base_ts and
+                self.find_flow_base is not None):
+            base_ts = self.find_flow_base(flow_id)
+            if base_ts is not None:
+                self.flow_base_ts[flow_id] = base_ts
+        return self.flow_base_ts.get(flow_id)
+
+    def merge(self, other):
+        """Fold in the summary of the part of the log that follows this one.
+        Both must have been given the same first_ts."""
+        for flow_id in other.flows:
+            self.flows.setdefault(flow_id, True)
+
+        self.capacity.merge(other.capacity)
+        self.all_departures.merge(other.all_departures)
+        for name in ['arrivals', 'departures']:
+            mine = getattr(self, name)
+            for flow_id, totals in getattr(other, name).items():
+                if flow_id in mine:
+                    mine[flow_id].merge(totals)
+                else:
+                    mine[flow_id] = totals
+
+        for flow_id, base_ts in other.flow_base_ts.items():
+            self.flow_base_ts.setdefault(flow_id, base_ts)
+        for flow_id, departure in other.first_departure.items():
+            self.first_departure.setdefault(flow_id, departure)
+        for flow_id, timeline in other.timelines.items():
+            if flow_id in self.timelines:
+                self.timelines[flow_id].merge(timeline)
+            else:
+                self.timelines[flow_id] = timeline
+
+        # both parts switch to sketches if either has or together they hold
+        # too many delays, as a single pass over the log would have
+        if (self.sketches is not None or other.sketches is not None or (
+                self.max_exact_delays is not None and
+                self.delays_kept + other.delays_kept > self.max_exact_delays)):
+            self.start_sketches()
+            other.start_sketches()
+            for flow_id, sketch in other.sketches.items():
+                if flow_id in self.sketches:
+                    self.sketches[flow_id].merge(sketch)
+                else:
+                    self.sketches[flow_id] = sketch
+
+        stride = max(self.delay_stride, other.delay_stride)
+        self.restride(stride)
+        other.restride(stride)
+        for flow_id in other.delays:
+            self.delays.setdefault(flow_id, []).extend(other.delays[flow_id])
+            self.delays_t.setdefault(flow_id, []).extend(
+                other.delays_t[flow_id])
+            self.delays_seen[flow_id] = (self.delays_seen.get(flow_id, 0) +
+                                         other.delays_seen[flow_id])
+        self.delays_kept += other.delays_kept
+
+        if (self.max_exact_delays is not None and
+                self.delays_kept > self.max_exact_delays):
+            self.thin_delays()
+
+    def flow_timeline(self, flow_id, ms_per_bin):
+        """Departures of a flow binned since its first arrival, leaving out
+        its first departure, as drawn by plot_over_time. Returns None for
+        flows without an arrival or with a single departure.
+        """
+        timeline = self.timelines.get(flow_id)
+        if timeline is None or self.delays_seen.get(flow_id, 0) < 2:
+            return None
+
+        timeline = timeline.shifted(0)
+        first_ts, first_bits, in_timeline = self.first_departure[flow_id]
+        if in_timeline:
+            first_bin = int(_whole_ms(first_ts - self.flow_base_ts[flow_id]))
+            timeline.counts[first_bin - timeline.base] -= first_bits
+            timeline.total -= first_bits
+        return timeline.coarsen(ms_per_bin)
+
+    def add_delays(self, flow_id, delays, delays_t):
+        seen = self.delays_seen.get(flow_id, 0)
+        self.delays_seen[flow_id] = seen + delays.size
+
+        if self.sketches is not None:
+            if flow_id not in self.sketches:
+                self.sketches[flow_id] = DelaySketch(self.delay_error)
+            self.sketches[flow_id].add(delays)
+
+            keep = np.arange(seen, seen + delays.size) % self.delay_stride == 0
+            delays = delays[keep]
+            delays_t = delays_t[keep]
+
+        self.delays.setdefault(flow_id, []).append(delays)
+        self.delays_t.setdefault(flow_id, []).append(delays_t)
+        self.delays_kept += delays.size
+
+        if (self.max_exact_delays is not None and
+                self.delays_kept > self.max_exact_delays):
+            self.thin_delays()
+
+    def start_sketches(self):
+        if self.sketches is None:
+            self.sketches = {}
+            for flow_id in self.delays:
+                self.sketches[flow_id] = DelaySketch(self.delay_error)
+                self.sketches[flow_id].add(self.flow_delays(flow_id))
+
+    def restride(self, stride):
+        """Thin the kept packets down to every stride-th packet per flow."""
+        if stride == self.delay_stride:
+            return
+
+        step = stride // self.delay_stride
+        self.delay_stride = stride
+        self.delays_kept = 0
+        for flow_id in self.delays:
+            self.delays[flow_id] = [self.flow_delays(flow_id)[::step]]
+            self.delays_t[flow_id] = [self.flow_delays_t(flow_id)[::step]]
+            self.delays_kept += self.delays[flow_id][0].size
+
+    def thin_delays(self):
+        self.start_sketches()
+
+        # halve the packets kept for graphing until they fit again; the
+        # first packet of every flow is always kept
+        while (self.delays_kept > self.max_exact_delays and
+               self.delays_kept > len(self.delays)):
+            self.restride(2 * self.delay_stride)
+
+    def flow_delays(self, flow_id):
+        return np.concatenate(self.delays[flow_id])
+
+    def flow_delays_t(self, flow_id):
+        return np.concatenate(self.delays_t[flow_id])
+
+    def delay_percentile(self, q, flow_id=None):
+        """q-th percentile delay of one flow, or of all flows if flow_id is
+        None; exact unless the summary has switched to sketches."""
+        flow_ids = list(self.delays) if flow_id is None else [flow_id]
+        flow_ids = [f for f in flow_ids if f in self.delays]
+        if not flow_ids:
+            return None
+
+        if self.sketches is None:
+            delays = np.concatenate([self.flow_delays(f) for f in flow_ids])
+            return np.percentile(delays, q, method='nearest')
+
+        sketch = DelaySketch(self.delay_error)
+        for f in flow_ids:
+            sketch.merge(self.sketches[f])
+        return sketch.quantile(q)
+
+    def save(self, npz_path):
+        """Save the summary, with the standard levels of every bin pyramid,
+        as an uncompressed .npz archive."""
+        pyramids = [self.capacity.bins, self.all_departures.bins]
+        pyramids += [totals.bins for totals in self.arrivals.values()]
+        pyramids += [totals.bins for totals in self.departures.values()]
+        for pyramid in pyramids:
+            pyramid.build()
+
+        state = {
+            'meta': np.array([
+                SUMMARY_VERSION,
+                -1 if self.max_exact_delays is None else self.max_exact_delays,
+                self.delay_error,
+                _nan_if_none(self.init_ts),
+                _nan_if_none(self.first_ts),
+                self.delays_kept,
+                self.delay_stride,
+                self.sketches is not None]),
+            'flows': np.array(list(self.flows), dtype=np.int64),
+        }
+        state.update(_prefixed('capacity', self.capacity.state()))
+        state.update(_prefixed('all_departures', self.all_departures.state()))
+
+        for name in ['arrivals', 'departures', 'timelines']:
+            for flow_id, value in getattr(self, name).items():
+                state.update(_prefixed('%s.%d' % (name, flow_id),
+                                       value.state()))
+        if self.sketches is not None:
+            for flow_id, sketch in self.sketches.items():
+                state.update(_prefixed('sketches.%d' % flow_id,
+                                       sketch.state()))
+
+        for flow_id in self.delays:
+            state['delays.%d' % flow_id] = self.flow_delays(flow_id)
+            state['delays_t.%d' % flow_id] = self.flow_delays_t(flow_id)
+            state['delays_seen.%d' % flow_id] = np.array(
+                [self.delays_seen[flow_id]])
+        for flow_id, base_ts in self.flow_base_ts.items():
+            state['flow_base_ts.%d' % flow_id] = np.array([base_ts])
+        for flow_id, departure in self.first_departure.items():
+            state['first_departure.%d' % flow_id] = np.array(departure)
+
+        # write to a file object so numpy does not append its own suffix
+        with open(npz_path, 'wb') as npz:
+            np.savez(npz, **state)
+
+    @classmethod
+    def load(cls, npz_path):
+        with np.load(npz_path) as npz:
+            state = dict(npz.items())
+
+        (version, max_exact_delays, delay_error, init_ts, first_ts,
+         delays_kept, delay_stride, sketched) = state['meta'].tolist()
+        if version != SUMMARY_VERSION:
+            raise ValueError('summary format %d is not %d'
+                             % (version, SUMMARY_VERSION))
+
+        summary = cls(None if max_exact_delays < 0 else int(max_exact_delays),
+                      delay_error)
+        summary.init_ts = _int_or_none(init_ts)
+        summary.first_ts = _int_or_none(first_ts)
+        summary.delays_kept = int(delays_kept)
+        summary.delay_stride = int(delay_stride)
+        summary.flows = {flow_id: True for flow_id in state['flows'].tolist()}
+
+        summary.capacity = EventTotals.from_state(
+            _unprefixed('capacity', state))
+        summary.all_departures = EventTotals.from_state(
+            _unprefixed('all_departures', state))
+        if sketched:
+            summary.sketches = {}
+
+        for key, value in state.items():
+            name, _, rest = key.partition('.')
+            flow_id, _, field = rest.partition('.')
+            if not flow_id.isdigit():
+                continue
+            flow_id = int(flow_id)
+
+            if name in ['delays', 'delays_t']:
+                getattr(summary, name)[flow_id] = [value]
+            elif name == 'delays_seen':
+                summary.delays_seen[flow_id] = int(value[0])
+            elif name == 'flow_base_ts':
+                summary.flow_base_ts[flow_id] = int(value[0])
+            elif name == 'first_departure':
+                summary.first_departure[flow_id] = (
+                    int(value[0]), int(value[1]), bool(value[2]))
+
+        # restore per-flow objects in the order they were saved
+        for name, klass in [('arrivals', EventTotals),
+                            ('departures', EventTotals),
+                            ('timelines', BinCounter),
+                            ('sketches', DelaySketch)]:
+            seen = []
+            for key in state:
+                if key.startswith(name + '.'):
+                    flow_id = int(key.split('.')[1])
+                    if flow_id not in seen:
+                        seen.append(flow_id)
+            for flow_id in seen:
+                getattr(summary, name)[flow_id] = klass.from_state(
+                    _unprefixed('%s.%d' % (name, flow_id), state))
+
+        return summary
+
+
+def _prefixed(prefix, state):
+    return {'%s.%s' % (prefix, key): value for key, value in state.items()}
+
+
+def _unprefixed(prefix, state):
+    prefix += '.'
+    return {key[len(prefix):]: value for key, value in state.items()
+            if key.startswith(prefix)}
+
+
+def _nan_if_none(value):
+    return np.nan if value is None else value
+
+
+def _int_or_none(value):
+    # timestamps in microseconds are saved exactly as floats
+    return None if np.isnan(value) else int(value)
+
+
+def _whole_ms(us):
+    """Whole milliseconds in microseconds, truncated toward zero"""
+    return np.sign(us) * (np.abs(us) // US_PER_MS)
+
+
+def summarize(tunnel_log, max_exact_delays=None, delay_error=0.01,
+              chunk_bytes=CHUNK_BYTES, jobs=1):
+    """Summarize a tunnel log. With jobs > 1, a log spanning several chunks
+    is split into up to jobs shards that are parsed by a process pool and
+    merged in log order. Compressed logs are read as one stream."""
+    jobs = min(jobs, os.path.getsize(tunnel_log) // chunk_bytes)
+    if compression(tunnel_log):
+        jobs = 1
+    if jobs < 2:
+        summary = TunnelLogSummary(max_exact_delays, delay_error)
+        summary.init_ts = read_init_timestamp(tunnel_log)
+        for chunk in iter_chunks(tunnel_log, chunk_bytes):
+            summary.update(chunk)
+        return summary
+
+    # every shard bins relative to the first event of the whole log
+    first_ts = read_first_timestamp(tunnel_log)
+    shards = [(tunnel_log, shard, first_ts, max_exact_delays, delay_error,
+               chunk_bytes) for shard in shard_ranges(tunnel_log, jobs)]
+    with multiprocessing.Pool(processes=len(shards)) as pool:
+        parts = pool.map(_summarize_shard, shards)
+
+    summary = parts[0]
+    for part in parts[1:]:
+        summary.merge(part)
+    summary.init_ts = read_init_timestamp(tunnel_log)
+    return summary
+
+
+def summarize_chunks(chunks, max_exact_delays=None, delay_error=0.01):
+    """Summarize the LogChunks of a log given in log order, such as the
+    events of a merge that is still running. init_ts is left unset."""
+    summary = TunnelLogSummary(max_exact_delays, delay_error)
+    for chunk in chunks:
+        summary.update(chunk)
+    return summary
+
+
+def _summarize_shard(args):
+    tunnel_log, shard, first_ts, max_exact_delays, delay_error, chunk_bytes = (
+        args)
+    summary = TunnelLogSummary(max_exact_delays, delay_error)
+    summary.first_ts = first_ts
+    summary.find_flow_base = functools.lru_cache()(functools.partial(
+        _first_arrival, tunnel_log, shard[0], chunk_bytes))
+    for chunk in iter_chunks(tunnel_log, chunk_bytes, shard):
+        summary.update(chunk)
+    summary.find_flow_base = None
+    return summary
+
+
+def _first_arrival(tunnel_log, end, chunk_bytes, flow_id):
+    """Timestamp of the first arrival of a flow before position end of a
+    tunnel log, or None. Logs with an index are read from where the flow
+    begins."""
+    start = 0
+    index = LogIndex.load(tunnel_log)
+    if index is not None:
+        span = index.flow_range(flow_id)
+        if span is None:
+            return None
+        start = span[0]
+    if start >= end:
+        return None
+
+    for chunk in iter_chunks(tunnel_log, chunk_bytes, (start, end)):
+        first = np.flatnonzero((chunk.event == ARRIVAL) &
+                               (chunk.flow == flow_id))
+        if first.size:
+            return int(chunk.ts[first[0]])
+    return None
@@ -0,0 +1,962 @@
+"""
+Reading and writing merged tunnel logs.
+
+A merged tunnel log (the output of ``merge_tunnel_logs.py multiple``) holds
+one event per line after a ``# init timestamp`` header:
+
+    <ts> # <size>                      delivery opportunity (mm-link)
+    <ts> + <size> [<flow>]             packet arrived at the tunnel
+    <ts> - <size> <delay> [<flow>]     packet departed from the tunnel
+
+Text logs are read in large blocks that are tokenized in one go and
+converted into typed column arrays (LogChunks).
+
+Timestamps and delays, written in milliseconds with three decimals, are
+held as integer microseconds from parsing to formatting, so reading and
+writing logs never rounds them; only the edges (headers, statistics and
+graphs) deal in milliseconds.
+
+The same events can also be stored in a binary columnar file: a small JSON
+header followed by one fixed-width array per column, which readers map into
+memory with np.memmap instead of parsing.
+
+Merged logs can have a sidecar index (log_path + INDEX_SUFFIX, see
+LogIndex) of where every second and every flow of the log begins.
+
+Text logs (merged or raw) whose names end in a compression extension (see
+COMPRESSIONS) are compressed and decompressed on the fly by open_log().
+"""
+
+import decimal
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+CAPACITY = 0
+ARRIVAL = 1
+DEPARTURE = 2
+
+US_PER_MS = 1000  # timestamps and delays are integer microseconds
+
+CHUNK_BYTES = 1024 * 1024
+CHUNK_ROWS = 1024 * 1024
+
+COLUMNAR_MAGIC = b"PTNLCOL\x00"
+COLUMNAR_VERSION = 2  # version 1 held timestamps and delays as float ms
+
+COLUMNS = [
+    ("ts", "<i8"),
+    ("event", "<i1"),
+    ("size", "<u2"),
+    ("delay", "<i8"),
+    ("flow", "<u2"),
+]
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+US_PER_INDEX_ENTRY = 1000 * US_PER_MS  # the index locates every second
+_ALIGN = 64
+_PREAMBLE = struct.Struct("<8sI")
+
+_COMMENT_RE = re.compile(rb"^#[^\n]*(?:\n|$)", re.MULTILINE)
+
+_POW10 = 10 ** np.arange(19, dtype=np.int64)
+_MAX_DIGITS = 15  # scaled by up to 10^3, mantissas still fit in int64
+
+# compression of text logs by file extension; .zst and .lz4 need the
+# zstandard and lz4 packages
+COMPRESSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "lzma",
+    ".zst": "zstandard",
+    ".lz4": "lz4.frame",
+}
+
+# ts and delay in integer microseconds; delay is 0 for other events than
+# departures and flow is 0 for capacity events
+LogChunk = namedtuple("LogChunk", ["ts", "event", "size", "delay", "flow"])
+
+
+def compression(log_path):
+    """Return the compression extension of a log's name, or None"""
+    extension = os.path.splitext(str(log_path))[1]
+    return extension if extension in COMPRESSIONS else None
+
+
+def open_log(log_path, mode="rb"):
+    """
+    Open a log like open(), streaming it through the compression that its
+    extension selects, if any. Text modes of compressed logs behave like
+    those of plain files.
+    """
+    extension = compression(log_path)
+    if extension is None:
+        return open(log_path, mode)
+
+    module = COMPRESSIONS[extension]
+    try:
+        module = importlib.import_module(module)
+    except ImportError:
+        raise ImportError(
+            "%s logs need the %s package" % (extension, module.split(".")[0])
+        )
+
+    if "b" not in mode:
+        mode += "t"
+    log = module.open(log_path, mode)
+    if extension == ".zst" and mode == "rb":
+        # the zstandard reader cannot read lines on its own
+        log = io.BufferedReader(log)
+    return log
+
+
+def find_log(log_path):
+    """
+    Return log_path, or the path of a compressed copy of it
+    (log_path + extension) if only that exists.
+    """
+    if os.path.exists(log_path):
+        return log_path
+    for extension in COMPRESSIONS:
+        if os.path.exists(str(log_path) + extension):
+            return str(log_path) + extension
+    return log_path
+
+
+def compress_log(log_path, extension=".gz"):
+    """Compress a finished log into log_path + extension, remove the
+    original and return the path of the compressed log. Its index, if
+    any, moves along."""
+    index = LogIndex.load(log_path)
+    compressed = str(log_path) + extension
+    # the partial file keeps the extension, which selects the compression
+    part = str(log_path) + ".part" + extension
+    with open(log_path, "rb") as log, open_log(part, "wb") as out:
+        shutil.copyfileobj(log, out, CHUNK_BYTES)
+    os.replace(part, compressed)
+    os.remove(log_path)
+    if os.path.exists(index_path(log_path)):
+        os.remove(index_path(log_path))
+    if index is not None:
+        index.save(compressed)
+    return compressed
+
+
+def empty_chunk():
+    return LogChunk(
+        ts=np.zeros(0, dtype=np.int64),
+        event=np.zeros(0, dtype=np.int8),
+        size=np.zeros(0, dtype=np.int64),
+        delay=np.zeros(0, dtype=np.int64),
+        flow=np.zeros(0, dtype=np.int64),
+    )
+
+
+def parse_ms(text):
+    """
+    Parse milliseconds (str or bytes) such as "12.345" into integer
+    microseconds. Anything else float() accepts is rounded to the nearest
+    microsecond, half to even.
+    """
+    if isinstance(text, bytes):
+        text = text.decode()
+    text = text.strip()
+    negative = text.startswith("-")
+    whole, _, frac = text[negative:].partition(".")
+    if whole.isdigit() and whole.isascii() and len(frac) <= 3 and (
+        not frac or frac.isdigit() and frac.isascii()
+    ):
+        us = int(whole) * US_PER_MS + int(frac.ljust(3, "0"))
+        return -us if negative else us
+    return _scaled(text, 3)
+
+
+def format_ms(us):
+    """Format integer microseconds as milliseconds, as "%.3f" does"""
+    sign = "-" if us < 0 else ""
+    return "%s%d.%03d" % (sign, abs(us) // US_PER_MS, abs(us) % US_PER_MS)
+
+
+def _scaled(text, decimals):
+    """Round a decimal number to an integer in units of 10^-decimals"""
+    float(text)  # rejects whatever float() rejects
+    return round(decimal.Decimal(text.strip()).scaleb(decimals))
+
+
+def tokenize(buf):
+    """Return the bytes of buf and the [start, end) offsets of its tokens"""
+    a = np.frombuffer(buf, dtype=np.uint8)
+    edge = np.diff((a <= 32).view(np.int8), prepend=np.int8(1), append=np.int8(1))
+    return a, np.flatnonzero(edge == -1), np.flatnonzero(edge == 1)
+
+
+def parse_numbers(a, start, end, decimals=3):
+    """
+    Convert the decimal tokens a[start:end] to integers in units of
+    10^-decimals.
+
+    Each token is read as an integer mantissa and scaled, which is exact for
+    plain decimals of up to 15 digits with at most decimals of them after
+    the dot. Anything else (exponents, longer mantissas, finer fractions)
+    is rounded to the nearest unit, half to even.
+    """
+    is_digit = (a - 48) < 10
+    cdigits = np.zeros(a.size + 1, dtype=np.int32)
+    np.cumsum(is_digit, out=cdigits[1:])
+    dstart = cdigits[start]
+    dend = cdigits[end]
+    ndigits = dend - dstart
+
+    # place value of every digit within its own token
+    place = np.repeat(dend, ndigits)
+    place -= np.arange(1, int(cdigits[-1]) + 1, dtype=np.int32)
+    np.minimum(place, 18, out=place)
+    contrib = _POW10[place]
+    contrib *= a[is_digit] - 48
+    # differences of the running sum are exact even if the sum wraps around
+    csum = np.zeros(contrib.size + 1, dtype=np.int64)
+    np.cumsum(contrib, out=csum[1:])
+    mantissa = csum[dend] - csum[dstart]
+
+    is_dot = a == 46
+    cdots = np.zeros(a.size + 1, dtype=np.int32)
+    np.cumsum(is_dot, out=cdots[1:])
+    ndots = cdots[end] - cdots[start]
+    frac = np.zeros(start.size, dtype=np.int32)
+    dotted = np.flatnonzero(ndots == 1)
+    dot_pos = np.flatnonzero(is_dot)[cdots[start[dotted]]]
+    frac[dotted] = dend[dotted] - cdigits[dot_pos + 1]
+
+    values = mantissa * _POW10[np.clip(decimals - frac, 0, 18)]
+    negative = a[start] == 45
+    values[negative] = -values[negative]
+
+    odd = (
+        (ndigits == 0)
+        | (ndigits > _MAX_DIGITS)
+        | (ndots > 1)
+        | (frac > decimals)
+        | (end - start != ndigits + ndots + negative)
+    )
+    for i in np.flatnonzero(odd).tolist():
+        values[i] = _scaled(a[start[i] : end[i]].tobytes().decode(), decimals)
+
+    return values
+
+
+def parse_fields(a, start, end, decimals=0):
+    """
+    Convert the fields a[start:end] (plain digits, with up to decimals of
+    them after a dot) to int64 in units of 10^-decimals, or return None if
+    any field is of another form or too long to convert exactly.
+
+    Unlike parse_numbers, the fields are grouped by length and dot position
+    and converted a whole group at a time, which suits logs whose fields
+    have only a few distinct widths.
+    """
+    length = end - start
+    if not length.size:
+        return np.zeros(0, dtype=np.int64)
+    if length.min() < 1 or length.max() > _MAX_DIGITS + 1:
+        return None
+
+    values = np.zeros(start.size, dtype=np.int64)
+    for width in np.unique(length).tolist():
+        rows = np.flatnonzero(length == width)
+        chars = a[start[rows, None] + np.arange(width)]
+        digits = chars - np.uint8(48)
+
+        if not decimals:
+            if width > _MAX_DIGITS or np.any(digits > 9):
+                return None
+            values[rows] = digits.astype(np.int64) @ _POW10[width - 1 :: -1]
+            continue
+
+        is_dot = chars == 46
+        dots = is_dot.sum(axis=1)
+        if np.any(dots > 1) or np.any((digits > 9) & ~is_dot):
+            return None
+        # the dot position (width if none) selects the place values
+        dot = np.where(dots == 1, is_dot.argmax(axis=1), width)
+        for pos in np.unique(dot).tolist():
+            group = dot == pos
+            ndigits = width - (pos < width)
+            frac = max(width - 1 - pos, 0)
+            if ndigits < 1 or ndigits > _MAX_DIGITS or frac > decimals:
+                return None
+            mantissa = digits[group]
+            if pos < width:
+                mantissa = np.delete(mantissa, pos, axis=1)
+            mantissa = mantissa.astype(np.int64) @ _POW10[ndigits - 1 :: -1]
+            values[rows[group]] = mantissa * _POW10[decimals - frac]
+
+    return values
+
+
+def fixed_point_chars(values, decimals=3):
+    """
+    Format integers in units of 10^-decimals like "%.<decimals>f" of the
+    numbers they stand for, as rows of a char matrix.
+
+    Return (chars, keep): keep marks the characters that belong to each
+    formatted value, right-aligned in its row.
+    """
+    return _decimal_chars(np.abs(values), values < 0, decimals)
+
+
+def integer_chars(values):
+    """Format integers like "%d" as rows of a (chars, keep) char matrix"""
+    return _decimal_chars(np.abs(values), values < 0, 0)
+
+
+def _decimal_chars(scaled, negative, decimals):
+    int_digits = 1
+    if scaled.size:
+        int_digits = len(str(int(scaled.max()) // 10**decimals))
+    width = 1 + int_digits + (decimals + 1 if decimals else 0)
+
+    chars = np.empty((scaled.size, width), dtype=np.uint8)
+    keep = np.ones((scaled.size, width), dtype=bool)
+    chars[:, 0] = 45
+    keep[:, 0] = negative
+
+    col = width - 1
+    rest = scaled
+    for place in range(decimals + int_digits):
+        if place == decimals and decimals:
+            chars[:, col] = 46
+            col -= 1
+        rest, digit = np.divmod(rest, 10)
+        chars[:, col] = digit
+        chars[:, col] += 48
+        if place > decimals:
+            # drop leading zeros of the integer part, keeping one
+            keep[:, col] = scaled >= _POW10[place]
+        col -= 1
+
+    return chars, keep
+
+
+def constant_chars(text, rows):
+    """Repeat text as a (chars, keep) char matrix with the given rows"""
+    chars = np.frombuffer(text, dtype=np.uint8)
+    return (
+        np.broadcast_to(chars, (rows, chars.size)),
+        np.ones((rows, chars.size), dtype=bool),
+    )
+
+
+def slice_chars(a, start, end):
+    """Take the fields a[start:end] as a left-aligned (chars, keep) char matrix"""
+    length = end - start
+    width = int(length.max()) if length.size else 0
+    keep = np.arange(width) < length[:, None]
+    # positions past a field end are masked out, only keep them in bounds
+    index = np.minimum(start[:, None] + np.arange(width), max(a.size - 1, 0))
+    return a[index] if a.size else np.zeros(keep.shape, dtype=np.uint8), keep
+
+
+def bytes_chars(texts):
+    """Lay out a list of bytes as a left-aligned (chars, keep) char matrix"""
+    length = np.array([len(text) for text in texts], dtype=np.int64)
+    width = int(length.max()) if length.size else 0
+    chars = np.frombuffer(b"".join(text.ljust(width) for text in texts), np.uint8)
+    return chars.reshape(len(texts), width), np.arange(width) < length[:, None]
+
+
+def hstack_chars(fields):
+    """Concatenate (chars, keep) matrices column-wise"""
+    chars = np.concatenate([field[0] for field in fields], axis=1)
+    keep = np.concatenate([field[1] for field in fields], axis=1)
+    return chars, keep
+
+
+def join_chars(fields):
+    """Concatenate (chars, keep) matrices column-wise into bytes, row by row"""
+    chars, keep = hstack_chars(fields)
+    return chars[keep].tobytes()
+
+
+def format_chunk(chunk):
+    """Format a LogChunk as the lines of a merged tunnel log"""
+    departure = chunk.event == DEPARTURE
+    ts_chars = fixed_point_chars(chunk.ts)
+    delay_chars = fixed_point_chars(np.where(departure, chunk.delay, 0))
+
+    rows = chunk.ts.size
+    event = np.full((rows, 3), 32, dtype=np.uint8)
+    event[:, 1] = np.array([35, 43, 45], dtype=np.uint8)[chunk.event]
+    space = constant_chars(b" ", rows)[0]
+    # delays belong to departures only, flow ids to every packet event
+    flowed = (chunk.event != CAPACITY)[:, None]
+    delay_chars[1][~departure] = False
+    flow_chars = integer_chars(chunk.flow)
+    flow_chars[1][~flowed[:, 0]] = False
+    return join_chars(
+        [
+            ts_chars,
+            (event, np.ones(event.shape, dtype=bool)),
+            integer_chars(chunk.size),
+            (space, departure[:, None]),
+            delay_chars,
+            (space, flowed),
+            flow_chars,
+            constant_chars(b"\n", rows),
+        ]
+    ).decode()
+
+
+def parse_chunk(data):
+    """Parse a block of complete log lines (bytes) into a LogChunk"""
+    if data.startswith(b"#") or b"\n#" in data:
+        data = _COMMENT_RE.sub(b"", data)
+
+    a, start, end = tokenize(data)
+    if not start.size:
+        return empty_chunk()
+
+    first = a[start]
+    single = end - start == 1
+    is_capacity = single & (first == 35)
+    is_arrival = single & (first == 43)
+    is_departure = single & (first == 45)
+
+    # every event type token is preceded by its timestamp, so the number of
+    # tokens on a line is the distance between consecutive line starts
+    is_event = is_capacity | is_arrival | is_departure
+    pos = np.flatnonzero(is_event)
+    starts = pos - 1
+    ntokens = np.diff(np.append(starts, start.size))
+
+    # in microseconds, or thousandths of sizes and flow ids
+    numbers = np.zeros(start.size, dtype=np.int64)
+    numeric = ~is_event
+    numbers[numeric] = parse_numbers(a, start[numeric], end[numeric])
+
+    event = np.full(pos.size, CAPACITY, dtype=np.int8)
+    event[is_arrival[pos]] = ARRIVAL
+    departure = is_departure[pos]
+    event[departure] = DEPARTURE
+
+    ts = numbers[starts]
+    size = numbers[pos + 1] // US_PER_MS
+
+    delay = np.zeros(pos.size, dtype=np.int64)
+    delay[departure] = numbers[pos[departure] + 2]
+
+    # flow ids are only present in logs merged from one or more tunnels
+    flow = np.zeros(pos.size, dtype=np.int64)
+    flowed = (event == ARRIVAL) & (ntokens == 4)
+    flow[flowed] = numbers[pos[flowed] + 2] // US_PER_MS
+    flowed = departure & (ntokens == 5)
+    flow[flowed] = numbers[pos[flowed] + 3] // US_PER_MS
+
+    return LogChunk(ts=ts, event=event, size=size, delay=delay, flow=flow)
+
+
+def iter_text_chunks(log_path, chunk_bytes=CHUNK_BYTES, shard=None):
+    """
+    Yield the events of a text log as LogChunks of about chunk_bytes.
+
+    shard restricts reading to a (start, end) byte range on line boundaries,
+    as returned by shard_ranges().
+    """
+    start, end = shard if shard is not None else (0, None)
+    with open_log(log_path) as log:
+        if start:
+            log.seek(start)
+        remaining = end - start if end is not None else None
+        partial = b""
+        while True:
+            size = chunk_bytes if remaining is None else min(chunk_bytes, remaining)
+            block = log.read(size) if size else b""
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+
+            block = partial + block
+            cut = block.rfind(b"\n") + 1
+            partial = block[cut:]
+            if cut:
+                yield parse_chunk(block[:cut])
+
+        if partial:
+            yield parse_chunk(partial)
+
+
+def is_columnar(log_path):
+    """Checks whether a log is stored in the binary columnar format"""
+    if compression(log_path):
+        return False
+    with open(log_path, "rb") as log:
+        return log.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+
+def iter_chunks(log_path, chunk_bytes=CHUNK_BYTES, shard=None):
+    """Yield the events of a text or columnar log (or of one of its shards)
+    as LogChunks"""
+    if is_columnar(log_path):
+        return ColumnarLog(log_path).iter_chunks(shard=shard)
+    return iter_text_chunks(log_path, chunk_bytes, shard)
+
+
+def shard_ranges(log_path, shards):
+    """
+    Split a log into at most shards consecutive, non-empty parts that can be
+    read independently with iter_chunks(shard=...).
+
+    Parts of text logs are byte ranges ending at line boundaries; parts of
+    columnar logs are row ranges. Logs with an index are cut where seconds
+    begin, without reading the log.
+    """
+    index = LogIndex.load(log_path)
+    if index is not None:
+        return index.shard_ranges(shards)
+
+    if is_columnar(log_path):
+        size = ColumnarLog(log_path).rows
+        cuts = [size * i // shards for i in range(1, shards)]
+    else:
+        size = os.path.getsize(log_path)
+        cuts = []
+        with open(log_path, "rb") as log:
+            for i in range(1, shards):
+                # move each cut to just after the end of the line it falls in
+                log.seek(max(size * i // shards - 1, 0))
+                log.readline()
+                cuts.append(log.tell())
+
+    bounds = [0] + cuts + [size]
+    return [
+        (start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+    ]
+
+
+def read_first_timestamp(log_path):
+    """Return the timestamp of the first event in a log (None if empty)"""
+    for chunk in iter_chunks(log_path):
+        if chunk.ts.size:
+            return int(chunk.ts[0])
+    return None
+
+
+def read_init_timestamp(log_path):
+    """Return the init timestamp of a text or columnar log (None if absent)"""
+    if is_columnar(log_path):
+        return ColumnarLog(log_path).init_ts
+
+    with open_log(log_path, "r") as log:
+        for line in log:
+            if not line.startswith("#"):
+                break
+            if "init timestamp" in line:
+                return parse_ms(line.split(":")[1])
+    return None
+
+
+class ColumnarLogWriter:
+    """
+    Writes LogChunks to a columnar log.
+
+    Columns are spooled to temporary files next to the output while the
+    number of rows is still unknown, and laid out one after another behind
+    the header when the writer is closed.
+
+    write() accepts the text a text log would receive (including its
+    ``# init timestamp`` header), so the writer can stand in for an output
+    file opened in text mode.
+    """
+
+    def __init__(self, log_path, init_ts=None):
+        self.log_path = str(log_path)
+        self.init_ts = init_ts
+        self.rows = 0
+        self.spools = {
+            name: open(f"{self.log_path}.{name}.part", "wb") for name, _ in COLUMNS
+        }
+        self.pending = []
+        self.pending_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, text):
+        if text.startswith("# init timestamp"):
+            self.init_ts = parse_ms(text.split(":")[1])
+            return
+
+        self.pending.append(text)
+        self.pending_bytes += len(text)
+        if self.pending_bytes >= CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self.pending).encode()
+        cut = data.rfind(b"\n") + 1
+        self.pending = [data[cut:].decode()] if cut < len(data) else []
+        self.pending_bytes = len(data) - cut
+        if cut:
+            self._append(parse_chunk(data[:cut]))
+
+    def append(self, chunk):
+        if self.pending:
+            self.flush()
+        self._append(chunk)
+
+    def _append(self, chunk):
+        for name, dtype in COLUMNS:
+            values = getattr(chunk, name)
+            info = np.iinfo(dtype) if np.dtype(dtype).kind in "iu" else None
+            if info is not None and values.size and (
+                values.min() < info.min or values.max() > info.max
+            ):
+                raise ValueError(f"{name} values do not fit in {dtype}")
+            self.spools[name].write(np.asarray(values, dtype=dtype).tobytes())
+        self.rows += chunk.ts.size
+
+    def close(self):
+        if self.pending:
+            data = "".join(self.pending).encode()
+            self.pending = []
+            self._append(parse_chunk(data))
+
+        columns = []
+        offset = 0
+        for name, dtype in COLUMNS:
+            columns.append({"name": name, "dtype": dtype, "offset": offset})
+            offset += _aligned(self.rows * np.dtype(dtype).itemsize)
+
+        header = {
+            "version": COLUMNAR_VERSION,
+            "rows": self.rows,
+            "init_ts": self.init_ts,
+            "columns": columns,
+        }
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(_PREAMBLE.size + len(header_bytes))
+        for column in columns:
+            column["offset"] += data_start
+        # offsets only grow, so the padded header length stays the same
+        header_bytes = json.dumps(header).encode()
+        header_bytes += b" " * (data_start - _PREAMBLE.size - len(header_bytes))
+
+        with open(self.log_path, "wb") as log:
+            log.write(_PREAMBLE.pack(COLUMNAR_MAGIC, len(header_bytes)))
+            log.write(header_bytes)
+            for column in columns:
+                spool = self.spools[column["name"]]
+                spool.close()
+                with open(spool.name, "rb") as part:
+                    shutil.copyfileobj(part, log)
+                log.write(b"\0" * (_aligned(log.tell()) - log.tell()))
+                os.remove(spool.name)
+
+    def discard(self):
+        for spool in self.spools.values():
+            spool.close()
+            os.remove(spool.name)
+
+
+class ColumnarLog:
+    """Read-only, memory-mapped view of a columnar log"""
+
+    def __init__(self, log_path):
+        self.log_path = str(log_path)
+        with open(self.log_path, "rb") as log:
+            magic, header_len = _PREAMBLE.unpack(log.read(_PREAMBLE.size))
+            if magic != COLUMNAR_MAGIC:
+                raise ValueError(f"{log_path} is not a columnar log")
+            header = json.loads(log.read(header_len))
+
+        self.version = header["version"]
+        if self.version not in (1, COLUMNAR_VERSION):
+            raise ValueError(
+                f"{log_path} has unsupported columnar version {self.version}"
+            )
+
+        self.rows = header["rows"]
+        self.init_ts = header["init_ts"]
+        if self.version == 1 and self.init_ts is not None:
+            self.init_ts = int(_us_from_ms(np.array([self.init_ts]))[0])
+        self.columns = {}
+        for column in header["columns"]:
+            if self.rows:
+                self.columns[column["name"]] = np.memmap(
+                    self.log_path,
+                    dtype=column["dtype"],
+                    mode="r",
+                    offset=column["offset"],
+                    shape=(self.rows,),
+                )
+            else:
+                self.columns[column["name"]] = np.zeros(0, dtype=column["dtype"])
+
+    def chunk(self, start, stop):
+        """Return rows [start, stop) as a LogChunk"""
+        cols = self.columns
+        ts = np.asarray(cols["ts"][start:stop])
+        delay = np.asarray(cols["delay"][start:stop])
+        if self.version == 1:
+            ts = _us_from_ms(ts)
+            delay = _us_from_ms(np.nan_to_num(delay))
+        return LogChunk(
+            ts=ts,
+            event=np.asarray(cols["event"][start:stop]),
+            size=cols["size"][start:stop].astype(np.int64),
+            delay=delay,
+            flow=cols["flow"][start:stop].astype(np.int64),
+        )
+
+    def iter_chunks(self, chunk_rows=CHUNK_ROWS, shard=None):
+        start, stop = shard if shard is not None else (0, self.rows)
+        for offset in range(start, stop, chunk_rows):
+            yield self.chunk(offset, min(offset + chunk_rows, stop))
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _us_from_ms(values):
+    # float ms parsed from three decimals scale back to them exactly
+    return np.rint(values * US_PER_MS).astype(np.int64)
+
+
+def convert_to_columnar(text_log, columnar_log, chunk_bytes=CHUNK_BYTES):
+    """Convert an existing text tunnel log to the columnar format"""
+    init_ts = read_init_timestamp(text_log)
+    with ColumnarLogWriter(columnar_log, init_ts) as writer:
+        for chunk in iter_text_chunks(text_log, chunk_bytes):
+            writer.append(chunk)
+
+
+def index_path(log_path):
+    """Return the path of the sidecar index of a log"""
+    return str(log_path) + INDEX_SUFFIX
+
+
+class LogIndexBuilder:
+    """
+    Builds the sidecar index of a log from its events, given in log order
+    as they are written.
+
+    Positions are byte offsets into the text of text logs (decompressed, for
+    compressed logs) and row numbers of columnar logs, the units of the
+    shards that iter_chunks() reads. start is where the first event may
+    begin, after the header of a text log.
+    """
+
+    def __init__(self, start=0):
+        self.position = start
+        self.max_ts = None
+        self.max_lag = 0
+        self.first_second = None
+        self.offsets = []
+        self.flows = {}
+
+    def add_lines(self, ts, flow, lines):
+        """Add events written as lines (str or bytes), one per event"""
+        if isinstance(lines, str):
+            lines = lines.encode()
+        ends = np.flatnonzero(np.frombuffer(lines, dtype=np.uint8) == 10) + 1
+        self.add(ts, flow, np.append(0, ends[:-1]), ends, len(lines))
+
+    def add_rows(self, ts, flow):
+        """Add events written as rows of a columnar log"""
+        self.add(ts, flow, np.arange(ts.size), np.arange(1, ts.size + 1), ts.size)
+
+    def add(self, ts, flow, starts, ends, size):
+        """Add the events of a block of size positions, whose lines (or
+        rows) span [starts, ends), relative to the start of the block"""
+        if ts.size:
+            starts = self.position + starts
+            ends = self.position + ends
+
+            # events may be slightly out of order, so seconds begin where
+            # the running maximum of the timestamps reaches them
+            first = ts[0] if self.max_ts is None else self.max_ts
+            key = np.maximum.accumulate(np.append(first, ts))[1:]
+            self.max_ts = int(key[-1])
+            self.max_lag = max(self.max_lag, int(np.max(key - ts)))
+
+            seconds = key // US_PER_INDEX_ENTRY
+            if self.first_second is None:
+                self.first_second = int(seconds[0])
+            new = np.arange(self.first_second + len(self.offsets), seconds[-1] + 1)
+            at = np.searchsorted(key, new * US_PER_INDEX_ENTRY)
+            self.offsets += starts[at].tolist()
+
+            # flow ids are few and small
+            counts = np.bincount(flow)
+            for flow_id in np.flatnonzero(counts):
+                events = flow == flow_id
+                i = int(np.argmax(events))
+                j = flow.size - 1 - int(np.argmax(events[::-1]))
+                span = self.flows.setdefault(int(flow_id), [int(starts[i]), 0, 0])
+                span[1] = int(ends[j])
+                span[2] += int(counts[flow_id])
+
+        self.position += size
+
+    def finish(self):
+        """Return the index of the events added so far"""
+        return LogIndex(
+            {
+                "version": INDEX_VERSION,
+                "end": self.position,
+                "us_per_entry": US_PER_INDEX_ENTRY,
+                "first_second": self.first_second or 0,
+                "offsets": self.offsets,
+                "max_lag_us": self.max_lag,
+                "flows": {str(flow_id): span for flow_id, span in self.flows.items()},
+            }
+        )
+
+
+class LogIndex:
+    """
+    Sidecar index of a log (log_path + INDEX_SUFFIX, in JSON): the position
+    at which every second of the log begins and the span of every flow, so
+    that readers can seek to a time range or a flow, or split a log into
+    shards, without scanning it first.
+
+    offsets[k] is the position of the first event from second
+    first_second + k on, counted in timestamps relative to the init
+    timestamp; every event before it has an earlier timestamp. No event
+    after it is more than max_lag_us earlier than an event before it.
+    flows maps each flow id (0 for delivery opportunities) to the
+    [start, end) span of its events and their number.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.end = header["end"]
+        self.us_per_entry = header["us_per_entry"]
+        self.first_second = header["first_second"]
+        self.offsets = header["offsets"]
+        self.max_lag = header["max_lag_us"]
+        self.flows = {
+            int(flow_id): tuple(span) for flow_id, span in header["flows"].items()
+        }
+
+    @classmethod
+    def load(cls, log_path):
+        """Return the index of a log, or None if it has none or the log
+        changed since it was indexed"""
+        try:
+            with open(index_path(log_path)) as index:
+                header = json.load(index)
+            log_size = os.path.getsize(log_path)
+        except (OSError, ValueError):
+            return None
+        if header.get("version") != INDEX_VERSION:
+            return None
+        if header.get("log_size") != log_size:
+            return None
+        return cls(header)
+
+    def save(self, log_path):
+        """Write the index next to log_path, which must be complete"""
+        header = dict(self.header, log_size=os.path.getsize(log_path))
+        part = index_path(log_path) + ".part"
+        with open(part, "w") as index:
+            json.dump(header, index)
+        os.replace(part, index_path(log_path))
+
+    def _second_start(self, second):
+        k = second - self.first_second
+        if k <= 0:
+            return self.offsets[0] if self.offsets else self.end
+        return self.offsets[k] if k < len(self.offsets) else self.end
+
+    def time_range(self, start_us=None, end_us=None):
+        """
+        Return the (start, end) range of positions that holds every event
+        with a timestamp in [start_us, end_us), possibly among others
+        """
+        start = 0
+        if start_us is not None:
+            start = self._second_start(start_us // self.us_per_entry)
+        end = self.end
+        if end_us is not None:
+            # an event before end_us precedes every event max_lag_us later
+            end = self._second_start(-(-(end_us + self.max_lag) // self.us_per_entry))
+        return start, max(start, end)
+
+    def flow_range(self, flow_id):
+        """Return the (start, end) range of positions that holds every event
+        of a flow, or None if the flow has no events"""
+        span = self.flows.get(flow_id)
+        return None if span is None else (span[0], span[1])
+
+    def shard_ranges(self, shards):
+        """Same as shard_ranges(), cutting at the starts of seconds"""
+        cuts = set()
+        offsets = np.array(self.offsets, dtype=np.int64)
+        for i in range(1, shards):
+            target = self.end * i // shards
+            j = int(np.searchsorted(offsets, target))
+            near = offsets[max(j - 1, 0) : j + 1]
+            if near.size:
+                cuts.add(int(near[np.argmin(np.abs(near - target))]))
+
+        bounds = [0] + sorted(cuts) + [self.end]
+        return [
+            (start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+        ]
+
+
+def index_log(log_path, chunk_bytes=CHUNK_BYTES):
+    """Write the index of an existing text or columnar log and return it"""
+    builder = LogIndexBuilder()
+    if is_columnar(log_path):
+        for chunk in ColumnarLog(log_path).iter_chunks():
+            builder.add_rows(chunk.ts, chunk.flow)
+    else:
+        with open_log(log_path) as log:
+            partial = b""
+            while True:
+                block = log.read(chunk_bytes)
+                data = partial + block
+                cut = data.rfind(b"\n") + 1 if block else len(data)
+                partial = data[cut:]
+                if cut:
+                    _index_lines(builder, data[:cut], log_path)
+                if not block:
+                    break
+
+    index = builder.finish()
+    index.save(log_path)
+    return index
+
+
+def _index_lines(builder, data, log_path):
+    a = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(a == 10) + 1
+    if not ends.size or ends[-1] != a.size:
+        ends = np.append(ends, a.size)
+    starts = np.append(0, ends[:-1])
+
+    # every line holds one event, except comments and blank lines
+    printable = np.append(0, np.cumsum(a > 32))
+    event = (printable[ends] > printable[starts]) & (a[starts] != 35)
+
+    chunk = parse_chunk(data)
+    if chunk.ts.size != np.count_nonzero(event):
+        raise ValueError(f"{log_path} has lines that are not single events")
+    builder.add(chunk.ts, chunk.flow, starts[event], ends[event], a.size)
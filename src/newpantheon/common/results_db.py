@@ -0,0 +1,275 @@
+"""
+Append-only SQLite store of test and analysis results across experiments.
+
+Every data dir stays the record of its own experiment; the database keeps a
+copy of what matters for comparing experiments, so that a dashboard queries
+one indexed file instead of reopening every pantheon_metadata.json,
+pantheon_perf.json and stats log:
+
+    experiments   one row per data dir and version of its metadata, with the
+                  mode, flows, runtime and traces pulled out for filtering
+    test_runs     start and end of every test run and its clock offsets
+                  (Test.record_time_stats)
+    results       throughput, delay, loss, duration and statistics of every
+                  analyzed run (Plot.run)
+    flow_results  throughput, delay and loss of every flow of a result, and
+                  of all flows as flow "all", as in pantheon_perf.json
+
+Rows are only ever added: analyzing a run again adds a newer result, and
+the latest_results view keeps the newest result of every run. aggregate()
+summarizes the latest results over any grouping of experiments and schemes;
+it is what "newpantheon results" prints.
+"""
+
+import json
+import sqlite3
+import sys
+from os import path
+
+from newpantheon.common import utils
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    data_dir TEXT NOT NULL,
+    recorded_at TEXT NOT NULL,
+    mode TEXT,
+    flows INTEGER,
+    runtime INTEGER,
+    uplink_trace TEXT,
+    downlink_trace TEXT,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS experiments_data_dir ON experiments (data_dir);
+
+CREATE TABLE IF NOT EXISTS test_runs (
+    id INTEGER PRIMARY KEY,
+    experiment_id INTEGER NOT NULL REFERENCES experiments (id),
+    scheme TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    recorded_at TEXT NOT NULL,
+    start_at TEXT,
+    end_at TEXT,
+    local_offset_ms REAL,
+    remote_offset_ms REAL
+);
+CREATE INDEX IF NOT EXISTS test_runs_run
+    ON test_runs (experiment_id, scheme, run_id);
+
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    experiment_id INTEGER NOT NULL REFERENCES experiments (id),
+    scheme TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    recorded_at TEXT NOT NULL,
+    throughput_mbps REAL,
+    delay_ms REAL,
+    loss_rate REAL,
+    duration_ms REAL,
+    stats TEXT
+);
+CREATE INDEX IF NOT EXISTS results_run
+    ON results (experiment_id, scheme, run_id);
+CREATE INDEX IF NOT EXISTS results_scheme ON results (scheme);
+
+CREATE TABLE IF NOT EXISTS flow_results (
+    result_id INTEGER NOT NULL REFERENCES results (id),
+    flow TEXT NOT NULL,
+    throughput_mbps REAL,
+    delay_ms REAL,
+    loss_rate REAL
+);
+CREATE INDEX IF NOT EXISTS flow_results_result ON flow_results (result_id);
+
+CREATE VIEW IF NOT EXISTS latest_results AS
+    SELECT * FROM results WHERE id IN (
+        SELECT max(id) FROM results GROUP BY experiment_id, scheme, run_id);
+"""
+
+# columns of experiments and results that aggregate() can group by
+GROUP_COLUMNS = (
+    "scheme",
+    "data_dir",
+    "mode",
+    "flows",
+    "runtime",
+    "uplink_trace",
+    "downlink_trace",
+)
+
+
+def connect(db_path) -> sqlite3.Connection:
+    """Open the database at db_path, creating it and its tables if needed"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, SCHEMA_VERSION):
+        conn.close()
+        raise sqlite3.DatabaseError(
+            "%s has schema version %d, expected %d"
+            % (db_path, version, SCHEMA_VERSION)
+        )
+    # readers such as dashboards do not block the writing tests and analyses
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.executescript(SCHEMA)
+        conn.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+    return conn
+
+
+def experiment_id(conn, data_dir, metadata) -> int:
+    """Id of the experiment in data_dir with this metadata, added if the
+    data dir is new or its metadata changed"""
+    data_dir = path.abspath(data_dir)
+    metadata_json = json.dumps(metadata, sort_keys=True)
+    row = conn.execute(
+        "SELECT id FROM experiments WHERE data_dir = ? AND metadata = ? "
+        "ORDER BY id DESC LIMIT 1",
+        (data_dir, metadata_json),
+    ).fetchone()
+    if row is not None:
+        return row["id"]
+
+    trace_names = [
+        path.basename(metadata[trace]) if metadata.get(trace) else None
+        for trace in ["uplink_trace", "downlink_trace"]
+    ]
+    return conn.execute(
+        "INSERT INTO experiments (data_dir, recorded_at, mode, flows, runtime, "
+        "uplink_trace, downlink_trace, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            data_dir,
+            utils.utc_time(),
+            metadata.get("mode"),
+            metadata.get("flows"),
+            metadata.get("runtime"),
+        ]
+        + trace_names
+        + [metadata_json],
+    ).lastrowid
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def add_test_run(
+    conn,
+    data_dir,
+    metadata,
+    scheme,
+    run_id,
+    start_at=None,
+    end_at=None,
+    local_offset_ms=None,
+    remote_offset_ms=None,
+):
+    with conn:
+        conn.execute(
+            "INSERT INTO test_runs (experiment_id, scheme, run_id, recorded_at, "
+            "start_at, end_at, local_offset_ms, remote_offset_ms) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                experiment_id(conn, data_dir, metadata),
+                scheme,
+                run_id,
+                utils.utc_time(),
+                start_at,
+                end_at,
+                _float(local_offset_ms),
+                _float(remote_offset_ms),
+            ),
+        )
+
+
+def add_results(conn, data_dir, metadata, perf_data):
+    """Add the results of Plot.eval_performance: {scheme: {run_id: the dict
+    returned by TunnelGraph.run, or None for a run that failed}}"""
+    with conn:
+        exp_id = experiment_id(conn, data_dir, metadata)
+        recorded_at = utils.utc_time()
+        for scheme, runs in perf_data.items():
+            for run_id, result in runs.items():
+                if result is None:
+                    continue
+                result_id = conn.execute(
+                    "INSERT INTO results (experiment_id, scheme, run_id, "
+                    "recorded_at, throughput_mbps, delay_ms, loss_rate, "
+                    "duration_ms, stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        exp_id,
+                        scheme,
+                        int(run_id),
+                        recorded_at,
+                        _float(result["throughput"]),
+                        _float(result["delay"]),
+                        _float(result["loss"]),
+                        _float(result["duration"]),
+                        result["stats"],
+                    ),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO flow_results (result_id, flow, throughput_mbps, "
+                    "delay_ms, loss_rate) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            result_id,
+                            str(flow),
+                            _float(data["tput"]),
+                            _float(data["delay"]),
+                            _float(data["loss"]),
+                        )
+                        for flow, data in (result["flow_data"] or {}).items()
+                    ],
+                )
+
+
+def record(db_path, add, *args, **kwargs):
+    """Open db_path and call add (add_test_run or add_results) with the
+    connection and args. A database that cannot be written is reported
+    and skipped, as the data dir remains the record of the experiment."""
+    try:
+        conn = connect(db_path)
+        try:
+            add(conn, *args, **kwargs)
+        finally:
+            conn.close()
+    except sqlite3.Error as exception:
+        sys.stderr.write(
+            "Warning: failed to record results in %s (%s)\n" % (db_path, exception)
+        )
+
+
+def aggregate(conn, group_by=("scheme",), schemes=None, where=None, params=()):
+    """Summarize the latest result of every run grouped by group_by (see
+    GROUP_COLUMNS), optionally only for schemes and rows matching the SQL
+    condition where on the columns of experiments and results, with
+    params. Return a list of sqlite3.Rows with the group columns followed
+    by experiments, runs and the mean throughput_mbps, delay_ms and
+    loss_rate."""
+    for column in group_by:
+        if column not in GROUP_COLUMNS:
+            raise ValueError("cannot group results by %s" % column)
+
+    conditions = []
+    params = list(params)
+    if schemes:
+        conditions.append("scheme IN (%s)" % ", ".join("?" * len(schemes)))
+        params += schemes
+    if where:
+        conditions.append("(%s)" % where)
+
+    columns = ", ".join(group_by)
+    query = (
+        "SELECT %s, count(DISTINCT experiment_id) AS experiments, "
+        "count(*) AS runs, avg(throughput_mbps) AS throughput_mbps, "
+        "avg(delay_ms) AS delay_ms, avg(loss_rate) AS loss_rate "
+        "FROM latest_results JOIN experiments ON experiments.id = experiment_id"
+        % columns
+    )
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " GROUP BY %s ORDER BY %s" % (columns, columns)
+    return conn.execute(query, params).fetchall()
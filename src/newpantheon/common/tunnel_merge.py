@@ -0,0 +1,838 @@
+"""
+Joining and merging the logs of the tunnels.
+
+The ingress and egress logs of a tunnel are joined into the events of its
+tunnel log by pairing every received packet with the packet sent with its
+uid (TunnelJoin), and tunnel logs and the mm-link log are merged in
+timestamp order a block at a time (merge_blocks). merge_tunnel_logs.py
+writes the results as logs, in single and multiple mode; FusedMerge does
+both in one pass for analyses that read the raw logs directly.
+"""
+
+import sys
+
+import numpy as np
+
+from newpantheon.common import log_format
+
+MERGE_BLOCK_BYTES = 1 << 22  # bytes read from each log at a time
+MERGE_BLOCK_ROWS = 1 << 18  # events of a tunnel joined in memory yielded at a time
+STRAGGLER_MS = 5000  # in flight for longer, a sent packet leaves the window
+
+
+def parse_line(line):
+    (ts, uid, size) = line.split("-")
+    return (log_format.parse_ms(ts), int(uid), int(size))
+
+
+def read_tunnel_log(log_path):
+    """
+    Read the ingress or egress log of a tunnel in one go.
+
+    Return its first line (with the init timestamp) and the timestamps, uids
+    and sizes of its packets as arrays.
+    """
+    with log_format.open_log(log_path) as log:
+        first_line = log.readline().decode()
+        data = log.read()
+
+    return first_line, parse_block(data)
+
+
+def read_records(log_file):
+    """
+    Read the next block of complete lines of an ingress or egress log and
+    parse it as read_tunnel_log does. Return None at the end of the log.
+    """
+    data = log_file.read(MERGE_BLOCK_BYTES)
+    data += log_file.readline()
+    if not data:
+        return None
+    return parse_block(data)
+
+
+def parse_block(data):
+    """Parse the packets of an ingress or egress log (bytes) into arrays"""
+    records = parse_records(data)
+    if records is None:
+        # not in the plain "ts - uid - size" form: parse it line by line,
+        # exactly as before
+        records = ([], [], [])
+        for line in data.decode().splitlines():
+            for column, value in zip(records, parse_line(line)):
+                column.append(value)
+        records = (
+            np.array(records[0], dtype=np.int64),
+            np.array(records[1], dtype=np.int64),
+            np.array(records[2], dtype=np.int64),
+        )
+    return records
+
+
+def parse_records(data):
+    """
+    Parse "ts - uid - size" lines (bytes) into arrays, giving the same
+    values as parse_line. Return None if any line is not exactly of that
+    form.
+    """
+    if data and not data.endswith(b"\n"):
+        data += b"\n"
+    a = np.frombuffer(data, dtype=np.uint8)
+
+    # every line holds two " - " separators before its newline
+    seps = np.flatnonzero((a == 45) | (a == 10))
+    lines = seps.size // 3
+    if seps.size != 3 * lines or np.any(a[seps] != np.tile([45, 45, 10], lines)):
+        return None
+    seps = seps.reshape(lines, 3)
+    dashes = seps[:, :2]
+    if lines and (
+        dashes.min() < 1
+        or np.any(a[dashes - 1] != 32)
+        or np.any(a[dashes + 1] != 32)
+    ):
+        return None
+
+    line_start = np.concatenate([[0], seps[:-1, 2] + 1])
+    ts = log_format.parse_fields(a, line_start, dashes[:, 0] - 1, decimals=3)
+    uid = log_format.parse_fields(a, dashes[:, 0] + 2, dashes[:, 1] - 1)
+    size = log_format.parse_fields(a, dashes[:, 1] + 2, seps[:, 2])
+    if ts is None or uid is None or size is None:
+        return None
+    return ts, uid, size
+
+
+def merge_positions(send_ts, recv_ts):
+    """
+    Return the output positions of the sent and received packets when the
+    two logs are merged by always writing the earlier event next (the sent
+    packet on a tie), as the line-by-line merge did.
+    """
+    if np.all(send_ts[1:] >= send_ts[:-1]) and np.all(recv_ts[1:] >= recv_ts[:-1]):
+        send_pos = np.arange(send_ts.size)
+        send_pos += np.searchsorted(recv_ts, send_ts, side="left")
+        recv_pos = np.arange(recv_ts.size)
+        recv_pos += np.searchsorted(send_ts, recv_ts, side="right")
+        return send_pos, recv_pos
+
+    # out-of-order logs do not merge like a sort; walk them instead
+    send_pos = np.zeros(send_ts.size, dtype=np.int64)
+    recv_pos = np.zeros(recv_ts.size, dtype=np.int64)
+    send_ts = send_ts.tolist()
+    recv_ts = recv_ts.tolist()
+    i = j = 0
+    while i < len(send_ts) or j < len(recv_ts):
+        if j == len(recv_ts) or (i < len(send_ts) and send_ts[i] <= recv_ts[j]):
+            send_pos[i] = i + j
+            i += 1
+        else:
+            recv_pos[j] = i + j
+            j += 1
+    return send_pos, recv_pos
+
+
+def join_tunnel_logs(
+    ingress_log, egress_log, i_clock_offset=None, e_clock_offset=None
+):
+    """
+    Join the ingress and egress logs of a tunnel into the events of its
+    tunnel log.
+
+    Return the init timestamp of the tunnel log, its events in order as the
+    arrays ts, is_recv, size and delay (zero for sent packets), all times in
+    integer microseconds, and None,
+    or, if a received packet cannot be paired with a sent one, the events
+    before it and a warning about it.
+    """
+    # retrieve initial timestamp of sender from the first line
+    line, (send_ts, send_uid, send_size) = read_tunnel_log(egress_log)
+    if not line:
+        sys.exit("Warning: egress log is empty\n")
+
+    send_init_ts = calibrated_init_ts(line, e_clock_offset)
+    min_init_ts = send_init_ts
+
+    # retrieve initial timestamp of receiver from the first line
+    line, (recv_ts, recv_uid, recv_size) = read_tunnel_log(ingress_log)
+    if not line:
+        sys.exit("Warning: ingress log is empty\n")
+
+    recv_init_ts = calibrated_init_ts(line, i_clock_offset)
+
+    if recv_init_ts < min_init_ts:
+        min_init_ts = recv_init_ts
+
+    # timestamp calibration to ensure non-negative timestamps
+    send_ts = send_ts + (send_init_ts - min_init_ts)
+    recv_ts = recv_ts + (recv_init_ts - min_init_ts)
+
+    # pair every received packet with the last packet sent with its uid
+    order = np.argsort(send_uid, kind="stable")
+    sorted_uid = send_uid[order]
+    paired = np.searchsorted(sorted_uid, recv_uid, side="right") - 1
+    found = paired >= 0
+    found[found] = sorted_uid[paired[found]] == recv_uid[found]
+    paired = order[np.maximum(paired, 0)] if send_uid.size else paired.clip(0)
+
+    send_pos, recv_pos = merge_positions(send_ts, recv_ts)
+    events = send_ts.size + recv_ts.size
+
+    # the merge stops at the first packet that cannot be paired
+    error = None
+    bad = ~found
+    bad[found] = send_size[paired[found]] != recv_size[found]
+    if np.any(bad):
+        j = int(np.argmax(bad))
+        events = int(recv_pos[j])
+        sent_size = send_size[paired[j]] if found[j] else None
+        error = unpaired_warning(recv_uid[j], sent_size, recv_size[j])
+
+    # lay the events out in output order
+    is_recv = np.zeros(send_ts.size + recv_ts.size, dtype=bool)
+    is_recv[recv_pos] = True
+    ts = np.empty(is_recv.size, dtype=np.int64)
+    ts[send_pos] = send_ts
+    ts[recv_pos] = recv_ts
+    size = np.empty(is_recv.size, dtype=np.int64)
+    size[send_pos] = send_size
+    size[recv_pos] = recv_size
+    delay = np.zeros(is_recv.size, dtype=np.int64)
+    delay[recv_pos[found]] = recv_ts[found] - send_ts[paired[found]]
+
+    events = (ts[:events], is_recv[:events], size[:events], delay[:events])
+    return min_init_ts, events, error
+
+
+def calibrated_init_ts(line, clock_offset=None):
+    """
+    Return the init timestamp on the first line of an ingress or egress
+    log, moved by a clock offset in ms (rounded to the microsecond), in
+    microseconds.
+    """
+    init_ts = log_format.parse_ms(line.rsplit(":", 1)[-1])
+    if clock_offset is not None:
+        init_ts += log_format.parse_ms(repr(clock_offset))
+    return init_ts
+
+
+def unpaired_warning(uid, send_size, recv_size):
+    """Warn about a received packet that no sent packet pairs with"""
+    if send_size is None:
+        return "Warning: received a packet with nonexistent uid %s\n" % uid
+    return (
+        "Warning: packet %s came into tunnel with size %s "
+        "but left with size %s\n" % (uid, send_size, recv_size)
+    )
+
+
+class MergeSource:
+    """
+    The events of one log to merge, read a block at a time.
+
+    Buffers the calibrated timestamps of the pending events, a tuple of
+    arrays with one row per event (what to write or report about it), and
+    their merge keys: the running maximum of the timestamps. Popping the
+    smallest (ts, index) head off a heap, as multiple mode used to, yields
+    the events in the order of their (key, index) with every log's own
+    order kept on ties.
+
+    Subclasses implement read_block(), which returns the timestamps and
+    rows of the next events, or None at the end of the log.
+    """
+
+    def __init__(self, index):
+        self.index = index  # -1 for the mm-link log
+        self.max_ts = np.iinfo(np.int64).min
+        self.done = False
+        self.ts = self.key = np.zeros(0, dtype=np.int64)
+        self.rows = ()
+
+    def fill(self):
+        """Read blocks until some events are pending or the log ends"""
+        while self.ts.size == 0 and not self.done:
+            block = self.read_block()
+            if block is None:
+                self.done = True
+                break
+
+            self.ts, self.rows = block
+            self.key = np.maximum.accumulate(np.append(self.max_ts, self.ts))[1:]
+            if self.key.size:
+                self.max_ts = self.key[-1]
+
+    def pop(self, n):
+        """Remove and return the first n pending events"""
+        events = (self.ts[:n], self.key[:n], tuple(row[:n] for row in self.rows))
+        self.ts, self.key = self.ts[n:], self.key[n:]
+        self.rows = tuple(row[n:] for row in self.rows)
+        return events
+
+
+class LogSource(MergeSource):
+    """
+    Lines of a tunnel log or of the mm-link log, with the rest of every
+    output line after its timestamp as (chars, keep) rows and the flow id
+    of every line (0 for the mm-link log).
+    """
+
+    def __init__(self, log_file, index, init_ts_delta):
+        super().__init__(index)
+        self.log_file = log_file
+        self.init_ts_delta = init_ts_delta
+        self.suffix = b"" if index == -1 else b" %d" % (index + 1)
+
+    def read_block(self):
+        data = self.log_file.read(MERGE_BLOCK_BYTES)
+        data += self.log_file.readline()
+        if not data:
+            return None
+        if not data.endswith(b"\n"):
+            data += b"\n"
+
+        ts, tail = parse_events(
+            data, self.index == -1, self.init_ts_delta, self.suffix
+        )
+        return ts, tail + (np.full(ts.size, self.index + 1),)
+
+
+class LinkChunkSource(LogSource):
+    """Delivery opportunities of the mm-link log as LogChunk columns"""
+
+    def __init__(self, log_file, init_ts_delta):
+        super().__init__(log_file, -1, init_ts_delta)
+
+    def read_block(self):
+        block = super().read_block()
+        if block is None:
+            return None
+
+        # parsed from the lines multiple mode would write for them
+        ts, (chars, keep, _) = block
+        return ts, tuple(log_format.parse_chunk(format_lines(ts, (chars, keep))))
+
+
+class TunnelSource(MergeSource):
+    """
+    Events of a tunnel joined by a TunnelJoin, as LogChunk columns. Writes
+    the warning about a packet that could not be paired once the events
+    end.
+    """
+
+    def __init__(self, index, tunnel, init_ts_delta):
+        super().__init__(index)
+        self.tunnel = tunnel
+        self.events = iter(tunnel)
+        self.init_ts_delta = init_ts_delta
+
+    def read_block(self):
+        events = next(self.events, None)
+        if events is None:
+            if self.tunnel.error is not None:
+                sys.stderr.write(self.tunnel.error)
+            return None
+
+        ts, is_recv, size, delay = events
+        ts = ts + self.init_ts_delta
+        event = np.where(is_recv, log_format.DEPARTURE, log_format.ARRIVAL)
+        flow = np.full(ts.size, self.index + 1)
+        return ts, (ts, event.astype(np.int8), size, delay, flow)
+
+
+def parse_events(data, link, init_ts_delta, suffix):
+    """
+    Parse a block of complete lines of a tunnel log (or of the mm-link log,
+    keeping its delivery opportunities only) into calibrated timestamps and
+    the rest of each output line after the timestamp.
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(a == 10)
+    starts = np.append(0, ends[:-1] + 1)
+    keep = a[starts] != 35
+    if link:
+        hashes = np.append(0, np.cumsum(a == 35))
+        keep &= hashes[ends] > hashes[starts]
+
+    # lines of single-space separated plain tokens are parsed in bulk; any
+    # other whitespace goes through the line-by-line rules of the old merge
+    odd = np.flatnonzero(((a < 32) & (a != 10)) | (a > 126))
+    odd = np.append(odd, np.flatnonzero((a[1:] == 32) & (a[:-1] == 32)))
+    odd_lines = np.searchsorted(ends, odd)
+    starts, ends = starts[keep], ends[keep]
+    if np.any(keep[odd_lines]) or np.any(a[starts] == 32) or np.any(a[ends - 1] == 32):
+        return parse_events_slowly(data, link, init_ts_delta, suffix)
+
+    spaces = np.flatnonzero(a == 32)
+    first = np.searchsorted(spaces, starts)
+    if np.any(first >= spaces.size):
+        return parse_events_slowly(data, link, init_ts_delta, suffix)
+    first = spaces[first]
+    ts = None
+    if np.all(first < ends):
+        ts = log_format.parse_fields(a, starts, first, decimals=3)
+    if ts is None:
+        return parse_events_slowly(data, link, init_ts_delta, suffix)
+    ts += init_ts_delta
+
+    rows = ts.size
+    is_opportunity = a[first + 1] == 35
+    if not link:
+        if np.any(is_opportunity):
+            return parse_events_slowly(data, link, init_ts_delta, suffix)
+        tail = log_format.slice_chars(a, first, ends)
+        return ts, log_format.hstack_chars(
+            [tail, log_format.constant_chars(suffix, rows)]
+        )
+
+    size = None
+    if np.all(is_opportunity) and np.all(a[first + 2] == 32):
+        size = log_format.parse_fields(a, first + 3, ends)
+    if size is None:
+        return parse_events_slowly(data, link, init_ts_delta, suffix)
+    # the tunnels add 4 bytes to the packets that mm-link records
+    return ts, log_format.hstack_chars(
+        [log_format.constant_chars(b" # ", rows), log_format.integer_chars(size - 4)]
+    )
+
+
+def parse_events_slowly(data, link, init_ts_delta, suffix):
+    """Same as parse_events, for lines of any form"""
+    text = data.decode().replace("\r\n", "\n").replace("\r", "\n")
+    ts = []
+    tails = []
+    for line in text.split("\n")[:-1]:
+        if line.startswith("#"):
+            continue
+        # the mm-link log only contributes its delivery opportunities
+        if link and "#" not in line:
+            continue
+
+        line_list = line.strip().split()
+        ts.append(log_format.parse_ms(line_list[0]) + init_ts_delta)
+        if line_list[1] == "#":
+            line_list[2] = str(int(line_list[2]) - 4)
+        tails.append((" " + " ".join(line_list[1:])).encode() + suffix)
+
+    return np.array(ts, dtype=np.int64), log_format.bytes_chars(tails)
+
+
+def format_lines(ts, tail):
+    """Format events as "<ts with 3 decimals><tail>" lines (bytes)"""
+    ts_chars = log_format.fixed_point_chars(ts)
+    newline = log_format.constant_chars(b"\n", ts.size)
+    return log_format.join_chars([ts_chars, tail, newline])
+
+
+def merge_blocks(sources):
+    """
+    Merge the events of every source, a block at a time: an event is
+    yielded once no event still unread can precede it. Yield the
+    timestamps and rows of each block of merged events.
+    """
+    while True:
+        for source in sources:
+            source.fill()
+
+        # unread events of a source come after its last pending key, so
+        # the smallest (last key, index) bounds what is safe to yield
+        bound = min(
+            ((source.key[-1], source.index) for source in sources if not source.done),
+            default=None,
+        )
+
+        events = []
+        for source in sources:
+            n = source.ts.size
+            if bound is not None:
+                side = "right" if source.index <= bound[1] else "left"
+                n = np.searchsorted(source.key, bound[0], side=side)
+            if n:
+                events.append(source.pop(n))
+
+        if events:
+            ts, key, rows = zip(*events)
+            # the sources are in index order, so a stable sort by key alone
+            # breaks ties by index and then by position in the log
+            order = np.argsort(np.concatenate(key), kind="stable")
+            rows = [concatenate_rows(row) for row in zip(*rows)]
+            yield np.concatenate(ts)[order], tuple(row[order] for row in rows)
+
+        if bound is None:
+            break
+
+
+def concatenate_rows(arrays):
+    """Concatenate arrays row-wise, padding 2-D ones to the widest"""
+    if arrays[0].ndim == 1:
+        return np.concatenate(arrays)
+    width = max(array.shape[1] for array in arrays)
+    return np.concatenate(
+        [np.pad(array, ((0, 0), (0, width - array.shape[1]))) for array in arrays]
+    )
+
+
+class UnorderedUids(Exception):
+    """The uids of an egress log do not increase"""
+
+
+class WindowedJoin:
+    """
+    Pairs the received packets of a tunnel with the packets it sent while
+    the egress log is read a block at a time, ahead of the ingress log just
+    as far as the uids of the received packets need.
+
+    The tunnels number the packets they send in increasing order, so the
+    sent packets are kept in arrays sorted by uid: a window of the packets
+    in flight, which loses each packet as it is received, and the
+    stragglers, packets still in flight STRAGGLER_MS after being sent (lost
+    ones, mostly), moved aside so that the window stays small. Memory is
+    thus bounded by the packets in flight and lost rather than by all the
+    packets of the log. A packet received again after its pair was evicted
+    is looked up in the egress log again.
+
+    Raises UnorderedUids as soon as the uids of the egress log stop
+    increasing, as the last packet sent with a uid may then be further on.
+    """
+
+    def __init__(self, egress_log, egress_file, init_ts_delta):
+        self.egress_log = egress_log
+        self.egress_file = egress_file
+        self.init_ts_delta = init_ts_delta
+        self.last_uid = None
+        self.sent = []  # blocks of (ts, size) not yet merged
+        empty = np.zeros(0, dtype=np.int64)
+        self.window = self.stragglers = (empty,) * 3  # (uid, ts, size)
+
+    def read_egress(self):
+        """Read the next block of sent packets; return False at the end"""
+        records = read_records(self.egress_file)
+        if records is None:
+            return False
+
+        ts, uid, size = records
+        ts = ts + self.init_ts_delta
+        self.check_uids(uid)
+        self.sent.append((ts, size))
+        self.window = tuple(map(np.concatenate, zip(self.window, (uid, ts, size))))
+        return True
+
+    def check_uids(self, uid):
+        if uid.size:
+            if np.any(uid[1:] <= uid[:-1]) or (
+                self.last_uid is not None and uid[0] <= self.last_uid
+            ):
+                raise UnorderedUids(self.egress_log)
+            self.last_uid = uid[-1]
+
+    def check_rest(self):
+        """Read the rest of the egress log only to check its uids"""
+        while True:
+            records = read_records(self.egress_file)
+            if records is None:
+                break
+            self.check_uids(records[1])
+
+    def pair(self, recv_uid, recv_ts):
+        """
+        Return the timestamps and sizes of the sent packets that pair with
+        received ones, and which were found.
+        """
+        if recv_uid.size:
+            needed = recv_uid.max()
+            while self.last_uid is None or self.last_uid < needed:
+                if not self.read_egress():
+                    break
+
+        send_ts = np.zeros(recv_uid.size, dtype=np.int64)
+        send_size = np.zeros(recv_uid.size, dtype=np.int64)
+        found = np.zeros(recv_uid.size, dtype=bool)
+        matched = take_pairs(self.window, recv_uid, send_ts, send_size, found)
+        if not np.all(found):
+            take_pairs(self.stragglers, recv_uid, send_ts, send_size, found)
+        if not np.all(found):
+            self.look_up_again(recv_uid, send_ts, send_size, found)
+
+        # evict the packets received, and keep the stragglers aside
+        keep = np.ones(self.window[0].size, dtype=bool)
+        keep[matched[matched >= 0]] = False
+        if recv_ts.size:
+            horizon = recv_ts.min() - STRAGGLER_MS * log_format.US_PER_MS
+            late = keep & (self.window[1] < horizon)
+            if np.any(late):
+                self.stragglers = tuple(
+                    np.concatenate([aside, column[late]])
+                    for aside, column in zip(self.stragglers, self.window)
+                )
+                keep &= ~late
+        self.window = tuple(column[keep] for column in self.window)
+
+        return send_ts, send_size, found
+
+    def look_up_again(self, recv_uid, send_ts, send_size, found):
+        """Look up the uids not found in the egress log again"""
+        last_missing = recv_uid[~found].max()
+        with log_format.open_log(self.egress_log) as egress_file:
+            egress_file.readline()
+            while True:
+                records = read_records(egress_file)
+                if records is None:
+                    break
+                ts, uid, size = records
+                ts = ts + self.init_ts_delta
+                take_pairs((uid, ts, size), recv_uid, send_ts, send_size, found)
+                if uid.size and uid[-1] >= last_missing:
+                    break
+
+
+def take_pairs(packets, recv_uid, send_ts, send_size, found):
+    """
+    Pair the received packets not yet found with the sent packets (uid, ts,
+    size) sorted by uid, in place. Return where each received uid is in the
+    sent packets, or -1.
+    """
+    sent_uid, ts, size = packets
+    where = np.full(recv_uid.size, -1, dtype=np.int64)
+    if sent_uid.size:
+        where = np.searchsorted(sent_uid, recv_uid)
+        where[where == sent_uid.size] = 0
+        where[sent_uid[where] != recv_uid] = -1
+
+    hit = (where >= 0) & ~found
+    send_ts[hit] = ts[where[hit]]
+    send_size[hit] = size[where[hit]]
+    found |= hit
+    return where
+
+
+class SentSource(MergeSource):
+    """Packets sent into a tunnel, read by a WindowedJoin"""
+
+    def __init__(self, join):
+        super().__init__(0)
+        self.join = join
+
+    def read_block(self):
+        while not self.join.sent:
+            if not self.join.read_egress():
+                return None
+
+        ts, size = self.join.sent.pop(0)
+        no = np.zeros(ts.size, dtype=bool)
+        return ts, (no, size, np.zeros(ts.size, dtype=np.int64), no)
+
+
+class ReceivedSource(MergeSource):
+    """
+    Packets received from a tunnel, paired by a WindowedJoin. A received
+    packet that cannot be paired ends the log as an event that stops the
+    merge, and sets error.
+    """
+
+    def __init__(self, ingress_file, init_ts_delta, join):
+        super().__init__(1)
+        self.ingress_file = ingress_file
+        self.init_ts_delta = init_ts_delta
+        self.join = join
+        self.error = None
+
+    def read_block(self):
+        records = None
+        if self.error is None:
+            records = read_records(self.ingress_file)
+        if records is None:
+            return None
+
+        ts, uid, size = records
+        ts = ts + self.init_ts_delta
+        send_ts, send_size, found = self.join.pair(uid, ts)
+
+        stop = np.zeros(ts.size, dtype=bool)
+        bad = ~found
+        bad[found] = send_size[found] != size[found]
+        if np.any(bad):
+            j = int(np.argmax(bad))
+            sent_size = send_size[j] if found[j] else None
+            self.error = unpaired_warning(uid[j], sent_size, size[j])
+            ts, size, send_ts, stop = (
+                column[: j + 1] for column in (ts, size, send_ts, stop)
+            )
+            stop[j] = True
+
+        return ts, (np.ones(ts.size, dtype=bool), size, ts - send_ts, stop)
+
+
+class TunnelJoin:
+    """
+    The ingress and egress logs of a tunnel, joined into the events of its
+    tunnel log a block at a time.
+
+    init_ts is the smaller of the init timestamps of the two logs, moved by
+    their clock offsets, in microseconds. Iterating yields the events in
+    order as the arrays ts (from init_ts), is_recv, size and delay (zero
+    for sent packets), all times in integer microseconds. A received packet
+    that cannot be paired ends the events and sets error to a warning.
+
+    The packets are paired by a WindowedJoin (windowed()). If the uids of
+    the egress log turn out not to increase, the rest of the events come
+    from pairing them with every sent packet in memory (join_tunnel_logs),
+    which pairs the events already yielded alike unless a uid is repeated.
+    """
+
+    def __init__(
+        self, ingress_log, egress_log, i_clock_offset=None, e_clock_offset=None
+    ):
+        self.ingress_log = ingress_log
+        self.egress_log = egress_log
+        self.i_clock_offset = i_clock_offset
+        self.e_clock_offset = e_clock_offset
+        self.error = None
+
+        # retrieve initial timestamp of sender from the first line
+        with log_format.open_log(egress_log) as egress_file:
+            line = egress_file.readline().decode()
+        if not line:
+            sys.exit("Warning: egress log is empty\n")
+        self.send_init_ts = calibrated_init_ts(line, e_clock_offset)
+
+        # retrieve initial timestamp of receiver from the first line
+        with log_format.open_log(ingress_log) as ingress_file:
+            line = ingress_file.readline().decode()
+        if not line:
+            sys.exit("Warning: ingress log is empty\n")
+        self.recv_init_ts = calibrated_init_ts(line, i_clock_offset)
+
+        self.init_ts = min(self.send_init_ts, self.recv_init_ts)
+
+    def __iter__(self):
+        joined = 0
+        try:
+            for events in self.windowed():
+                joined += events[0].size
+                yield events
+        except UnorderedUids:
+            # pair the packets with every sent packet in memory instead
+            _, events, self.error = join_tunnel_logs(
+                self.ingress_log,
+                self.egress_log,
+                self.i_clock_offset,
+                self.e_clock_offset,
+            )
+            for i in range(joined, events[0].size, MERGE_BLOCK_ROWS):
+                yield tuple(column[i : i + MERGE_BLOCK_ROWS] for column in events)
+
+    def windowed(self):
+        """
+        Yield the events as iterating does, pairing the packets with a
+        WindowedJoin only; raises UnorderedUids
+        """
+        egress_file = log_format.open_log(self.egress_log)
+        ingress_file = log_format.open_log(self.ingress_log)
+        try:
+            egress_file.readline()
+            ingress_file.readline()
+
+            # timestamp calibration to ensure non-negative timestamps
+            join = WindowedJoin(
+                self.egress_log, egress_file, self.send_init_ts - self.init_ts
+            )
+            received = ReceivedSource(
+                ingress_file, self.recv_init_ts - self.init_ts, join
+            )
+
+            for ts, (is_recv, size, delay, stop) in merge_blocks(
+                [SentSource(join), received]
+            ):
+                # the join stops at the first packet that cannot be paired
+                n = int(np.argmax(stop)) if np.any(stop) else ts.size
+                yield ts[:n], is_recv[:n], size[:n], delay[:n]
+                if n < ts.size:
+                    join.check_rest()
+                    break
+        finally:
+            egress_file.close()
+            ingress_file.close()
+
+        self.error = received.error
+
+
+def read_init_ts(log_file):
+    """Return the timestamp of the "# init timestamp" line, or None"""
+    while True:
+        line = log_file.readline()
+        if not line:
+            return None
+        if line.startswith(b"# init timestamp"):
+            return log_format.parse_ms(line.split(b":")[1])
+
+
+class FusedMerge:
+    """
+    Merge the raw ingress and egress logs of every tunnel and the mm-link
+    log in one pass, into the events that multiple mode would write after
+    single mode, without writing the tunnel log of each tunnel in between.
+    Every tunnel is joined a block at a time as it is merged (TunnelJoin),
+    so memory stays bounded as in single mode.
+
+    Iterating yields the merged events as LogChunks, with the values that
+    reading the merged log would give, and writes that log to output_log
+    along the way if one is given. Flows are given as dicts of keyword
+    arguments of TunnelJoin. init_ts (in microseconds, like every
+    timestamp of the chunks) is set once iteration starts.
+    """
+
+    def __init__(self, flows, link_log=None, output_log=None):
+        self.flows = flows
+        self.link_log = link_log
+        self.output_log = output_log
+        self.init_ts = None
+
+    def __iter__(self):
+        tunnels = [TunnelJoin(**flow) for flow in self.flows]
+
+        link_log = None
+        init_ts = [tunnel.init_ts for tunnel in tunnels]
+        if self.link_log:
+            link_log = log_format.open_log(self.link_log)
+            link_init_ts = read_init_ts(link_log)
+            if link_init_ts is None:
+                sys.exit("Warning: link log %s is empty" % self.link_log)
+            init_ts.append(link_init_ts)
+        min_init_ts = self.init_ts = min(init_ts)
+
+        sources = []
+        if link_log:
+            source = LinkChunkSource(link_log, link_init_ts - min_init_ts)
+            source.fill()
+            if source.done:
+                sys.exit("Warning: no delivery opportunities found\n")
+            sources.append(source)
+
+        for i, tunnel in enumerate(tunnels):
+            source = TunnelSource(i, tunnel, tunnel.init_ts - min_init_ts)
+            source.fill()
+            if source.done:
+                sys.exit(
+                    "Warning: tunnel %d does not contain any arrival or "
+                    "departure events\n" % (i + 1)
+                )
+            sources.append(source)
+
+        output_log = None
+        if self.output_log:
+            output_log = log_format.open_log(self.output_log, "w")
+            header = "# init timestamp: %s\n" % log_format.format_ms(min_init_ts)
+            output_log.write(header)
+            index = log_format.LogIndexBuilder(len(header))
+
+        for _, columns in merge_blocks(sources):
+            chunk = log_format.LogChunk(*columns)
+            if output_log:
+                lines = log_format.format_chunk(chunk)
+                output_log.write(lines)
+                index.add_lines(chunk.ts, chunk.flow, lines)
+            yield chunk
+
+        if link_log:
+            link_log.close()
+        if output_log:
+            output_log.close()
+            index.finish().save(self.output_log)
@@ -1,4 +1,5 @@
 import argparse
+import os
 from os import path
 import sys
 import yaml
@@ -67,6 +68,31 @@ def parse_test_shared(parser):
         action="store_true",
         help="clean up using pkill (send SIGKILL when necessary) if there were errors during tests",
     )
+    parser.add_argument(
+        "--live-stats",
+        action="store_true",
+        help="print rolling throughput, delay and loss of every flow during "
+        "the test and keep them in DIR/<scheme>_datalink_run<ID>_live.json",
+    )
+    parser.add_argument(
+        "--fused-merge",
+        action="store_true",
+        help="write the datalink and acklink logs straight from the raw "
+        "tunnel logs in one pass, without a merged log per flow",
+    )
+    parser.add_argument(
+        "--compress-logs",
+        choices=["gz", "bz2", "xz", "zst", "lz4"],
+        help="compress the tunnel and link logs of every run once it is done "
+        "(zst and lz4 need the zstandard and lz4 packages)",
+    )
+    parser.add_argument(
+        "--results-db",
+        metavar="DB",
+        default=os.environ.get("PANTHEON_RESULTS_DB"),
+        help="also record the start and end of every run in this SQLite "
+        "results database (default: $PANTHEON_RESULTS_DB, if set)",
+    )
 
 
 def parse_test_local(parser):
@@ -141,6 +167,14 @@ def parse_test_remote(parser):
         metavar="HOST",
         help="address of an NTP server to query clock offset",
     )
+    parser.add_argument(
+        "--download-streams",
+        metavar="N",
+        type=int,
+        default=4,
+        help="concurrent ssh sessions that download the compressed tunnel "
+        "logs of each run from the remote side (default 4)",
+    )
     parser.add_argument(
         "--local-desc", metavar="DESC", help="extra description of the local side"
     )
@@ -182,6 +216,8 @@ def verify_test_args(args):
         sys.exit('flow cannot be negative')
     if args.interval < 0:
         sys.exit('interval cannot be negative')
+    if getattr(args, 'download_streams', 1) < 1:
+        sys.exit('download streams must be positive')
     if args.flows > 0 and args.interval > 0:
         if (args.flows - 1) * args.interval > args.runtime:
             sys.exit('interval time between flows is too long to be '
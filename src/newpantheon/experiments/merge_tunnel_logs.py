@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import argparse
-import heapq
+import multiprocessing
 import sys
 
+import numpy as np
+
+from newpantheon.common import log_format, tunnel_merge
+
+WRITE_LINES = 1 << 20  # lines joined per write in single mode
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -76,220 +82,180 @@ def parse_arguments():
         required=True,
         help="output log after merging",
     )
+    multiple_parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the output log in the binary columnar format",
+    )
+
+    # subparser for convert mode
+    convert_parser = subparsers.add_parser(
+        "convert",
+        help="convert a merged tunnel log to the binary columnar format",
+    )
+    convert_parser.add_argument(
+        "text_log", metavar="TEXT-LOG", help="tunnel log written by multiple mode"
+    )
+    convert_parser.add_argument(
+        "-o",
+        action="store",
+        metavar="OUTPUT-LOG",
+        dest="output_log",
+        required=True,
+        help="columnar log after conversion",
+    )
+
+    # subparser for index mode
+    index_parser = subparsers.add_parser(
+        "index",
+        help="index existing merged tunnel logs, as multiple mode does for "
+        "the logs it writes",
+    )
+    index_parser.add_argument(
+        "logs",
+        metavar="TUNNEL-LOG",
+        nargs="+",
+        help="text or columnar tunnel logs written by multiple mode",
+    )
 
     return parser.parse_args()
 
 
-def parse_line(line):
-    (ts, uid, size) = line.split("-")
-    return (float(ts), int(uid), int(size))
+def format_events(ts, is_recv, size, delay):
+    """Format "ts + size" and "ts - size delay" lines"""
+    ts_chars = log_format.fixed_point_chars(ts)
+    delay_chars = log_format.fixed_point_chars(delay)
+
+    rows = ts.size
+    event = np.full((rows, 3), 32, dtype=np.uint8)
+    event[:, 1] = np.where(is_recv, 45, 43)
+    space = log_format.constant_chars(b" ", rows)
+    # the delay and the space before it only belong to received packets
+    delay_chars[1][~is_recv] = False
+    delay_space = (space[0], is_recv[:, None].copy())
+    return log_format.join_chars(
+        [
+            ts_chars,
+            (event, np.ones(event.shape, dtype=bool)),
+            log_format.integer_chars(size),
+            delay_space,
+            delay_chars,
+            log_format.constant_chars(b"\n", rows),
+        ]
+    ).decode()
 
 
 def single_mode(args):
-    recv_log = open(args.ingress_log)
-    send_log = open(args.egress_log)
-    output_log = open(args.output_log, "w")
-
-    # retrieve initial timestamp of sender from the first line
-    line = send_log.readline()
-    if not line:
-        sys.exit("Warning: egress log is empty\n")
-
-    send_init_ts = float(line.rsplit(":", 1)[-1])
-    if args.e_clock_offset is not None:
-        send_init_ts += args.e_clock_offset
-
-    min_init_ts = send_init_ts
-
-    # retrieve initial timestamp of receiver from the first line
-    line = recv_log.readline()
-    if not line:
-        sys.exit("Warning: ingress log is empty\n")
-
-    recv_init_ts = float(line.rsplit(":", 1)[-1])
-    if args.i_clock_offset is not None:
-        recv_init_ts += args.i_clock_offset
-
-    if recv_init_ts < min_init_ts:
-        min_init_ts = recv_init_ts
-
-    output_log.write("# init timestamp: %.3f\n" % min_init_ts)
-
-    # timestamp calibration to ensure non-negative timestamps
-    send_cal = send_init_ts - min_init_ts
-    recv_cal = recv_init_ts - min_init_ts
-
-    # construct a hash table using uid as keys
-    send_pkts = {}
-    for line in send_log:
-        (send_ts, send_uid, send_size) = parse_line(line)
-        send_pkts[send_uid] = (send_ts + send_cal, send_size)
-
-    send_log.seek(0)
-    send_log.readline()
-
-    # merge two sorted logs into one
-    send_l = send_log.readline()
-    if send_l:
-        (send_ts, send_uid, send_size) = parse_line(send_l)
-
-    recv_l = recv_log.readline()
-    if recv_l:
-        (recv_ts, recv_uid, recv_size) = parse_line(recv_l)
-
-    while send_l or recv_l:
-        if send_l:
-            send_ts_cal = send_ts + send_cal
-        if recv_l:
-            recv_ts_cal = recv_ts + recv_cal
-
-        if (send_l and recv_l and send_ts_cal <= recv_ts_cal) or not recv_l:
-            output_log.write("%.3f + %s\n" % (send_ts_cal, send_size))
-            send_l = send_log.readline()
-            if send_l:
-                (send_ts, send_uid, send_size) = parse_line(send_l)
-        elif (send_l and recv_l and send_ts_cal > recv_ts_cal) or not send_l:
-            if recv_uid in send_pkts:
-                (paired_send_ts, paired_send_size) = send_pkts[recv_uid]
-                # inconsistent packet size
-                if paired_send_size != recv_size:
-                    sys.exit(
-                        "Warning: packet %s came into tunnel with size %s "
-                        "but left with size %s\n"
-                        % (recv_uid, paired_send_size, recv_size)
-                    )
-            else:
-                # nonexistent packet
-                sys.exit(
-                    "Warning: received a packet with nonexistent " "uid %s\n" % recv_uid
-                )
-
-            delay = recv_ts_cal - paired_send_ts
-            output_log.write("%.3f - %s %.3f\n" % (recv_ts_cal, recv_size, delay))
-            recv_l = recv_log.readline()
-            if recv_l:
-                (recv_ts, recv_uid, recv_size) = parse_line(recv_l)
-
-    recv_log.close()
-    send_log.close()
-    output_log.close()
+    try:
+        join_windowed(args)
+    except tunnel_merge.UnorderedUids:
+        # pair the packets with every sent packet in memory instead
+        join_in_memory(args)
 
 
-def push_to_heap(heap, index, log_file, init_ts_delta):
-    line = None
+def join_in_memory(args):
+    output_log = log_format.open_log(args.output_log, "w")
 
-    while True:
-        line = log_file.readline()
-        if not line:
-            break
+    min_init_ts, events, error = tunnel_merge.join_tunnel_logs(
+        args.ingress_log, args.egress_log, args.i_clock_offset, args.e_clock_offset
+    )
+    output_log.write("# init timestamp: %s\n" % log_format.format_ms(min_init_ts))
 
-        if line.startswith("#"):
-            continue
+    ts, is_recv, size, delay = events
+    for i in range(0, ts.size, WRITE_LINES):
+        j = i + WRITE_LINES
+        output_log.write(format_events(ts[i:j], is_recv[i:j], size[i:j], delay[i:j]))
+    output_log.close()
 
-        # if log_file is mm-link-log
-        if index == -1:
-            # find the next delivery opportunity
-            if "#" in line:
-                break
-        else:
-            break
+    if error is not None:
+        sys.exit(error)
 
-    if line:
-        line_list = line.strip().split()
-        calibrated_ts = float(line_list[0]) + init_ts_delta
 
-        line_list[0] = "%.3f" % calibrated_ts
-        if line_list[1] == "#":
-            line_list[2] = str(int(line_list[2]) - 4)
-        line = " ".join(line_list)
-        heapq.heappush(heap, (calibrated_ts, index, line))
+def join_windowed(args):
+    output_log = log_format.open_log(args.output_log, "w")
+    try:
+        tunnel = tunnel_merge.TunnelJoin(
+            args.ingress_log, args.egress_log, args.i_clock_offset, args.e_clock_offset
+        )
+        init_ts = log_format.format_ms(tunnel.init_ts)
+        output_log.write("# init timestamp: %s\n" % init_ts)
 
-    return line
+        for ts, is_recv, size, delay in tunnel.windowed():
+            output_log.write(format_events(ts, is_recv, size, delay))
+    finally:
+        output_log.close()
+
+    if tunnel.error is not None:
+        sys.exit(tunnel.error)
 
 
 def multiple_mode(args):
     # open log files
     link_log = None
     if args.link_log:
-        link_log = open(args.link_log)
+        link_log = log_format.open_log(args.link_log)
 
     tun_logs = []
     for tun_log_name in args.tunnel_logs:
-        tun_logs.append(open(tun_log_name))
+        tun_logs.append(log_format.open_log(tun_log_name))
 
-    output_log = open(args.output_log, "w")
+    if args.binary:
+        output_log = log_format.ColumnarLogWriter(args.output_log)
+    else:
+        output_log = log_format.open_log(args.output_log, "w")
 
-    # maintain a min heap to merge sorted logs
-    heap = []
     if link_log:
         # find initial timestamp in the mm-link log
-        while True:
-            line = link_log.readline()
-            if not line:
-                sys.exit("Warning: link log %s is empty" % link_log.name)
-
-            if not line.startswith("# init timestamp"):
-                continue
-
-            link_init_ts = float(line.split(":")[1])
-            min_init_ts = link_init_ts
-            break
+        link_init_ts = tunnel_merge.read_init_ts(link_log)
+        if link_init_ts is None:
+            sys.exit("Warning: link log %s is empty" % args.link_log)
+        min_init_ts = link_init_ts
     else:
-        min_init_ts = 1e20
+        min_init_ts = None
 
     # find the smallest initial timestamp
     init_ts_delta = []
-    for tun_log in tun_logs:
-        while True:
-            line = tun_log.readline()
-            if not line:
-                sys.exit("Warning: tunnel log %s is empty" % tun_log.name)
-
-            if not line.startswith("# init timestamp"):
-                continue
-
-            init_ts = float(line.split(":")[1])
-            init_ts_delta.append(init_ts)
-            if init_ts < min_init_ts:
-                min_init_ts = init_ts
-            break
+    for tun_log, tun_log_name in zip(tun_logs, args.tunnel_logs):
+        init_ts = tunnel_merge.read_init_ts(tun_log)
+        if init_ts is None:
+            sys.exit("Warning: tunnel log %s is empty" % tun_log_name)
 
-    if link_log:
-        link_init_ts_delta = link_init_ts - min_init_ts
+        init_ts_delta.append(init_ts)
+        if min_init_ts is None or init_ts < min_init_ts:
+            min_init_ts = init_ts
 
     for i in range(len(init_ts_delta)):
         init_ts_delta[i] -= min_init_ts
 
-    output_log.write("# init timestamp: %.3f\n" % min_init_ts)
+    header = "# init timestamp: %s\n" % log_format.format_ms(min_init_ts)
+    output_log.write(header)
+    index = log_format.LogIndexBuilder(0 if args.binary else len(header))
 
-    # build the min heap
+    sources = []
     if link_log:
-        line = push_to_heap(heap, -1, link_log, link_init_ts_delta)
-        if not line:
+        source = tunnel_merge.LogSource(link_log, -1, link_init_ts - min_init_ts)
+        source.fill()
+        if source.done:
             sys.exit("Warning: no delivery opportunities found\n")
+        sources.append(source)
 
     for i in range(len(tun_logs)):
-        line = push_to_heap(heap, i, tun_logs[i], init_ts_delta[i])
-        if not line:
+        source = tunnel_merge.LogSource(tun_logs[i], i, init_ts_delta[i])
+        source.fill()
+        if source.done:
             sys.exit(
                 "Warning: %s does not contain any arrival or "
-                "departure events\n" % tun_logs[i].name
+                "departure events\n" % args.tunnel_logs[i]
             )
+        sources.append(source)
 
-    # merge all log files
-    while heap:
-        (ts, index, line) = heapq.heappop(heap)
-
-        # append flow ids to arrival and departure events
-        if index != -1:
-            line += " %s" % (index + 1)
-
-        output_log.write(line + "\n")
-
-        if index == -1:
-            push_to_heap(heap, index, link_log, link_init_ts_delta)
+    for ts, (chars, keep, flow) in tunnel_merge.merge_blocks(sources):
+        lines = tunnel_merge.format_lines(ts, (chars, keep))
+        output_log.write(lines.decode())
+        if args.binary:
+            index.add_rows(ts, flow)
         else:
-            push_to_heap(heap, index, tun_logs[index], init_ts_delta[index])
+            index.add_lines(ts, flow, lines)
 
     # close log files
     if link_log:
@@ -297,6 +263,75 @@ def multiple_mode(args):
     for tun_log in tun_logs:
         tun_log.close()
     output_log.close()
+    index.finish().save(args.output_log)
+
+
+def merge_fused(flows, output_log, link_log=None):
+    """Write the merged log of raw tunnel logs with FusedMerge"""
+    for _ in tunnel_merge.FusedMerge(flows, link_log, output_log):
+        pass
+
+
+def merge_single(
+    ingress_log, egress_log, output_log, i_clock_offset=None, e_clock_offset=None
+):
+    """Merge the ingress and egress logs of one tunnel (single mode)"""
+    single_mode(
+        argparse.Namespace(
+            ingress_log=ingress_log,
+            egress_log=egress_log,
+            output_log=output_log,
+            i_clock_offset=i_clock_offset,
+            e_clock_offset=e_clock_offset,
+        )
+    )
+
+
+def merge_multiple(tunnel_logs, output_log, link_log=None, binary=False):
+    """Merge the tunnel logs of one or more tunnels (multiple mode)"""
+    multiple_mode(
+        argparse.Namespace(
+            tunnel_logs=tunnel_logs,
+            output_log=output_log,
+            link_log=link_log,
+            binary=binary,
+        )
+    )
+
+
+def merge_all(single_merges, multiple_merges, fused_merges=(), processes=None):
+    """
+    Run every single-mode merge concurrently in a process pool, then every
+    multiple-mode merge, also concurrently. Merges are given as dicts of
+    keyword arguments of merge_single and merge_multiple; fused merges
+    (merge_fused) need no single-mode merges and run with those.
+
+    A merge that fails prints its warning, as the script does, without
+    stopping the others. Return whether every merge succeeded.
+    """
+    first = [(merge_single, kw) for kw in single_merges]
+    first += [(merge_fused, kw) for kw in fused_merges]
+    jobs = max(len(first), len(multiple_merges), 1)
+    processes = min(processes or multiprocessing.cpu_count(), jobs)
+    with multiprocessing.Pool(processes=processes) as pool:
+        ok = pool.map(_run_merge, first)
+        ok += pool.map(_run_merge, [(merge_multiple, kw) for kw in multiple_merges])
+    return all(ok)
+
+
+def _run_merge(job):
+    merge, kwargs = job
+    try:
+        merge(**kwargs)
+    except SystemExit as e:
+        if e.code:
+            sys.stderr.write("%s\n" % e.code)
+            return False
+    except Exception as e:
+        # e.g. a missing, truncated or malformed log fails only this merge
+        sys.stderr.write("Error: failed to merge %s (%r)\n" % (kwargs["output_log"], e))
+        return False
+    return True
 
 
 def main():
@@ -304,6 +339,12 @@ def main():
 
     if args.mode == "single":
         single_mode(args)
+    elif args.mode == "convert":
+        log_format.convert_to_columnar(args.text_log, args.output_log)
+        log_format.index_log(args.output_log)
+    elif args.mode == "index":
+        for log_path in args.logs:
+            log_format.index_log(log_path)
     else:
         multiple_mode(args)
 
@@ -20,7 +20,7 @@ def setup_metadata(args, cc_schemes):
     )
     metadata_path = Path(args.data_dir) / "pantheon_metadata.json"
     for key in list(meta.keys()):
-        if meta[key] is None or key in ["all", "schemes", "data_dir", "pkill_cleanup"]:
+        if meta[key] is None or key in ["all", "schemes", "data_dir", "pkill_cleanup", "results_db"]:
             meta.pop(key)
     if "uplink_trace" in meta:
         meta["uplink_trace"] = str(Path(meta["uplink_trace"]).name)
@@ -0,0 +1,113 @@
+"""
+Download the tunnel logs that a remote-mode test leaves on the remote host.
+
+Instead of one scp per log, the logs are fetched in a few streams. Each
+stream is a single ssh session in which tar packs a group of logs and
+gzip -1 compresses them on the fly; the archive is unpacked here as it
+arrives. The streams run concurrently. ssh_cmd is any command that runs its
+last argument in a shell on the remote host, e.g. ["ssh", host], or
+["sh", "-c"] to stand in for the remote host locally.
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+from multiprocessing.pool import ThreadPool
+from os import path
+from subprocess import PIPE
+
+from newpantheon.common import log_format
+from newpantheon.common.process_manager import Popen
+
+
+def pack_command(remote_logs) -> str:
+    """Shell command that writes the remote logs to stdout as a gzipped tar"""
+    tar_args = []
+    for remote_log in remote_logs:
+        tar_args += ["-C", path.dirname(remote_log) or ".", path.basename(remote_log)]
+    # tar has to write the archive itself, so -1 goes to gzip on the pipe
+    return "tar -cf - %s | gzip -1" % " ".join(shlex.quote(a) for a in tar_args)
+
+
+def fetch_logs(ssh_cmd, remote_logs, local_dir):
+    """
+    Copy the remote logs into local_dir in one ssh session and return their
+    local paths, in the order of remote_logs
+    """
+    local_logs = {
+        path.basename(remote_log): path.join(local_dir, path.basename(remote_log))
+        for remote_log in remote_logs
+    }
+    if len(local_logs) != len(remote_logs):
+        raise ValueError("remote logs to fetch together need distinct names")
+
+    received = set()
+    proc = Popen(ssh_cmd + [pack_command(remote_logs)], stdout=PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile() or member.name not in local_logs:
+                    continue
+                local_log = local_logs[member.name]
+                part = local_log + ".part"
+                with open(part, "wb") as out:
+                    shutil.copyfileobj(
+                        archive.extractfile(member), out, log_format.CHUNK_BYTES
+                    )
+                os.replace(part, local_log)
+                received.add(member.name)
+    except tarfile.ReadError:
+        pass  # no archive at all; reported below as missing logs
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    # the exit status is gzip's, so a log that tar could not read only
+    # shows up as missing from the archive
+    missing = [name for name in local_logs if name not in received]
+    if missing:
+        raise subprocess.CalledProcessError(
+            proc.returncode or 1,
+            ssh_cmd + [pack_command(remote_logs)],
+            output="missing from the archive: %s" % ", ".join(missing),
+        )
+    return [local_logs[path.basename(remote_log)] for remote_log in remote_logs]
+
+
+def fetch_remote_logs(ssh_cmd, remote_logs, local_dir, streams=4):
+    """
+    Copy the remote logs into local_dir in up to streams concurrent ssh
+    sessions and return a dict from every remote log that was fetched to
+    its local path. A group that fails is reported and the remaining logs
+    are still returned, so that a missing log only fails its own run.
+    """
+    streams = max(1, min(streams, len(remote_logs)))
+    groups = [remote_logs[i::streams] for i in range(streams)]
+    groups = [group for group in groups if group]
+
+    def fetch_group(group):
+        try:
+            return dict(zip(group, fetch_logs(ssh_cmd, group, local_dir)))
+        except (subprocess.CalledProcessError, OSError) as exception:
+            details = getattr(exception, "output", None) or exception
+            sys.stderr.write(
+                "Warning: failed to download %s (%s)\n" % (", ".join(group), details)
+            )
+        # the logs of the group that arrived before the failure
+        fetched = {}
+        for remote_log in group:
+            local_log = path.join(local_dir, path.basename(remote_log))
+            if path.isfile(local_log):
+                fetched[remote_log] = local_log
+        return fetched
+
+    with ThreadPool(processes=streams) as pool:
+        local_groups = pool.map(fetch_group, groups)
+
+    local_logs = {}
+    for local_group in local_groups:
+        local_logs.update(local_group)
+    return local_logs
@@ -3,19 +3,21 @@ import signal
 import time
 import uuid
 from os import path
+from multiprocessing.pool import ThreadPool
 from subprocess import PIPE
 from typing import List
 import sys
 
-from newpantheon.experiments.test import helpers
+from newpantheon.analysis import live
+from newpantheon.experiments import merge_tunnel_logs
+from newpantheon.experiments.test import helpers, remote_logs
 from newpantheon.experiments.test.flow import Flow
-from newpantheon.common import context, utils
+from newpantheon.common import context, log_format, results_db, utils
 from newpantheon.common.logger import log_print
 from newpantheon.common.process_manager import (
     Popen,
     write_stdin,
     read_stdout,
-    call,
     kill_proc_group,
 )
 
@@ -32,6 +34,10 @@ class Test:
         self.runtime = args.runtime  # total runtime (sec)
         self.interval = args.interval  # interval between two flows (secs)
         self.run_times = args.run_times  # run-times of each scheme
+        self.live_stats = args.live_stats  # follow tunnel logs during the run
+        self.fused_merge = args.fused_merge  # skip the merged log of each flow
+        self.compress_logs = args.compress_logs  # compression of finished logs
+        self.results_db = args.results_db  # SQLite database to record runs in
 
         self.cc_src: str = ""
         self.tunnel_manager: str = ""
@@ -42,6 +48,7 @@ class Test:
         self.datalink_name = None
         self.acklink_name = None
         self.datalink_log = None
+        self.tunnel_logs = []  # merged log of each flow and direction
         self.acklink_log = None
         self.datalink_ingress_logs = {}
         self.datalink_egress_logs = {}
@@ -81,6 +88,7 @@ class Test:
             self.remote_if = args.remote_if
             self.local_desc = args.local_desc
             self.remote_desc = args.remote_desc
+            self.download_streams = args.download_streams
 
             self.ntp_addr = args.ntp_addr
             self.local_offset = None
@@ -538,8 +546,13 @@ class Test:
             second_cmds.append(second_cmd)
 
         # run the side that runs second
-        if not self.run_second_side(send_manager, recv_manager, second_cmds):
-            return False
+        live_graph = self.start_live_stats()
+        try:
+            if not self.run_second_side(send_manager, recv_manager, second_cmds):
+                return False
+        finally:
+            if live_graph is not None:
+                live_graph.stop()
 
         # stop all the running flows and quit tunnel managers
         write_stdin(ts_manager, "halt\n")
@@ -549,63 +562,63 @@ class Test:
         self.process_tunnel_logs()
         return True
 
-    def download_tunnel_logs(self, tun_id):
-        assert self.mode == "remote"
+    def start_live_stats(self):
+        """Follow the datalink tunnel logs in the background while the test
+        runs, if requested and the logs are written on this machine"""
+        if not self.live_stats:
+            return None
 
-        # download logs from remote side
-        cmd = f"scp -C {self.remote["host_addr"]}:%(remote_log)s %(local_log)s"
+        flows = {}
+        for tun_id in range(1, self.flows + 1):
+            ingress_log = self.datalink_ingress_logs[tun_id]
+            egress_log = self.datalink_egress_logs[tun_id]
+            if self.mode == "remote" and self.remote["temp_dir"] in (
+                path.dirname(ingress_log),
+                path.dirname(egress_log),
+            ):
+                log_print(
+                    f"Warning: no live statistics for flow {tun_id}, "
+                    "its tunnel logs are on the remote side"
+                )
+                continue
+            flows[tun_id] = (ingress_log, egress_log)
 
-        # function to get a corresponding local path from a remote path
-        def remote_path_to_local(p):
-            return path.join(
-                str(context.base_dir / "tmp"),
-                path.basename(p),
-            )
+        if not flows:
+            return None
+
+        snapshot = path.join(self.data_dir, f"{self.datalink_name}_live.json")
+        live_graph = live.LiveTunnelGraph(flows, snapshot=snapshot)
+        live_graph.start()
+        return live_graph
 
+    def download_tunnel_logs(self):
+        assert self.mode == "remote"
+
+        # the logs of every flow that were written on the remote side
         if self.sender_side == "remote":
-            local_log = remote_path_to_local(self.datalink_egress_logs[tun_id])
-            call(
-                cmd
-                % {
-                    "remote_log": self.datalink_egress_logs[tun_id],
-                    "local_log": local_log,
-                },
-                shell=True,
-            )
-            self.datalink_egress_logs[tun_id] = local_log
-
-            local_log = remote_path_to_local(self.acklink_ingress_logs[tun_id])
-            call(
-                cmd
-                % {
-                    "remote_log": self.acklink_ingress_logs[tun_id],
-                    "local_log": local_log,
-                },
-                shell=True,
-            )
-            self.acklink_ingress_logs[tun_id] = local_log
+            remote_side_logs = [self.datalink_egress_logs, self.acklink_ingress_logs]
         else:
-            local_log = remote_path_to_local(self.datalink_ingress_logs[tun_id])
-            call(
-                cmd
-                % {
-                    "remote_log": self.datalink_ingress_logs[tun_id],
-                    "local_log": local_log,
-                },
-                shell=True,
-            )
-            self.datalink_ingress_logs[tun_id] = local_log
-
-            local_log = remote_path_to_local(self.acklink_egress_logs[tun_id])
-            call(
-                cmd
-                % {
-                    "remote_log": self.acklink_egress_logs[tun_id],
-                    "local_log": local_log,
-                },
-                shell=True,
-            )
-            self.acklink_egress_logs[tun_id] = local_log
+            remote_side_logs = [self.datalink_ingress_logs, self.acklink_egress_logs]
+
+        # download them in a few concurrent compressed streams
+        local_dir = str(context.base_dir / "tmp")
+        local_logs = remote_logs.fetch_remote_logs(
+            self.remote["ssh_cmd"],
+            [
+                logs[tun_id]
+                for tun_id in range(1, self.flows + 1)
+                for logs in remote_side_logs
+            ],
+            local_dir,
+            streams=self.download_streams,
+        )
+        # a log that could not be downloaded keeps its local path, where
+        # merging reports it missing and fails only this run
+        for logs in remote_side_logs:
+            for tun_id in logs:
+                logs[tun_id] = local_logs.get(
+                    logs[tun_id], path.join(local_dir, path.basename(logs[tun_id]))
+                )
 
     def process_tunnel_logs(self):
         datalink_tun_logs = []
@@ -636,15 +649,43 @@ class Test:
                     data_egress_offset = self.local_offset
                     ack_ingress_offset = self.local_offset
 
-        # TODO: is there a better way?
-        log_merge_script = os.path.join(
-            str(context.src_dir), "experiments", "merge_tunnel_logs.py"
-        )
+        if self.mode == "remote":
+            self.download_tunnel_logs()
 
+        datalink_flows = []
+        acklink_flows = []
         for tun_id in range(1, self.flows + 1):
-            if self.mode == "remote":
-                self.download_tunnel_logs(tun_id)
+            datalink_flow = {
+                "ingress_log": self.datalink_ingress_logs[tun_id],
+                "egress_log": self.datalink_egress_logs[tun_id],
+            }
+            acklink_flow = {
+                "ingress_log": self.acklink_ingress_logs[tun_id],
+                "egress_log": self.acklink_egress_logs[tun_id],
+            }
+            if apply_offset:
+                datalink_flow["i_clock_offset"] = float(data_ingress_offset)
+                datalink_flow["e_clock_offset"] = float(data_egress_offset)
+                acklink_flow["i_clock_offset"] = float(ack_ingress_offset)
+                acklink_flow["e_clock_offset"] = float(ack_egress_offset)
+            datalink_flows.append(datalink_flow)
+            acklink_flows.append(acklink_flow)
+
+        datalink_merge = {"output_log": self.datalink_log}
+        acklink_merge = {"output_log": self.acklink_log}
+        if self.mode == "local":
+            datalink_merge["link_log"] = self.mm_datalink_log
+            acklink_merge["link_log"] = self.mm_acklink_log
+
+        log_print("Merging tunnel logs...")
+        if self.fused_merge:
+            datalink_merge["flows"] = datalink_flows
+            acklink_merge["flows"] = acklink_flows
+            merge_tunnel_logs.merge_all([], [], [datalink_merge, acklink_merge])
+            return
 
+        single_merges = []
+        for tun_id in range(1, self.flows + 1):
             uid = uuid.uuid4()
             datalink_tun_log = os.path.join(
                 str(context.base_dir / "tmp"),
@@ -654,58 +695,21 @@ class Test:
                 str(context.base_dir / "tmp"),
                 f"{self.acklink_name}_flow{tun_id}_uid{uid}.log.merged",
             )
-            cmd = [
-                "python",
-                log_merge_script,
-                "single",
-                "-i",
-                self.datalink_ingress_logs[tun_id],
-                "-e",
-                self.datalink_egress_logs[tun_id],
-                "-o",
-                datalink_tun_log,
-            ]
-            if apply_offset:
-                cmd += [
-                    "-i-clock-offset",
-                    data_ingress_offset,
-                    "-e-clock-offset",
-                    data_egress_offset,
-                ]
-            call(cmd)
-            cmd = [
-                "python",
-                log_merge_script,
-                "single",
-                "-i",
-                self.acklink_ingress_logs[tun_id],
-                "-e",
-                self.acklink_egress_logs[tun_id],
-                "-o",
-                acklink_tun_log,
-            ]
-            if apply_offset:
-                cmd += [
-                    "-i-clock-offset",
-                    ack_ingress_offset,
-                    "-e-clock-offset",
-                    ack_egress_offset,
-                ]
-            call(cmd)
+            single_merges.append(
+                dict(datalink_flows[tun_id - 1], output_log=datalink_tun_log)
+            )
+            single_merges.append(
+                dict(acklink_flows[tun_id - 1], output_log=acklink_tun_log)
+            )
             datalink_tun_logs.append(datalink_tun_log)
             acklink_tun_logs.append(acklink_tun_log)
 
-        cmd = [log_merge_script, "multiple", "-o", self.datalink_log]
-        if self.mode == "local":
-            cmd += ["--link-log", self.mm_datalink_log]
-        cmd += datalink_tun_logs
-        call(cmd)
+        datalink_merge["tunnel_logs"] = datalink_tun_logs
+        acklink_merge["tunnel_logs"] = acklink_tun_logs
+        self.tunnel_logs = datalink_tun_logs + acklink_tun_logs
 
-        cmd = [log_merge_script, "multiple", "-o", self.acklink_log]
-        if self.mode == "local":
-            cmd += ["--link-log", self.mm_acklink_log]
-        cmd += acklink_tun_logs
-        call(cmd)
+        # merge all flows and both directions at once, in process
+        merge_tunnel_logs.merge_all(single_merges, [datalink_merge, acklink_merge])
 
     def run_congestion_control(self):
         if self.flows > 0:
@@ -722,6 +726,28 @@ class Test:
                 kill_proc_group(self.first_process)
                 kill_proc_group(self.second_process)
 
+    def compress_finished_logs(self):
+        """Compress the raw, merged and mm-link logs of this run"""
+        logs = [self.datalink_log, self.acklink_log] + self.tunnel_logs
+        if self.mode == "local":
+            logs += [self.mm_datalink_log, self.mm_acklink_log]
+        for tun_id in range(1, self.flows + 1):
+            logs += [
+                self.datalink_ingress_logs[tun_id],
+                self.datalink_egress_logs[tun_id],
+                self.acklink_ingress_logs[tun_id],
+                self.acklink_egress_logs[tun_id],
+            ]
+        # logs that only exist on the remote side stay uncompressed
+        logs = [log for log in logs if path.isfile(log)]
+
+        log_print(f"Compressing {len(logs)} logs...")
+        with ThreadPool(processes=len(logs) or 1) as pool:
+            pool.map(
+                lambda log: log_format.compress_log(log, "." + self.compress_logs),
+                logs,
+            )
+
     def record_time_stats(self):
         stats_log = os.path.join(self.data_dir, f"{self.cc}_stats_run{self.run_id}.log")
         with open(stats_log, "w") as stats:
@@ -742,6 +768,26 @@ class Test:
                     log_print(offset_info)
                     stats.write(offset_info)
 
+        if self.results_db:
+            metadata_path = path.join(self.data_dir, "pantheon_metadata.json")
+            metadata = (
+                utils.load_test_metadata(metadata_path)
+                if path.isfile(metadata_path)
+                else {}
+            )
+            results_db.record(
+                self.results_db,
+                results_db.add_test_run,
+                self.data_dir,
+                metadata,
+                self.cc,
+                self.run_id,
+                start_at=self.test_start_time,
+                end_at=self.test_end_time,
+                local_offset_ms=getattr(self, "local_offset", None),
+                remote_offset_ms=getattr(self, "remote_offset", None),
+            )
+
     def run(self):
         """Run congestion control test"""
         msg = f"Testing scheme {self.cc} for experiment run {self.run_id}/{self.run_times}..."
@@ -758,4 +804,7 @@ class Test:
         # write runtimes and clock offsets to file
         self.record_time_stats()
 
+        if self.compress_logs:
+            self.compress_finished_logs()
+
         log_print(f"Done testing {self.cc}")
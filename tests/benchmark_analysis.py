@@ -0,0 +1,209 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+"""Time the log merging and analysis pipeline on synthetic logs.
+
+For every scale, a data directory is generated with tests/synthetic_logs.py
+and each stage is timed in process, in the order a test and its analysis
+run them: merge_tunnel_logs single mode (every flow), multiple mode (all
+flows and the link log), TunnelGraph.run on one datalink log, Plot.run and
+report.PDF. Caching of parsed logs is disabled so every stage starts cold.
+
+    python -m tests.benchmark_analysis --scales small medium -o results.json
+
+The results are printed as a table and, with -o, written as JSON: one
+record per scale and stage with the best and all measured wall-clock times.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+from newpantheon import analysis
+from newpantheon.analysis import plot, report, tunnel_graph
+from newpantheon.experiments import merge_tunnel_logs
+
+from tests import synthetic_logs
+
+SCALES = {
+    "tiny": dict(schemes=("cubic",), flows=1, rate_mbps=12, duration_s=5),
+    "small": dict(schemes=("cubic",), flows=1, rate_mbps=24, duration_s=30),
+    "medium": dict(schemes=("cubic", "bbr"), flows=3, rate_mbps=48, duration_s=30),
+    "large": dict(schemes=("cubic", "bbr"), flows=3, rate_mbps=96, duration_s=60),
+}
+
+
+def merge_single(run):
+    tunnel_logs = []
+    for ingress_log, egress_log in zip(run["ingress"], run["egress"]):
+        tunnel_log = ingress_log.rsplit(".", 1)[0] + ".merged"
+        merge_tunnel_logs.single_mode(
+            argparse.Namespace(
+                ingress_log=ingress_log,
+                egress_log=egress_log,
+                output_log=tunnel_log,
+                i_clock_offset=None,
+                e_clock_offset=None,
+            )
+        )
+        tunnel_logs.append(tunnel_log)
+    run["tunnel_logs"] = tunnel_logs
+
+
+def merge_multiple(run):
+    merge_tunnel_logs.multiple_mode(
+        argparse.Namespace(
+            link_log=run["link"],
+            tunnel_logs=run["tunnel_logs"],
+            output_log=run["datalink"],
+            binary=False,
+        )
+    )
+
+
+def analysis_args(data_dir):
+    parser = argparse.ArgumentParser()
+    analysis.parse_plot(parser)
+    parser.add_argument("--interactions", action="store_true")
+    args = parser.parse_args(["--data-dir", data_dir, "--no-cache"])
+    args.test_name = None
+    return args
+
+
+def run_tunnel_graph(run):
+    prefix = run["datalink"][: -len(".log")]
+    tunnel_graph.TunnelGraph(
+        tunnel_log=run["datalink"],
+        throughput_graph=prefix + "_throughput.png",
+        delay_graph=prefix + "_delay.png",
+    ).run()
+
+
+def time_call(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_scale(scale, params, repeat, seed, keep_dir=None):
+    data_dir = keep_dir or tempfile.mkdtemp(prefix=f"pantheon-bench-{scale}-")
+    try:
+        runs = synthetic_logs.make_data_dir(data_dir, seed=seed, **params)
+        first_run = runs[min(runs)]
+        packets = sum(
+            sum(1 for _ in open(egress_log)) - 1
+            for run in runs.values()
+            for egress_log in run["egress"]
+        )
+
+        # merging is timed over all runs, so that the later stages find
+        # every datalink log in place
+        stages = [
+            ("merge_single", lambda: [merge_single(run) for run in runs.values()]),
+            ("merge_multiple", lambda: [merge_multiple(run) for run in runs.values()]),
+            ("tunnel_graph", lambda: run_tunnel_graph(first_run)),
+            ("plot", lambda: plot.Plot(analysis_args(data_dir)).run()),
+            ("report", lambda: report.PDF(analysis_args(data_dir))),
+        ]
+
+        results = []
+        for stage, func in stages:
+            times = time_call(func, repeat)
+            results.append(
+                {
+                    "scale": scale,
+                    "stage": stage,
+                    "runs": len(runs),
+                    "flows": params["flows"],
+                    "packets": packets,
+                    "datalink_bytes": path.getsize(first_run["datalink"])
+                    if path.isfile(first_run["datalink"])
+                    else None,
+                    "best_s": min(times),
+                    "times_s": times,
+                }
+            )
+        return results
+    finally:
+        if keep_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def results_table(results):
+    ret = "%-8s %-15s %10s %10s\n" % ("scale", "stage", "packets", "best (s)")
+    for record in results:
+        ret += "%-8s %-15s %10d %10.3f\n" % (
+            record["scale"],
+            record["stage"],
+            record["packets"],
+            record["best_s"],
+        )
+    return ret
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(SCALES),
+        default=["tiny", "small"],
+        help="scales to benchmark (default: tiny small)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="times to run each stage (default 1)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the synthetic logs (default 0)"
+    )
+    parser.add_argument(
+        "--keep-dir",
+        metavar="DIR",
+        help="generate into DIR and keep it instead of a temporary directory",
+    )
+    parser.add_argument(
+        "-o", metavar="JSON", dest="output", help="write the results to JSON"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    results = []
+    for scale in args.scales:
+        keep_dir = None
+        if args.keep_dir:
+            keep_dir = path.join(args.keep_dir, scale)
+            os.makedirs(keep_dir, exist_ok=True)
+        results += benchmark_scale(
+            scale, SCALES[scale], args.repeat, args.seed, keep_dir
+        )
+
+    sys.stderr.write(results_table(results))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "seed": args.seed,
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
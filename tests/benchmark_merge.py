@@ -0,0 +1,345 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+"""Check and time merge_tunnel_logs on synthetic tunnel and mm-link logs.
+
+For every scale, the raw ingress and egress logs of every flow are generated
+with tests/synthetic_logs.py, with loss, reordering, duplicate uids and
+clocks that differ between the two ends (corrected by clock offsets, as
+with --ntp-addr), next to an mm-link log of arrivals, departures and
+delivery opportunities. merge_tunnel_logs then runs the way a test runs it,
+as a script in a process of its own: single mode on every flow, followed by
+multiple mode on the tunnel logs and the link log.
+
+Every output is compared byte for byte with what tests/reference_merge.py
+writes for the same logs, and every stage reports the events it merged per
+second and the peak RSS of its processes.
+
+    python -m tests.benchmark_merge --scales small medium -o merge.json
+
+The results are printed as a table and, with -o, written as JSON: one
+record per scale and stage. The exit status is 1 if an output differs from
+the reference.
+"""
+
+import argparse
+import filecmp
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+from newpantheon.experiments import merge_tunnel_logs
+
+from tests import reference_merge, synthetic_logs
+
+SCALES = {
+    "tiny": dict(flows=1, rate_mbps=12, duration_s=5),
+    "small": dict(flows=2, rate_mbps=48, duration_s=30),
+    "medium": dict(flows=3, rate_mbps=100, duration_s=60),
+    "large": dict(flows=4, rate_mbps=400, duration_s=60),
+}
+
+
+def make_logs(
+    data_dir,
+    flows,
+    rate_mbps,
+    duration_s,
+    loss=0.02,
+    reorder=0.1,
+    duplicate=0.01,
+    tick_ms=None,
+    seed=0,
+):
+    """Write the raw logs of every flow and the mm-link log into data_dir.
+
+    Return {"flows": [merge_single keyword arguments without output_log],
+    "link": path}."""
+    rnd = random.Random(seed)
+    logs = {"flows": [], "link": path.join(data_dir, "link.log")}
+    all_packets = []
+    for flow_id in range(1, flows + 1):
+        packets = synthetic_logs.generate_packets(
+            rate_mbps / flows,
+            duration_s,
+            loss=loss,
+            reorder=reorder,
+            start_ms=flow_id - 1.0,
+            seed=seed * 31 + flow_id,
+            duplicate=duplicate,
+            tick_ms=tick_ms,
+        )
+        all_packets.append(packets)
+
+        # the receiver's clock may run up to 10 ms ahead, which keeps the
+        # timestamps of the ingress log positive
+        send_init_ts = synthetic_logs.INIT_TS + round(rnd.uniform(0, 20), 3)
+        recv_init_ts = send_init_ts + round(rnd.uniform(-20, 10), 3)
+        prefix = path.join(data_dir, f"flow{flow_id}.log")
+        synthetic_logs.write_raw_logs(
+            prefix + ".ingress", prefix + ".egress", packets, send_init_ts, recv_init_ts
+        )
+        logs["flows"].append(
+            {
+                "ingress_log": prefix + ".ingress",
+                "egress_log": prefix + ".egress",
+                "i_clock_offset": rnd.uniform(-5, 5),
+                "e_clock_offset": rnd.uniform(-5, 5),
+            }
+        )
+
+    synthetic_logs.write_link_log(
+        logs["link"], rate_mbps, duration_s + 1, flows=all_packets
+    )
+    return logs
+
+
+def single_args(flow, output_log):
+    return [
+        "single",
+        "-i",
+        flow["ingress_log"],
+        "-e",
+        flow["egress_log"],
+        "-o",
+        output_log,
+        "-i-clock-offset=%r" % flow["i_clock_offset"],
+        "-e-clock-offset=%r" % flow["e_clock_offset"],
+    ]
+
+
+def run_merge(args):
+    """Run merge_tunnel_logs.py with args, return its wall-clock time and
+    peak RSS in MB"""
+    cmd = [sys.executable, merge_tunnel_logs.__file__] + args
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    # kilobytes on Linux, bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / 1024.0
+    if sys.platform == "darwin":
+        peak_rss_mb /= 1024.0
+    return wall, peak_rss_mb
+
+
+def count_events(log_path):
+    with open(log_path, "rb") as log:
+        return sum(1 for line in log if not line.startswith(b"#"))
+
+
+def benchmark_scale(scale, params, repeat, seed, reference=True, keep_dir=None):
+    data_dir = keep_dir or tempfile.mkdtemp(prefix=f"pantheon-merge-{scale}-")
+    try:
+        logs = make_logs(data_dir, seed=seed, **params)
+        flows = logs["flows"]
+        tunnel_logs = [
+            path.join(data_dir, f"flow{i}.merged") for i in range(1, len(flows) + 1)
+        ]
+        output_log = path.join(data_dir, "datalink.log")
+
+        # every stage lists the arguments of each of its runs, and the
+        # outputs it writes with how the reference writes each of them
+        single_refs = [tunnel_log + ".ref" for tunnel_log in tunnel_logs]
+        stages = [
+            (
+                "single",
+                [
+                    single_args(flow, tunnel_log)
+                    for flow, tunnel_log in zip(flows, tunnel_logs)
+                ],
+                [
+                    (tunnel_log, reference_single(flow, reference_log))
+                    for flow, tunnel_log, reference_log in zip(
+                        flows, tunnel_logs, single_refs
+                    )
+                ],
+            ),
+            (
+                "multiple",
+                [
+                    ["multiple", "--link-log", logs["link"], "-o", output_log]
+                    + tunnel_logs
+                ],
+                # from the references of single mode, so that a difference
+                # shows up in the stage that made it
+                [
+                    (
+                        output_log,
+                        reference_multiple(
+                            single_refs, output_log + ".ref", logs["link"]
+                        ),
+                    )
+                ],
+            ),
+        ]
+
+        results = []
+        for stage, runs, outputs in stages:
+            times = []
+            peak_rss_mb = 0.0
+            for _ in range(repeat):
+                total = 0.0
+                for args in runs:
+                    wall, rss = run_merge(args)
+                    total += wall
+                    peak_rss_mb = max(peak_rss_mb, rss)
+                times.append(total)
+
+            identical = None
+            if reference:
+                # every reference is written, even after a difference
+                identical = all(
+                    [
+                        filecmp.cmp(output, write(), shallow=False)
+                        for output, write in outputs
+                    ]
+                )
+
+            events = sum(count_events(output) for output, _ in outputs)
+            results.append(
+                {
+                    "scale": scale,
+                    "stage": stage,
+                    "flows": params["flows"],
+                    "events": events,
+                    "best_s": min(times),
+                    "times_s": times,
+                    "events_per_s": events / min(times),
+                    "peak_rss_mb": peak_rss_mb,
+                    "identical": identical,
+                }
+            )
+        return results
+    finally:
+        if keep_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def reference_single(flow, reference_log):
+    """Return a function that writes the reference of single mode for flow
+    and returns its path"""
+
+    def write():
+        reference_merge.single(output_log=reference_log, **flow)
+        return reference_log
+
+    return write
+
+
+def reference_multiple(tunnel_logs, reference_log, link_log):
+    """Return a function that writes the reference of multiple mode and
+    returns its path"""
+
+    def write():
+        reference_merge.multiple(tunnel_logs, reference_log, link_log)
+        return reference_log
+
+    return write
+
+
+def results_table(results):
+    ret = "%-8s %-9s %10s %9s %12s %10s %10s\n" % (
+        "scale",
+        "stage",
+        "events",
+        "best (s)",
+        "events/s",
+        "RSS (MB)",
+        "identical",
+    )
+    for record in results:
+        ret += "%-8s %-9s %10d %9.3f %12.0f %10.1f %10s\n" % (
+            record["scale"],
+            record["stage"],
+            record["events"],
+            record["best_s"],
+            record["events_per_s"],
+            record["peak_rss_mb"],
+            "-" if record["identical"] is None else record["identical"],
+        )
+    return ret
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(SCALES),
+        default=["tiny", "small"],
+        help="scales to benchmark (default: tiny small)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="times to run each stage (default 1)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the synthetic logs (default 0)"
+    )
+    parser.add_argument(
+        "--no-reference",
+        action="store_true",
+        help="only time the merge, without comparing it with the reference "
+        "implementation, which is slow at large scales",
+    )
+    parser.add_argument(
+        "--keep-dir",
+        metavar="DIR",
+        help="generate into DIR and keep it instead of a temporary directory",
+    )
+    parser.add_argument(
+        "-o", metavar="JSON", dest="output", help="write the results to JSON"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    results = []
+    for scale in args.scales:
+        keep_dir = None
+        if args.keep_dir:
+            keep_dir = path.join(args.keep_dir, scale)
+            os.makedirs(keep_dir, exist_ok=True)
+        results += benchmark_scale(
+            scale,
+            SCALES[scale],
+            args.repeat,
+            args.seed,
+            reference=not args.no_reference,
+            keep_dir=keep_dir,
+        )
+
+    sys.stderr.write(results_table(results))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "seed": args.seed,
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+    if any(record["identical"] is False for record in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
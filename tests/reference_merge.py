@@ -0,0 +1,168 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+"""Reference implementation of merge_tunnel_logs single and multiple mode.
+
+The original line-at-a-time merge: single mode pairs every received packet
+with its send through a dict of uids (the last send of a uid wins) and
+walks both logs in step, sends first on equal timestamps; multiple mode
+pops one line at a time off a heap of (timestamp, log index, line). It is
+slow but simple, and timestamps are parsed with decimal and kept as
+integer microseconds, so the optimized merge has to match it byte for
+byte. Failures raise SystemExit with the messages of the script, after
+the lines merged until then are written.
+"""
+
+import heapq
+from decimal import ROUND_HALF_EVEN, Decimal
+
+
+def parse_ms(text):
+    """Milliseconds in text as integer microseconds, rounded half to even"""
+    return int((Decimal(text.strip()) * 1000).to_integral_value(ROUND_HALF_EVEN))
+
+
+def format_ms(us):
+    """Integer microseconds as milliseconds with three decimals"""
+    return "%s%d.%03d" % ("-" if us < 0 else "", abs(us) // 1000, abs(us) % 1000)
+
+
+def parse_line(line):
+    ts, uid, size = line.split("-")
+    return parse_ms(ts), int(uid), int(size)
+
+
+def init_ts(line, clock_offset=None):
+    ts = parse_ms(line.rsplit(":", 1)[-1])
+    if clock_offset is not None:
+        ts += parse_ms(repr(clock_offset))
+    return ts
+
+
+def single(
+    ingress_log, egress_log, output_log, i_clock_offset=None, e_clock_offset=None
+):
+    with open(egress_log) as send_log, open(ingress_log) as recv_log, open(
+        output_log, "w"
+    ) as output:
+        line = send_log.readline()
+        if not line:
+            raise SystemExit("Warning: egress log is empty\n")
+        send_init_ts = init_ts(line, e_clock_offset)
+
+        line = recv_log.readline()
+        if not line:
+            raise SystemExit("Warning: ingress log is empty\n")
+        recv_init_ts = init_ts(line, i_clock_offset)
+
+        min_init_ts = min(send_init_ts, recv_init_ts)
+        output.write("# init timestamp: %s\n" % format_ms(min_init_ts))
+        send_cal = send_init_ts - min_init_ts
+        recv_cal = recv_init_ts - min_init_ts
+
+        sends = [parse_line(line) for line in send_log]
+        recvs = [parse_line(line) for line in recv_log]
+        sent = {uid: (ts + send_cal, size) for ts, uid, size in sends}
+
+        i = j = 0
+        while i < len(sends) or j < len(recvs):
+            if j == len(recvs) or (
+                i < len(sends) and sends[i][0] + send_cal <= recvs[j][0] + recv_cal
+            ):
+                ts, _, size = sends[i]
+                output.write("%s + %d\n" % (format_ms(ts + send_cal), size))
+                i += 1
+                continue
+
+            ts, uid, size = recvs[j]
+            if uid not in sent:
+                raise SystemExit(
+                    "Warning: received a packet with nonexistent uid %s\n" % uid
+                )
+            send_ts, send_size = sent[uid]
+            if send_size != size:
+                raise SystemExit(
+                    "Warning: packet %s came into tunnel with size %s "
+                    "but left with size %s\n" % (uid, send_size, size)
+                )
+            ts += recv_cal
+            output.write(
+                "%s - %d %s\n" % (format_ms(ts), size, format_ms(ts - send_ts))
+            )
+            j += 1
+
+
+def _next_line(log, link):
+    for line in log:
+        if line.startswith("#"):
+            continue
+        # the mm-link log only contributes its delivery opportunities
+        if link and "#" not in line:
+            continue
+        return line
+    return None
+
+
+def _push(heap, index, log, init_ts_delta):
+    line = _next_line(log, index == -1)
+    if line is None:
+        return False
+
+    tokens = line.strip().split()
+    ts = parse_ms(tokens[0]) + init_ts_delta
+    tokens[0] = format_ms(ts)
+    if tokens[1] == "#":
+        tokens[2] = str(int(tokens[2]) - 4)
+    else:
+        tokens.append(str(index + 1))
+    heapq.heappush(heap, (ts, index, " ".join(tokens)))
+    return True
+
+
+def _read_init_ts(log):
+    for line in log:
+        if line.startswith("# init timestamp"):
+            return parse_ms(line.split(":")[1])
+    return None
+
+
+def multiple(tunnel_logs, output_log, link_log=None):
+    logs = [open(tunnel_log) for tunnel_log in tunnel_logs]
+    link = open(link_log) if link_log else None
+    try:
+        init_ts = []
+        if link:
+            link_init_ts = _read_init_ts(link)
+            if link_init_ts is None:
+                raise SystemExit("Warning: link log %s is empty" % link_log)
+        for log, tunnel_log in zip(logs, tunnel_logs):
+            init_ts.append(_read_init_ts(log))
+            if init_ts[-1] is None:
+                raise SystemExit("Warning: tunnel log %s is empty" % tunnel_log)
+        min_init_ts = min(init_ts + ([link_init_ts] if link else []))
+
+        with open(output_log, "w") as output:
+            output.write("# init timestamp: %s\n" % format_ms(min_init_ts))
+
+            heap = []
+            if link and not _push(heap, -1, link, link_init_ts - min_init_ts):
+                raise SystemExit("Warning: no delivery opportunities found\n")
+            for i, log in enumerate(logs):
+                if not _push(heap, i, log, init_ts[i] - min_init_ts):
+                    raise SystemExit(
+                        "Warning: %s does not contain any arrival or "
+                        "departure events\n" % tunnel_logs[i]
+                    )
+
+            while heap:
+                _, index, line = heapq.heappop(heap)
+                output.write(line + "\n")
+                if index == -1:
+                    _push(heap, index, link, link_init_ts - min_init_ts)
+                else:
+                    _push(heap, index, logs[index], init_ts[index] - min_init_ts)
+    finally:
+        for log in logs:
+            log.close()
+        if link:
+            link.close()
@@ -0,0 +1,288 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+"""Deterministic synthetic logs for exercising the analysis without Mahimahi.
+
+Every flow is a stream of packets sent at a configurable rate, delayed by a
+base delay plus jitter, dropped with probability ``loss`` and held back
+(so that later packets overtake it) with probability ``reorder``. With
+probability ``duplicate`` a packet is lost and sent again under the same
+uid, and ``tick_ms`` coarsens timestamps so that events tie. From the
+packets this module writes the raw ingress/egress logs of each tunnel, the
+mm-link log of the bottleneck, the per-tunnel logs of merge_tunnel_logs
+single mode and complete datalink logs, and can lay out a data directory
+that plot, report and plot_over_time accept. The same arguments always
+produce the same bytes.
+"""
+
+import json
+import random
+from os import path
+
+INIT_TS = 1700000000000.0  # ms since the epoch, as written by the tunnels
+MTU = 1500
+
+
+class Packet(object):
+    __slots__ = ["uid", "size", "send_ts", "recv_ts"]
+
+    def __init__(self, uid, size, send_ts, recv_ts):
+        self.uid = uid
+        self.size = size
+        self.send_ts = send_ts  # ms after the sender's init timestamp
+        self.recv_ts = recv_ts  # None if the packet was lost
+
+
+def generate_packets(
+    rate_mbps,
+    duration_s,
+    loss=0.0,
+    reorder=0.0,
+    base_delay_ms=20.0,
+    jitter_ms=5.0,
+    start_ms=0.0,
+    seed=0,
+    duplicate=0.0,
+    tick_ms=None,
+):
+    """Return the packets of one flow in the order they were sent."""
+    rnd = random.Random(seed)
+    packets = []
+
+    ts = start_ms
+    end_ms = 1000.0 * duration_s
+    uid = 0
+    while ts < end_ms:
+        size = MTU if rnd.random() < 0.9 else rnd.choice([52, 100, 600])
+        # milliseconds to send size bytes at rate_mbps, jittered around it
+        gap = size * 8.0 / (1000.0 * rate_mbps) * rnd.uniform(0.5, 1.5)
+
+        recv_ts = None
+        if rnd.random() >= loss:
+            delay = base_delay_ms + rnd.expovariate(1.0 / jitter_ms)
+            if rnd.random() < reorder:
+                delay += rnd.uniform(1.0, 10.0)
+            recv_ts = ts + delay
+
+        if duplicate and rnd.random() < duplicate:
+            # the first copy is lost, the second one is received instead
+            packets.append(Packet(uid, size, _round(ts, tick_ms), None))
+            ts += gap / 2
+            if recv_ts is not None:
+                recv_ts += gap / 2
+
+        packets.append(Packet(uid, size, _round(ts, tick_ms), _round(recv_ts, tick_ms)))
+        uid += 1
+        ts += gap
+
+    return packets
+
+
+def _round(ts, tick_ms=None):
+    if ts is None:
+        return None
+    if tick_ms:
+        ts = round(ts / tick_ms) * tick_ms
+    return round(ts, 3)
+
+
+def write_raw_logs(ingress_log, egress_log, packets, send_init_ts, recv_init_ts):
+    """Write the logs of a tunnel: the egress log records packets entering
+    it on the sender, the ingress log the packets leaving it on the receiver.
+    Timestamps are relative to each side's own init timestamp."""
+    with open(egress_log, "w") as egress:
+        egress.write("# init timestamp: %.3f\n" % send_init_ts)
+        for pkt in packets:
+            egress.write("%.3f - %d - %d\n" % (pkt.send_ts, pkt.uid, pkt.size))
+
+    offset = send_init_ts - recv_init_ts
+    with open(ingress_log, "w") as ingress:
+        ingress.write("# init timestamp: %.3f\n" % recv_init_ts)
+        for pkt in received_in_order(packets):
+            ingress.write(
+                "%.3f - %d - %d\n" % (pkt.recv_ts + offset, pkt.uid, pkt.size)
+            )
+
+
+def received_in_order(packets):
+    received = [pkt for pkt in packets if pkt.recv_ts is not None]
+    received.sort(key=lambda pkt: pkt.recv_ts)
+    return received
+
+
+def write_tunnel_log(tunnel_log, ingress_log, egress_log):
+    """Write what merge_tunnel_logs single mode makes of the raw logs,
+    computed independently of it."""
+    send_init_ts, send_pkts = _read_raw_log(egress_log)
+    recv_init_ts, recv_pkts = _read_raw_log(ingress_log)
+
+    min_init_ts = min(send_init_ts, recv_init_ts)
+    send_cal = send_init_ts - min_init_ts
+    recv_cal = recv_init_ts - min_init_ts
+
+    sent = {uid: ts + send_cal for ts, uid, _ in send_pkts}
+    # sends go first on equal timestamps, as in single mode
+    events = []
+    for i, (ts, _, size) in enumerate(send_pkts):
+        send_ts = ts + send_cal
+        events.append((send_ts, 0, i, "%.3f + %s\n" % (send_ts, size)))
+    for i, (ts, uid, size) in enumerate(recv_pkts):
+        recv_ts = ts + recv_cal
+        line = "%.3f - %s %.3f\n" % (recv_ts, size, recv_ts - sent[uid])
+        events.append((recv_ts, 1, i, line))
+    events.sort()
+
+    with open(tunnel_log, "w") as output:
+        output.write("# init timestamp: %.3f\n" % min_init_ts)
+        for event in events:
+            output.write(event[3])
+
+
+def _read_raw_log(raw_log):
+    with open(raw_log) as log:
+        init_ts = float(log.readline().rsplit(":", 1)[-1])
+        pkts = []
+        for line in log:
+            ts, uid, size = line.split("-")
+            pkts.append((float(ts), int(uid), int(size)))
+    return init_ts, pkts
+
+
+def write_link_log(link_log, rate_mbps, duration_s, init_ts=INIT_TS, flows=None):
+    """Write the delivery opportunities of an mm-link log for a constant
+    rate link, one MTU-sized opportunity at a time. With flows (packet
+    lists), the arrivals and departures of their packets are logged too,
+    in whole milliseconds like mm-link does."""
+    gap = MTU * 8.0 / (1000.0 * rate_mbps)
+    events = []
+    ts = 0.0
+    while ts < 1000.0 * duration_s:
+        events.append((int(ts), "%d # %d\n" % (ts, MTU + 4)))
+        ts += gap
+    for packets in flows or []:
+        for pkt in packets:
+            events.append((int(pkt.send_ts), "%d + %d\n" % (pkt.send_ts, pkt.size + 4)))
+            if pkt.recv_ts is not None:
+                delay = int(pkt.recv_ts) - int(pkt.send_ts)
+                line = "%d - %d %d\n" % (pkt.recv_ts, pkt.size + 4, delay)
+                events.append((int(pkt.recv_ts), line))
+    events.sort(key=lambda event: event[0])
+
+    with open(link_log, "w") as log:
+        log.write("# mahimahi mm-link (synthetic) [%d Mbit/s]\n" % rate_mbps)
+        log.write("# init timestamp: %d\n" % init_ts)
+        log.write("# base timestamp: 0\n")
+        for _, line in events:
+            log.write(line)
+
+
+def write_datalink_log(datalink_log, flows, link_rate_mbps=None, init_ts=INIT_TS):
+    """Write a merged datalink log (merge_tunnel_logs multiple mode format)
+    straight from the packets of every flow; flows is a list of packet
+    lists, flow ids are assigned in order."""
+    events = []
+    duration = 0.0
+    for flow_id, packets in enumerate(flows, 1):
+        for pkt in packets:
+            line = "%.3f + %d %d\n" % (pkt.send_ts, pkt.size, flow_id)
+            events.append((pkt.send_ts, line))
+            if pkt.recv_ts is not None:
+                delay = pkt.recv_ts - pkt.send_ts
+                line = "%.3f - %d %.3f %d\n" % (pkt.recv_ts, pkt.size, delay, flow_id)
+                events.append((pkt.recv_ts, line))
+                duration = max(duration, pkt.recv_ts)
+
+    if link_rate_mbps:
+        gap = MTU * 8.0 / (1000.0 * link_rate_mbps)
+        ts = 0.0
+        while ts < duration:
+            events.append((float(int(ts)), "%.3f # %d\n" % (int(ts), MTU)))
+            ts += gap
+
+    events.sort(key=lambda event: event[0])
+    with open(datalink_log, "w") as log:
+        log.write("# init timestamp: %.3f\n" % init_ts)
+        for _, line in events:
+            log.write(line)
+
+
+def make_data_dir(
+    data_dir,
+    schemes=("cubic",),
+    run_times=1,
+    flows=1,
+    rate_mbps=12.0,
+    duration_s=10,
+    loss=0.0,
+    reorder=0.0,
+    seed=0,
+    datalink=False,
+):
+    """Lay out data_dir like the output of a local test: per scheme and run,
+    the raw tunnel logs of every flow and the link log, empty stats logs and
+    pantheon_metadata.json. With datalink, the merged datalink logs are
+    written as well; otherwise merge_tunnel_logs is left to produce them.
+
+    Return {(cc, run_id): {"ingress": [...], "egress": [...], "link": path,
+    "datalink": path}}."""
+    runs = {}
+    for cc_index, cc in enumerate(schemes):
+        for run_id in range(1, run_times + 1):
+            run_seed = seed * 1000003 + cc_index * 1009 + run_id
+            name = f"{cc}_datalink_run{run_id}"
+            run = {
+                "ingress": [],
+                "egress": [],
+                "link": path.join(data_dir, f"{name}_link.log"),
+                "datalink": path.join(data_dir, f"{name}.log"),
+            }
+
+            all_packets = []
+            for flow_id in range(1, flows + 1):
+                packets = generate_packets(
+                    rate_mbps / flows,
+                    duration_s,
+                    loss=loss,
+                    reorder=reorder,
+                    start_ms=flow_id - 1.0,
+                    seed=run_seed * 31 + flow_id,
+                )
+                all_packets.append(packets)
+
+                prefix = path.join(data_dir, f"{name}_flow{flow_id}.log")
+                run["ingress"].append(prefix + ".ingress")
+                run["egress"].append(prefix + ".egress")
+                # the receiver's clock starts a little after the sender's
+                write_raw_logs(
+                    run["ingress"][-1],
+                    run["egress"][-1],
+                    packets,
+                    INIT_TS,
+                    INIT_TS + 1.5,
+                )
+
+            write_link_log(run["link"], rate_mbps, duration_s + 1)
+            if datalink:
+                write_datalink_log(run["datalink"], all_packets, rate_mbps)
+
+            stats_log = path.join(data_dir, f"{cc}_stats_run{run_id}.log")
+            with open(stats_log, "w") as stats:
+                stats.write("Start at: 0\nEnd at: %d\n" % (1000 * duration_s))
+
+            runs[(cc, run_id)] = run
+
+    meta = {
+        "cc_schemes": list(schemes),
+        "run_times": run_times,
+        "flows": flows,
+        "interval": 0,
+        "runtime": duration_s,
+        "mode": "local",
+        "uplink_trace": "synthetic",
+        "downlink_trace": "synthetic",
+        "git_summary": "synthetic logs",
+    }
+    with open(path.join(data_dir, "pantheon_metadata.json"), "w") as metadata:
+        json.dump(meta, metadata)
+
+    return runs
@@ -0,0 +1,118 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+import filecmp
+import random
+
+import pytest
+
+from newpantheon.common import tunnel_merge
+from newpantheon.experiments import merge_tunnel_logs
+
+from tests import benchmark_merge, reference_merge
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_merges_match_reference(tmp_path, monkeypatch, seed):
+    rnd = random.Random(seed)
+    logs = benchmark_merge.make_logs(
+        str(tmp_path),
+        flows=rnd.randint(1, 3),
+        rate_mbps=rnd.choice([2, 12]),
+        duration_s=2,
+        loss=0.05,
+        reorder=0.2,
+        duplicate=0.05,
+        # whole milliseconds make sends, receives and flows tie
+        tick_ms=rnd.choice([None, 1]),
+        seed=seed,
+    )
+    # merge in small blocks, so that events tie across block boundaries
+    monkeypatch.setattr(tunnel_merge, "MERGE_BLOCK_BYTES", rnd.choice([64, 4096]))
+
+    tunnel_logs = []
+    for i, flow in enumerate(logs["flows"]):
+        tunnel_log = str(tmp_path / f"flow{i}.merged")
+        merge_tunnel_logs.merge_single(output_log=tunnel_log, **flow)
+        reference_merge.single(output_log=tunnel_log + ".ref", **flow)
+        assert filecmp.cmp(tunnel_log, tunnel_log + ".ref", shallow=False)
+        tunnel_logs.append(tunnel_log)
+
+    link_log = logs["link"] if seed % 2 else None
+    output_log = str(tmp_path / "datalink.log")
+    merge_tunnel_logs.merge_multiple(tunnel_logs, output_log, link_log)
+    reference_merge.multiple(tunnel_logs, output_log + ".ref", link_log)
+    assert filecmp.cmp(output_log, output_log + ".ref", shallow=False)
+
+    fused_log = str(tmp_path / "fused.log")
+    merge_tunnel_logs.merge_fused(logs["flows"], fused_log, link_log)
+    assert filecmp.cmp(fused_log, output_log + ".ref", shallow=False)
+
+
+def test_single_mode_failure_matches_reference(tmp_path):
+    logs = benchmark_merge.make_logs(str(tmp_path), flows=1, rate_mbps=2, duration_s=1)
+    flow = logs["flows"][0]
+    with open(flow["ingress_log"], "a") as ingress:
+        ingress.write("5000.000 - 999999 - 1500\n")
+
+    output_log = str(tmp_path / "flow.merged")
+    with pytest.raises(SystemExit) as merged:
+        merge_tunnel_logs.merge_single(output_log=output_log, **flow)
+    with pytest.raises(SystemExit) as referenced:
+        reference_merge.single(output_log=output_log + ".ref", **flow)
+    assert merged.value.code == referenced.value.code
+    assert filecmp.cmp(output_log, output_log + ".ref", shallow=False)
+
+
+def test_benchmark_reports_identical_merges(tmp_path):
+    results = benchmark_merge.benchmark_scale(
+        "tiny", benchmark_merge.SCALES["tiny"], 1, 0, keep_dir=str(tmp_path)
+    )
+
+    assert [record["stage"] for record in results] == ["single", "multiple"]
+    assert all(record["identical"] for record in results)
+    assert all(record["events_per_s"] > 0 for record in results)
+
+
+def test_merge_all_reports_failed_merge(tmp_path, capfd):
+    logs = benchmark_merge.make_logs(str(tmp_path), flows=1, rate_mbps=2, duration_s=1)
+    flow = logs["flows"][0]
+    merges = [
+        dict(flow, output_log=str(tmp_path / "ok.merged")),
+        dict(
+            flow,
+            ingress_log=str(tmp_path / "missing.log"),
+            output_log=str(tmp_path / "missing.merged"),
+        ),
+    ]
+
+    # the missing log fails its own merge without stopping the other
+    assert not merge_tunnel_logs.merge_all(merges, [], processes=1)
+    assert "missing.merged" in capfd.readouterr().err
+    assert (tmp_path / "ok.merged").exists()
+
+
+def test_fused_merge_falls_back_on_unordered_uids(tmp_path, monkeypatch):
+    logs = benchmark_merge.make_logs(str(tmp_path), flows=2, rate_mbps=2, duration_s=1)
+    # swap two packets late in the egress log of the first flow, so that its
+    # uids stop increasing after the windowed join has yielded events
+    egress_log = logs["flows"][0]["egress_log"]
+    with open(egress_log) as egress:
+        lines = egress.readlines()
+    i = len(lines) - 20
+    (ts1, packet1), (ts2, packet2) = (line.split(" - ", 1) for line in lines[i : i + 2])
+    lines[i : i + 2] = [ts1 + " - " + packet2, ts2 + " - " + packet1]
+    with open(egress_log, "w") as egress:
+        egress.writelines(lines)
+    monkeypatch.setattr(tunnel_merge, "MERGE_BLOCK_BYTES", 64)
+
+    tunnel_logs = []
+    for i, flow in enumerate(logs["flows"]):
+        tunnel_logs.append(str(tmp_path / f"flow{i}.ref"))
+        reference_merge.single(output_log=tunnel_logs[-1], **flow)
+    reference_log = str(tmp_path / "datalink.ref")
+    reference_merge.multiple(tunnel_logs, reference_log, logs["link"])
+
+    fused_log = str(tmp_path / "fused.log")
+    merge_tunnel_logs.merge_fused(logs["flows"], fused_log, logs["link"])
+    assert filecmp.cmp(fused_log, reference_log, shallow=False)
@@ -0,0 +1,39 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+import os
+
+from newpantheon.analysis import parse_cache, tunnel_log
+
+from tests import synthetic_logs
+
+
+def entry_name(cache_dir, log_path):
+    npz_path = parse_cache.cache_path(
+        cache_dir,
+        log_path,
+        version=tunnel_log.SUMMARY_VERSION,
+        max_exact_delays=None,
+        delay_error=0.01,
+    )
+    return os.path.basename(npz_path)
+
+
+def test_new_entry_replaces_superseded_ones(tmp_path):
+    runs = synthetic_logs.make_data_dir(
+        str(tmp_path), run_times=2, duration_s=1, datalink=True
+    )
+    log_path, other_log = (runs[("cubic", i)]["datalink"] for i in (1, 2))
+    cache_dir = parse_cache.cache_dir_for(str(tmp_path))
+
+    parse_cache.load_summary(other_log, cache_dir)
+    parse_cache.load_summary(log_path, cache_dir)
+    parse_cache.load_summary(log_path, cache_dir, max_exact_delays=10)
+    # a changed log is parsed again
+    st = os.stat(log_path)
+    os.utime(log_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    parse_cache.load_summary(log_path, cache_dir)
+
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        [entry_name(cache_dir, log_path), entry_name(cache_dir, other_log)]
+    )
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+import filecmp
+import subprocess
+
+import pytest
+
+from newpantheon.experiments.test import remote_logs
+
+from tests import synthetic_logs
+
+# runs the pack command in a local shell, as ssh would on the remote host
+LOCAL_SHELL = ["sh", "-c"]
+
+
+def make_remote_logs(tmp_path):
+    remote_dir = tmp_path / "remote dir"
+    remote_dir.mkdir()
+    runs = synthetic_logs.make_data_dir(
+        str(remote_dir), rate_mbps=12, duration_s=1, flows=3, seed=5
+    )
+    run = runs[("cubic", 1)]
+    return run["ingress"] + run["egress"]
+
+
+def test_fetch_remote_logs_copies_every_log(tmp_path):
+    logs = make_remote_logs(tmp_path)
+    local_dir = tmp_path / "local"
+    local_dir.mkdir()
+
+    local_logs = remote_logs.fetch_remote_logs(
+        LOCAL_SHELL, logs, str(local_dir), streams=2
+    )
+
+    assert sorted(local_logs) == sorted(logs)
+    for remote_log, local_log in local_logs.items():
+        assert local_log.startswith(str(local_dir))
+        assert filecmp.cmp(remote_log, local_log, shallow=False)
+
+
+def test_fetch_logs_reports_missing_logs(tmp_path):
+    logs = make_remote_logs(tmp_path)
+    missing = str(tmp_path / "remote dir" / "missing.log.egress")
+    local_dir = tmp_path / "local"
+    local_dir.mkdir()
+
+    with pytest.raises(subprocess.CalledProcessError, match="missing.log.egress"):
+        remote_logs.fetch_logs(LOCAL_SHELL, logs[:1] + [missing], str(local_dir))
+
+
+def test_fetch_remote_logs_warns_about_missing_logs(tmp_path, capsys):
+    logs = make_remote_logs(tmp_path)
+    missing = str(tmp_path / "remote dir" / "missing.log.egress")
+    local_dir = tmp_path / "local"
+    local_dir.mkdir()
+
+    local_logs = remote_logs.fetch_remote_logs(
+        LOCAL_SHELL, logs + [missing], str(local_dir), streams=2
+    )
+
+    assert "Warning" in capsys.readouterr().err
+    assert missing not in local_logs
+    assert sorted(local_logs) == sorted(logs)
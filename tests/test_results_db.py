@@ -0,0 +1,74 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+from newpantheon.common import results_db
+
+
+def make_result(tput, delay):
+    return {
+        "throughput": tput,
+        "delay": delay,
+        "loss": 0.01,
+        "duration": 30000.0,
+        "stats": "# stats\n",
+        "flow_data": {"all": {"tput": tput, "delay": delay, "loss": 0.01}},
+    }
+
+
+def test_aggregate_uses_latest_result_of_every_run(tmp_path):
+    db_path = str(tmp_path / "results.db")
+    meta = {"mode": "local", "flows": 1, "runtime": 30, "uplink_trace": "a/12mbps"}
+    other_meta = dict(meta, runtime=60)
+
+    results_db.record(
+        db_path,
+        results_db.add_results,
+        str(tmp_path / "a"),
+        meta,
+        {"cubic": {1: make_result(10.0, 50.0), 2: None}},
+    )
+    # analyzing again appends a newer result for the same run
+    results_db.record(
+        db_path,
+        results_db.add_results,
+        str(tmp_path / "a"),
+        meta,
+        {"cubic": {1: make_result(12.0, 40.0)}},
+    )
+    results_db.record(
+        db_path,
+        results_db.add_results,
+        str(tmp_path / "b"),
+        other_meta,
+        {"cubic": {1: make_result(8.0, 60.0)}, "bbr": {1: make_result(6.0, 30.0)}},
+    )
+    results_db.record(
+        db_path,
+        results_db.add_test_run,
+        str(tmp_path / "a"),
+        meta,
+        "cubic",
+        1,
+        start_at="2024-01-01 00:00:00",
+        end_at="2024-01-01 00:00:30",
+    )
+
+    conn = results_db.connect(db_path)
+    try:
+        rows = results_db.aggregate(conn, ["scheme"])
+        assert [(row["scheme"], row["experiments"], row["runs"]) for row in rows] == [
+            ("bbr", 1, 1),
+            ("cubic", 2, 2),
+        ]
+        assert rows[1]["throughput_mbps"] == 10.0
+
+        rows = results_db.aggregate(
+            conn, ["uplink_trace", "runtime"], schemes=["cubic"], where="runtime < 60"
+        )
+        assert [tuple(row)[:4] for row in rows] == [("12mbps", 30, 1, 1)]
+        assert rows[0]["delay_ms"] == 40.0
+
+        assert conn.execute("SELECT count(*) FROM experiments").fetchone()[0] == 2
+        assert conn.execute("SELECT count(*) FROM test_runs").fetchone()[0] == 1
+    finally:
+        conn.close()
@@ -0,0 +1,192 @@
+# SPDX-FileCopyrightText: 2024-present Shinwoo Kim <shinwookim@proton.me>
+#
+# SPDX-License-Identifier: MIT
+import argparse
+import filecmp
+import json
+import os
+
+import numpy as np
+
+from newpantheon.analysis import manifest, plot, run_stats, tunnel_graph, tunnel_log
+from newpantheon.common import log_format
+from newpantheon.experiments import merge_tunnel_logs
+
+from tests import benchmark_merge, synthetic_logs
+
+
+def make_run(tmp_path, **params):
+    params.setdefault("rate_mbps", 12)
+    params.setdefault("duration_s", 2)
+    tmp_path.mkdir(exist_ok=True)
+    runs = synthetic_logs.make_data_dir(str(tmp_path), **params)
+    return runs[("cubic", 1)]
+
+
+def test_generator_is_deterministic(tmp_path):
+    first = make_run(tmp_path / "first", loss=0.05, reorder=0.1, seed=7)
+    second = make_run(tmp_path / "second", loss=0.05, reorder=0.1, seed=7)
+
+    for key in ["ingress", "egress"]:
+        for log_a, log_b in zip(first[key], second[key]):
+            assert filecmp.cmp(log_a, log_b, shallow=False)
+    assert filecmp.cmp(first["link"], second["link"], shallow=False)
+
+
+def test_single_mode_matches_generated_tunnel_log(tmp_path):
+    run = make_run(tmp_path, loss=0.02, reorder=0.2, seed=3)
+    merged = str(tmp_path / "merged.log")
+    expected = str(tmp_path / "expected.log")
+
+    merge_tunnel_logs.single_mode(
+        argparse.Namespace(
+            ingress_log=run["ingress"][0],
+            egress_log=run["egress"][0],
+            output_log=merged,
+            i_clock_offset=None,
+            e_clock_offset=None,
+        )
+    )
+    synthetic_logs.write_tunnel_log(expected, run["ingress"][0], run["egress"][0])
+
+    assert filecmp.cmp(merged, expected, shallow=False)
+
+
+def test_datalink_log_statistics(tmp_path):
+    flows = [
+        synthetic_logs.generate_packets(6, 4, loss=0.1, seed=flow_id)
+        for flow_id in [1, 2]
+    ]
+    datalink_log = str(tmp_path / "datalink.log")
+    synthetic_logs.write_datalink_log(datalink_log, flows, link_rate_mbps=12)
+
+    results = tunnel_graph.TunnelGraph(datalink_log).run()
+
+    assert set(results["flow_data"]) == {"all", 1, 2}
+    assert 0.05 < results["loss"] < 0.15
+    assert 20 < results["delay"] < 40
+
+
+def test_merged_log_index(tmp_path):
+    run = make_run(tmp_path, flows=2, duration_s=4, reorder=0.2, seed=5)
+    tunnel_logs = []
+    for i, (ingress_log, egress_log) in enumerate(zip(run["ingress"], run["egress"])):
+        tunnel_logs.append(str(tmp_path / f"flow{i}.merged"))
+        merge_tunnel_logs.merge_single(ingress_log, egress_log, tunnel_logs[-1])
+    merged = str(tmp_path / "merged.log")
+    merge_tunnel_logs.merge_multiple(tunnel_logs, merged, run["link"])
+
+    with open(log_format.index_path(merged)) as index:
+        written = json.load(index)
+    index = log_format.index_log(merged)
+    with open(log_format.index_path(merged)) as rewritten:
+        assert json.load(rewritten) == written
+
+    events = next(log_format.iter_chunks(merged, 1 << 30))
+    start_us, end_us = 1500000, 2500000
+    within = next(
+        log_format.iter_chunks(merged, 1 << 30, index.time_range(start_us, end_us))
+    )
+    assert np.count_nonzero((within.ts >= start_us) & (within.ts < end_us)) == (
+        np.count_nonzero((events.ts >= start_us) & (events.ts < end_us))
+    )
+    assert within.ts.size < events.ts.size
+
+    flow = next(log_format.iter_chunks(merged, 1 << 30, index.flow_range(2)))
+    assert np.count_nonzero(flow.flow == 2) == np.count_nonzero(events.flow == 2)
+
+
+def exact_timelines(log_path, ms_per_bin):
+    """Departures per flow binned since its first arrival, leaving out its
+    first departure, the way plot_over_time used to bin every line"""
+    events = next(log_format.iter_chunks(log_path, 1 << 30))
+    base_ts = {}
+    timelines = {}
+    for ts, event, size, flow in zip(
+        events.ts.tolist(), events.event, events.size.tolist(), events.flow.tolist()
+    ):
+        if event == log_format.ARRIVAL:
+            base_ts.setdefault(flow, ts)
+        elif event == log_format.DEPARTURE:
+            if flow not in timelines:
+                timelines[flow] = {}
+                continue
+            bin_id = int((ts - base_ts[flow]) / (ms_per_bin * log_format.US_PER_MS))
+            timelines[flow][bin_id] = timelines[flow].get(bin_id, 0) + size * 8
+    return timelines
+
+
+def test_flow_timelines_bin_exactly(tmp_path):
+    # flows start at sub-millisecond offsets from the start of the log
+    logs = benchmark_merge.make_logs(
+        str(tmp_path), flows=3, rate_mbps=12, duration_s=3, seed=9
+    )
+    tunnel_logs = []
+    for i, flow in enumerate(logs["flows"]):
+        tunnel_logs.append(str(tmp_path / f"flow{i}.merged"))
+        merge_tunnel_logs.merge_single(output_log=tunnel_logs[-1], **flow)
+    merged = str(tmp_path / "merged.log")
+    merge_tunnel_logs.merge_multiple(tunnel_logs, merged, logs["link"])
+
+    summaries = [tunnel_log.summarize(merged)]
+    summaries.append(tunnel_log.summarize(merged, chunk_bytes=1 << 14, jobs=4))
+    os.remove(log_format.index_path(merged))
+    summaries.append(tunnel_log.summarize(merged, chunk_bytes=1 << 14, jobs=4))
+
+    for ms_per_bin in [1, 7, 500]:
+        expected = exact_timelines(merged, ms_per_bin)
+        for summary in summaries:
+            for flow_id, bins in expected.items():
+                timeline = summary.flow_timeline(flow_id, ms_per_bin)
+                binned = zip(timeline.bin_ids().tolist(), timeline.values().tolist())
+                assert {k: v for k, v in binned if v} == bins
+
+
+def test_incremental_plot_reparses_only_new_schemes(tmp_path, monkeypatch):
+    runs = synthetic_logs.make_data_dir(
+        str(tmp_path), schemes=("cubic", "bbr"), duration_s=3, datalink=True
+    )
+    parsed = []
+    parse_tunnel_log = plot.Plot.parse_tunnel_log
+
+    def counting_parse(self, cc, run_id):
+        parsed.append(cc)
+        return parse_tunnel_log(self, cc, run_id)
+
+    monkeypatch.setattr(plot.Plot, "parse_tunnel_log", counting_parse)
+
+    def run_plot(schemes):
+        args = argparse.Namespace(
+            data_dir=str(tmp_path),
+            schemes=schemes,
+            include_acklink=False,
+            no_graphs=False,
+            max_exact_delays=None,
+            delay_error=0.01,
+            delay_graph_mode="scatter",
+            parse_jobs=1,
+            analysis_jobs=1,
+            no_cache=True,
+            formats=["none"],
+            incremental=True,
+            interactions=False,
+        )
+        plot.Plot(args).run()
+        with open(tmp_path / "pantheon_perf.json") as perf:
+            return json.load(perf)
+
+    run_plot("cubic")
+    assert parsed == ["cubic"]
+    both = run_plot("cubic bbr")
+    assert parsed == ["cubic", "bbr"]
+    assert run_plot("cubic bbr") == both
+    assert parsed == ["cubic", "bbr"]
+    assert (tmp_path / manifest.MANIFEST_NAME).exists()
+    saved = run_stats.load(str(tmp_path), "bbr", 1)
+    assert saved["flow_data"] == both["bbr"]["1"]
+
+    # a changed log makes its run outdated
+    with open(runs[("bbr", 1)]["datalink"], "a") as datalink:
+        datalink.write("\n")
+    run_plot("cubic bbr")
+    assert parsed == ["cubic", "bbr", "bbr"]